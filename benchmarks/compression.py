@@ -0,0 +1,57 @@
+# Copyright (C) 2017 O.S. Systems Software LTDA.
+# SPDX-License-Identifier: GPL-2.0
+
+"""Compares compressed files verification: in-process vs utilities.
+
+Usage:
+
+    python benchmarks/compression.py IMAGE [IMAGE ...]
+
+Images may be gzip, xz or lzop files. To generate test images, use
+something like:
+
+    head -c 4G /dev/urandom | gzip -1 > 4G.img.gz
+"""
+
+import subprocess
+import sys
+import time
+
+from uhu.core.compression import (
+    COMPRESSORS, get_compressor_format, is_compressor_supported,
+    verify_compressed_file)
+
+
+def with_utility(fn, compressor):
+    compressor = COMPRESSORS[compressor]
+    subprocess.check_call(compressor['test'] % fn, shell=True)
+    size = subprocess.check_output(compressor['cmd'] % fn, shell=True)
+    return int(size.decode())
+
+
+def measure(func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - start
+
+
+def main(files):
+    print('{:<40} {:>8} {:>14} {:>10} {:>10}'.format(
+        'file', 'format', 'size', 'native', 'utility'))
+    for fn in files:
+        compressor = get_compressor_format(fn)
+        if compressor is None:
+            print('{}: not a supported compressed file'.format(fn))
+            continue
+        size, native = measure(verify_compressed_file, fn, compressor)
+        if is_compressor_supported(compressor):
+            _, utility = measure(with_utility, fn, compressor)
+            utility = '{:.2f}s'.format(utility)
+        else:
+            utility = 'n/a'
+        print('{:<40} {:>8} {:>14} {:>9.2f}s {:>10}'.format(
+            fn, compressor, size, native, utility))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,109 @@
+# Copyright (C) 2017 O.S. Systems Software LTDA.
+# SPDX-License-Identifier: GPL-2.0
+
+"""Measures install-condition version scanner throughput.
+
+Usage:
+
+    python benchmarks/version_scanner.py [FILE ...]
+
+Without arguments, a 32 MiB synthetic image is scanned: half random
+binary data, half long printable runs, with the U-Boot version string
+at its end (worst case, since the whole image must be scanned).
+
+get_uboot_version (memory mapped direct search) and UBootScanner (used
+by package inspection, fed with chunk size reads) are compared against
+the original implementation, reproduced below: printable strings built
+byte by byte from 30 bytes reads. find (VersionScanner, still used for
+regexp patterns and kernel images) is measured with the same pattern
+and chunk size reads.
+"""
+
+import os
+import random
+import re
+import sys
+import tempfile
+import time
+
+from uhu.core.install_condition import (
+    PRINTABLE, UBOOT_PATTERN, UBootScanner, check, find, get_uboot_version)
+from uhu.utils import get_chunk_size
+
+
+SYNTHETIC_SIZE = 32 * 1024 * 1024
+
+
+def create_image():
+    rand = random.Random(0)
+    with tempfile.NamedTemporaryFile(delete=False) as fp:
+        chunk = 1024 * 1024
+        for i in range(SYNTHETIC_SIZE // chunk):
+            if i % 2:
+                fp.write(bytes(rand.getrandbits(8) for _ in range(256)) * (
+                    chunk // 256))
+            else:
+                fp.write((b'x' * 4095 + b'\0') * (chunk // 4096))
+        fp.write(b'\0U-Boot 2017.01 (Jan 01 2017 - 00:00:00)\0')
+    return fp.name
+
+
+def original_get_uboot_version(fp):
+    regexp = re.compile(UBOOT_PATTERN)
+    phrase = b''
+    for chunk in iter(lambda: fp.read(30), b''):
+        for char in chunk:
+            if char in PRINTABLE:
+                phrase += bytes([char])
+            else:
+                result = check(phrase, regexp)
+                if result:
+                    return result
+                phrase = b''
+    return check(phrase, regexp)
+
+
+def inspect_uboot_version(fp):
+    scanner = UBootScanner()
+    for chunk in iter(lambda: fp.read(get_chunk_size()), b''):
+        if scanner.feed(chunk):
+            break
+    return scanner.close()
+
+
+def scan_uboot_version(fp):
+    chunks = iter(lambda: fp.read(get_chunk_size()), b'')
+    return find(fp, UBOOT_PATTERN, chunks)
+
+
+def measure(fn):
+    size = os.path.getsize(fn)
+    for name, func in [('direct search', get_uboot_version),
+                       ('inspection', inspect_uboot_version),
+                       ('version scanner', scan_uboot_version),
+                       ('original', original_get_uboot_version)]:
+        start = time.perf_counter()
+        with open(fn, 'rb') as fp:
+            try:
+                version = func(fp)
+            except ValueError:
+                version = None
+        elapsed = time.perf_counter() - start
+        print('{} [{}]: {} ({:.1f} MB/s, {:.2f}s)'.format(
+            fn, name, version, size / elapsed / 10 ** 6, elapsed))
+
+
+def main(files):
+    if files:
+        for fn in files:
+            measure(fn)
+        return
+    fn = create_image()
+    try:
+        measure(fn)
+    finally:
+        os.remove(fn)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
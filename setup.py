@@ -25,6 +25,12 @@ setup(
         'requests>=2',
         'rfc3987>=1.3',
     ],
+    extras_require={
+        # lz4 compressed Linux kernels support
+        'lz4': ['lz4>=2.0'],
+        # asyncio push engine
+        'asyncio': ['aiohttp>=3.3'],
+    },
     author='O.S. Systems Software LTDA',
     author_email='contato@ossystems.com.br',
     url='http://www.ossystems.com.br',
@@ -1,9 +1,11 @@
 # Copyright (C) 2017 O.S. Systems Software LTDA.
 # SPDX-License-Identifier: GPL-2.0
 
+import io
 import json
 import os
 import unittest
+from contextlib import redirect_stderr, redirect_stdout
 from unittest.mock import Mock, patch
 
 from click.testing import CliRunner
@@ -11,12 +13,15 @@ from click.testing import CliRunner
 from uhu.cli.package import (
     add_object_command, edit_object_command, remove_object_command,
     archive_command, export_command, show_command, set_version_command,
-    status_command, metadata_command, push_command)
+    status_command, metadata_command, push_command, batch_push_command,
+    verify_archive_command, push_archive_command)
+from uhu.cache import cache
 from uhu.cli.utils import open_package
 from uhu.core.package import Package
 from uhu.core.utils import dump_package, load_package
 from uhu.updatehub.api import UpdateHubError
-from uhu.utils import LOCAL_CONFIG_VAR, SERVER_URL_VAR
+from uhu.core.archive import EntryVerification
+from uhu.utils import LOCAL_CONFIG_VAR, PRIVATE_KEY_FN, SERVER_URL_VAR
 
 
 from utils import UHUTestCase, FileFixtureMixin, EnvironmentFixtureMixin
@@ -214,6 +219,40 @@ class ArchiveCommand(PackageTestCase):
         self.assertEqual(output, 'spam')
         self.assertTrue(force)
 
+    @patch('uhu.cli.package.dump_package_archive')
+    def test_can_archive_with_compression(self, mock):
+        result = self.runner.invoke(
+            archive_command, ['--compression', 'lzma', '--jobs', '2'])
+        self.assertEqual(result.exit_code, 0)
+        self.assertEqual(mock.call_args[1]['compression'], 'lzma')
+        self.assertEqual(mock.call_args[1]['jobs'], 2)
+
+    @patch('uhu.cli.package.stream_package_archive')
+    @patch('uhu.cli.package.dump_package_archive')
+    def test_can_stream_archive_to_stdout(self, dump, stream):
+        result = self.runner.invoke(archive_command, ['--output', '-'])
+        self.assertEqual(result.exit_code, 0)
+        self.assertFalse(dump.called)
+        self.assertEqual(stream.call_count, 1)
+
+    @patch('uhu.cli.package.stream_package_archive',
+           side_effect=ValueError('Invalid package.'))
+    def test_streaming_errors_are_written_to_stderr(self, stream):
+        stdout = io.TextIOWrapper(io.BytesIO())  # archive is binary
+        stderr = io.StringIO()
+        with redirect_stdout(stdout), redirect_stderr(stderr):
+            with self.assertRaises(SystemExit) as context:
+                archive_command.main(
+                    ['--output', '-'], standalone_mode=False)
+        self.assertEqual(context.exception.code, 2)
+        stdout.flush()
+        self.assertEqual(stdout.buffer.getvalue(), b'')
+        self.assertEqual(stderr.getvalue(), 'Error: Invalid package.\n')
+
+    def test_cannot_archive_with_unknown_compression(self):
+        result = self.runner.invoke(archive_command, ['--compression', 'zstd'])
+        self.assertEqual(result.exit_code, 2)
+
     @patch('uhu.cli.package.dump_package_archive', side_effect=FileExistsError)
     def test_archive_command_returns_1_if_archive_exists(self, mock):
         result = self.runner.invoke(archive_command)
@@ -418,6 +457,15 @@ class MetadataTestCase(PackageTestCase):
         result = self.runner.invoke(metadata_command)
         self.assertEqual(result.exit_code, 0)
 
+    def test_metadata_command_can_bypass_cache(self):
+        self.addCleanup(setattr, cache, 'enabled', True)
+        pkg = Package()
+        dump_package(pkg.to_template(), self.pkg_fn)
+        self.runner.invoke(metadata_command, ['--no-cache'])
+        self.assertFalse(cache.enabled)
+        self.runner.invoke(metadata_command)
+        self.assertTrue(cache.enabled)
+
     def test_metadata_commands_returns_1_when_metadata_is_invalid(self):
         pkg = Package()
         dump_package(pkg.to_template(), self.pkg_fn)
@@ -436,6 +484,32 @@ class PushCommandTestCase(unittest.TestCase):
         result = self.runner.invoke(push_command)
         self.assertEqual(result.exit_code, 0)
 
+    @patch('uhu.cli.package.open_package')
+    def test_can_set_number_of_jobs(self, open_package):
+        package = Mock()
+        open_package.return_value.__enter__.return_value = package
+        result = self.runner.invoke(push_command, ['--jobs', '4'])
+        self.assertEqual(result.exit_code, 0)
+        self.assertEqual(package.push.call_args[1]['jobs'], 4)
+
+    @patch('uhu.cli.package.open_package')
+    def test_can_set_number_of_upload_jobs(self, open_package):
+        package = Mock()
+        open_package.return_value.__enter__.return_value = package
+        result = self.runner.invoke(push_command, ['--upload-jobs', '2'])
+        self.assertEqual(result.exit_code, 0)
+        self.assertEqual(package.push.call_args[1]['upload_jobs'], 2)
+
+    @patch('uhu.cli.package.open_package')
+    def test_can_select_engine(self, open_package):
+        package = Mock()
+        open_package.return_value.__enter__.return_value = package
+        result = self.runner.invoke(push_command)
+        self.assertEqual(package.push.call_args[1]['engine'], 'threads')
+        result = self.runner.invoke(push_command, ['--engine', 'asyncio'])
+        self.assertEqual(result.exit_code, 0)
+        self.assertEqual(package.push.call_args[1]['engine'], 'asyncio')
+
     @patch('uhu.cli.package.open_package')
     def test_returns_2_when_updatehub_error(self, open_package):
         package = Mock()
@@ -452,3 +526,160 @@ class PushCommandTestCase(unittest.TestCase):
         for effect in effects:
             result = self.runner.invoke(push_command)
         self.assertEqual(show_cursor.call_count, len(effects))
+
+
+class BatchPushCommandTestCase(FileFixtureMixin, UHUTestCase):
+
+    def setUp(self):
+        self.runner = CliRunner()
+        self.files = []
+        for version in ('1.0', '2.0'):
+            fn = self.create_file()
+            dump_package(Package(version=version).to_template(), fn)
+            self.files.append(fn)
+
+    @patch('uhu.cli.package.push_packages')
+    def test_prints_uid_of_each_package(self, push_packages):
+        push_packages.return_value = ['uid-1', 'uid-2']
+        result = self.runner.invoke(batch_push_command, self.files)
+        self.assertEqual(result.exit_code, 0)
+        self.assertIn('{}: uid-1'.format(self.files[0]), result.output)
+        self.assertIn('{}: uid-2'.format(self.files[1]), result.output)
+        packages = push_packages.call_args[0][0]
+        self.assertEqual([pkg.version for pkg in packages], ['1.0', '2.0'])
+
+    @patch('uhu.cli.package.push_packages')
+    def test_can_set_number_of_jobs(self, push_packages):
+        push_packages.return_value = ['uid-1', 'uid-2']
+        args = ['--jobs', '2', '--upload-jobs', '3', '--package-jobs', '4']
+        self.runner.invoke(batch_push_command, args + self.files)
+        kwargs = push_packages.call_args[1]
+        self.assertEqual(kwargs['jobs'], 2)
+        self.assertEqual(kwargs['upload_jobs'], 3)
+        self.assertEqual(kwargs['package_jobs'], 4)
+
+    @patch('uhu.cli.package.push_packages')
+    def test_returns_2_when_some_package_fails(self, push_packages):
+        push_packages.return_value = [UpdateHubError('spam'), 'uid-2']
+        result = self.runner.invoke(batch_push_command, self.files)
+        self.assertEqual(result.exit_code, 2)
+        self.assertIn('{}: failed: spam'.format(self.files[0]), result.output)
+        self.assertIn('{}: uid-2'.format(self.files[1]), result.output)
+
+    @patch('uhu.core.package.push_package', return_value='uid-2')
+    def test_reports_packages_which_can_not_be_loaded(self, _):
+        package = Package(version='1.0')
+        package.objects.create({
+            'filename': '/missing/file',
+            'mode': 'raw',
+            'target-type': 'device',
+            'target': '/dev/sda',
+        })
+        dump_package(package.to_template(), self.files[0])
+        result = self.runner.invoke(batch_push_command, self.files)
+        self.assertEqual(result.exit_code, 2)
+        self.assertIn('{}: failed: '.format(self.files[0]), result.output)
+        self.assertIn('{}: uid-2'.format(self.files[1]), result.output)
+
+    def test_returns_1_when_package_file_is_invalid(self):
+        fn = self.create_file('not json')
+        result = self.runner.invoke(batch_push_command, [fn])
+        self.assertEqual(result.exit_code, 1)
+
+
+class VerifyArchiveCommandTestCase(
+        EnvironmentFixtureMixin, FileFixtureMixin, UHUTestCase):
+
+    def setUp(self):
+        self.runner = CliRunner()
+        self.key = self.create_file()
+        self.set_env_var(PRIVATE_KEY_FN, self.key)
+        self.archives = [self.create_file(), self.create_file()]
+
+    @patch('uhu.cli.package.verify_archive')
+    def test_prints_each_verified_entry(self, verify):
+        verify.side_effect = lambda fn, key, jobs: iter([
+            EntryVerification('sha0', 2 ** 20, None),
+            EntryVerification('sha1', 2 ** 20, None)])
+        result = self.runner.invoke(
+            verify_archive_command, ['--jobs', '3'] + self.archives)
+        self.assertEqual(result.exit_code, 0)
+        for fn in self.archives:
+            self.assertIn('{}: sha0: OK'.format(fn), result.output)
+            self.assertIn('{}: sha1: OK'.format(fn), result.output)
+            self.assertIn('{}: 2 entries, 2.0 MiB'.format(fn), result.output)
+        verify.assert_called_with(self.archives[1], self.key, 3)
+
+    @patch('uhu.cli.package.verify_archive')
+    def test_can_set_public_key(self, verify):
+        verify.return_value = iter([])
+        public_key = self.create_file()
+        self.runner.invoke(
+            verify_archive_command, ['--public-key', public_key,
+                                     self.archives[0]])
+        verify.assert_called_once_with(self.archives[0], public_key, None)
+
+    @patch('uhu.cli.package.verify_archive')
+    def test_returns_2_if_some_entry_is_invalid(self, verify):
+        verify.side_effect = [
+            iter([EntryVerification('sha0', 1, 'Object is missing.')]),
+            iter([EntryVerification('sha0', 1, None)])]
+        result = self.runner.invoke(verify_archive_command, self.archives)
+        self.assertEqual(result.exit_code, 2)
+        self.assertIn('{}: sha0: Object is missing.'.format(
+            self.archives[0]), result.output)
+        self.assertIn('1 of 2 archives are not valid.', result.output)
+
+    @patch('uhu.cli.package.verify_archive',
+           side_effect=ValueError('Archive metadata is not valid.'))
+    def test_returns_2_if_metadata_is_invalid(self, verify):
+        result = self.runner.invoke(verify_archive_command, self.archives)
+        self.assertEqual(result.exit_code, 2)
+        self.assertIn('{}: Archive metadata is not valid.'.format(
+            self.archives[1]), result.output)
+
+
+class PushArchiveCommandTestCase(
+        EnvironmentFixtureMixin, FileFixtureMixin, UHUTestCase):
+
+    def setUp(self):
+        self.runner = CliRunner()
+        self.key = self.create_file()
+        self.set_env_var(PRIVATE_KEY_FN, self.key)
+        self.archive = self.create_file()
+
+    @patch('uhu.cli.package.push_archive')
+    def test_returns_0_when_success(self, push):
+        result = self.runner.invoke(
+            push_archive_command,
+            [self.archive, '--jobs', '2', '--upload-jobs', '3'])
+        self.assertEqual(result.exit_code, 0)
+        args, kwargs = push.call_args
+        self.assertEqual(args[:2], (self.archive, self.key))
+        self.assertEqual(kwargs, {'jobs': 2, 'upload_jobs': 3})
+
+    @patch('uhu.cli.package.push_archive')
+    def test_can_set_public_key(self, push):
+        public_key = self.create_file()
+        self.runner.invoke(
+            push_archive_command, ['--public-key', public_key, self.archive])
+        self.assertEqual(push.call_args[0][1], public_key)
+
+    @patch('uhu.cli.package.push_archive')
+    def test_does_not_check_signature_when_trusted(self, push):
+        self.remove_env_var(PRIVATE_KEY_FN)
+        result = self.runner.invoke(
+            push_archive_command, ['--trust', self.archive])
+        self.assertEqual(result.exit_code, 0)
+        self.assertIsNone(push.call_args[0][1])
+
+    @patch('uhu.cli.package.push_archive',
+           side_effect=ValueError('Archive object is compressed.'))
+    def test_returns_2_when_archive_is_not_valid(self, push):
+        result = self.runner.invoke(push_archive_command, [self.archive])
+        self.assertEqual(result.exit_code, 2)
+
+    @patch('uhu.cli.package.push_archive', side_effect=UpdateHubError)
+    def test_returns_2_when_push_fails(self, push):
+        result = self.runner.invoke(push_archive_command, [self.archive])
+        self.assertEqual(result.exit_code, 2)
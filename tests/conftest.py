@@ -0,0 +1,12 @@
+# Copyright (C) 2017 O.S. Systems Software LTDA.
+# SPDX-License-Identifier: GPL-2.0
+
+import pytest
+
+from uhu.utils import CACHE_FILE_VAR
+
+
+@pytest.fixture(autouse=True)
+def cache_file(tmpdir, monkeypatch):
+    """Keeps tests away from user cache, and from each other caches."""
+    monkeypatch.setenv(CACHE_FILE_VAR, str(tmpdir.join('uhu-cache')))
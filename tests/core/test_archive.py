@@ -0,0 +1,359 @@
+# Copyright (C) 2017 O.S. Systems Software LTDA.
+# SPDX-License-Identifier: GPL-2.0
+
+import gzip
+import hashlib
+import os
+import threading
+import time
+import zipfile
+from unittest.mock import patch
+
+from Crypto.PublicKey import RSA
+
+from uhu.core.archive import (
+    ArchiveWriter, COMPRESSIONS, EntryVerification, push_archive,
+    verify_archive)
+from uhu.core.object import Object
+from uhu.core.package import Package
+from uhu.utils import CHUNK_SIZE_VAR, canonical_json, sign_bytes
+
+from utils import EnvironmentFixtureMixin, FileFixtureMixin, UHUTestCase
+
+
+class ArchiveWriterTestCase(
+        EnvironmentFixtureMixin, FileFixtureMixin, UHUTestCase):
+
+    def setUp(self):
+        self.set_env_var(CHUNK_SIZE_VAR, 2)
+        self.output = self.create_file()
+
+    def create_object(self, content):
+        return Object({
+            'filename': self.create_file(content),
+            'mode': 'raw',
+            'target-type': 'device',
+            'target': '/dev/sda',
+        })
+
+    def write(self, *objs, memo=None):
+        memo = {} if memo is None else memo
+        with ArchiveWriter(self.output) as writer:
+            writer.add([[obj] for obj in objs], memo)
+            writer.finish('metadata', 'signature')
+        return memo
+
+    def test_writes_objects_while_reading_digests(self):
+        objs = [self.create_object(b'spam'), self.create_object(b'eggs')]
+        with patch('uhu.core.inspection.open', create=True,
+                   side_effect=open) as read:
+            memo = self.write(*objs)
+        self.assertEqual(read.call_count, 2)
+        with zipfile.ZipFile(self.output) as archive:
+            self.assertIsNone(archive.testzip())
+            for obj, content in zip(objs, [b'spam', b'eggs']):
+                sha256sum = hashlib.sha256(content).hexdigest()
+                self.assertEqual(archive.read(sha256sum), content)
+                self.assertEqual(obj['sha256sum'], sha256sum)
+                self.assertEqual(
+                    memo[('digests', obj.realpath)][0], sha256sum)
+            self.assertEqual(archive.read('metadata'), b'metadata')
+            self.assertEqual(archive.read('signature'), b'signature')
+
+    def test_writes_metadata_and_signature_last(self):
+        self.write(self.create_object(b'spam'))
+        with zipfile.ZipFile(self.output) as archive:
+            names = archive.namelist()
+        self.assertEqual(names[1:], ['signature', 'metadata'])
+
+    def test_writes_same_content_only_once(self):
+        objs = [self.create_object(b'spam'), self.create_object(b'spam'),
+                self.create_object(b'eggs')]
+        self.write(*objs)
+        with zipfile.ZipFile(self.output) as archive:
+            self.assertIsNone(archive.testzip())
+            self.assertEqual(archive.namelist(), [
+                hashlib.sha256(b'spam').hexdigest(),
+                hashlib.sha256(b'eggs').hexdigest(),
+                'signature', 'metadata'])
+
+    def test_does_not_read_duplicated_cached_objects_into_archive(self):
+        objs = [self.create_object(b'spam'), self.create_object(b'spam')]
+        sha256sum = hashlib.sha256(b'spam').hexdigest()
+        memo = {
+            ('digests', objs[1].realpath): (sha256sum, 'md5'),
+            ('compression', objs[1].realpath): {},
+        }
+        with ArchiveWriter(self.output) as writer:
+            writer.add([[objs[0]]], memo)
+            with patch('uhu.core.inspection.open', create=True,
+                       side_effect=open) as read:
+                writer.add([[objs[1]]], memo)
+        self.assertFalse(read.called)
+
+    def test_can_write_empty_objects(self):
+        self.write(self.create_object(b''))
+        with zipfile.ZipFile(self.output) as archive:
+            self.assertEqual(
+                archive.read(hashlib.sha256(b'').hexdigest()), b'')
+
+    def test_archive_can_be_closed_when_object_read_fails(self):
+        obj = self.create_object(b'spam')
+        with patch('uhu.core.inspection.call', side_effect=OSError):
+            with self.assertRaises(OSError):
+                with ArchiveWriter(self.output) as writer:
+                    writer.add([[obj]], {})
+        self.assertTrue(os.path.exists(self.output))
+
+
+class ArchiveCompressionTestCase(
+        EnvironmentFixtureMixin, FileFixtureMixin, UHUTestCase):
+
+    def setUp(self):
+        self.set_env_var(CHUNK_SIZE_VAR, 1024)
+        self.contents = [b'spam' * 1000, b'eggs' * 1000, b'spam' * 1000,
+                         gzip.compress(b'ham' * 1000), b'']
+        self.groups = []
+        for content in self.contents:
+            self.groups.append([Object({
+                'filename': self.create_file(content),
+                'mode': 'raw',
+                'target-type': 'device',
+                'target': '/dev/sda',
+            })])
+
+    def write(self, compression, jobs):
+        output = self.create_file()
+        with ArchiveWriter(output, compression, jobs) as writer:
+            writer.add(self.groups, {})
+            writer.finish('metadata', 'signature')
+        return output
+
+    def test_can_compress_entries(self):
+        for compression, compress_type in COMPRESSIONS.items():
+            with zipfile.ZipFile(self.write(compression, 2)) as archive:
+                self.assertIsNone(archive.testzip())
+                for content in self.contents[:2]:
+                    name = hashlib.sha256(content).hexdigest()
+                    self.assertEqual(archive.read(name), content)
+                    info = archive.getinfo(name)
+                    self.assertEqual(info.compress_type, compress_type)
+                    self.assertLess(info.compress_size, info.file_size)
+                info = archive.getinfo('metadata')
+                self.assertEqual(info.compress_type, compress_type)
+
+    def test_does_not_compress_compressed_objects(self):
+        with zipfile.ZipFile(self.write('deflate', 2)) as archive:
+            name = hashlib.sha256(self.contents[3]).hexdigest()
+            self.assertEqual(archive.read(name), self.contents[3])
+            info = archive.getinfo(name)
+            self.assertEqual(info.compress_type, zipfile.ZIP_STORED)
+
+    def test_archive_does_not_depend_on_jobs(self):
+        for compression in [None, 'deflate', 'lzma']:
+            archives = []
+            for jobs in [1, 2, 5]:
+                with open(self.write(compression, jobs), 'rb') as fp:
+                    archives.append(fp.read())
+            self.assertEqual(archives[0], archives[1])
+            self.assertEqual(archives[0], archives[2])
+        with zipfile.ZipFile(self.write('deflate', 5)) as archive:
+            contents = [self.contents[i] for i in (0, 1, 3, 4)]
+            self.assertEqual(archive.namelist(), [
+                hashlib.sha256(content).hexdigest() for content in contents
+            ] + ['signature', 'metadata'])
+
+    def test_spooled_entries_write_the_same_archive(self):
+        for compression in [None, 'deflate']:
+            with open(self.write(compression, 2), 'rb') as fp:
+                expected = fp.read()
+            with patch('uhu.core.archive.WRITABLE_ENTRIES', False):
+                with open(self.write(compression, 2), 'rb') as fp:
+                    self.assertEqual(fp.read(), expected)
+
+    def test_compresses_objects_concurrently(self):
+        barrier = threading.Barrier(2, timeout=5)
+
+        def open_entry(writer, archive, filename, name=None):
+            barrier.wait()  # entries must be written at the same time
+            return original(writer, archive, filename, name)
+        original = ArchiveWriter.open_entry
+        self.groups = self.groups[:2]
+        with patch.object(ArchiveWriter, 'open_entry', open_entry):
+            self.write('deflate', 2)
+
+
+class ArchiveVerificationTestCase(
+        EnvironmentFixtureMixin, FileFixtureMixin, UHUTestCase):
+
+    def setUp(self):
+        self.set_env_var(CHUNK_SIZE_VAR, 1024)
+        self.key = self.create_file(RSA.generate(1024).exportKey())
+        self.contents = [b'spam' * 1000, b'eggs' * 1000]
+        self.names = [hashlib.sha256(content).hexdigest()
+                      for content in self.contents]
+        package = Package(version='1.0', product='a' * 64)
+        for content in self.contents:
+            package.objects.create({
+                'filename': self.create_file(content),
+                'mode': 'raw',
+                'target-type': 'device',
+                'target': '/dev/sda',
+            })
+        self.package = package
+        self.metadata = canonical_json(package.to_metadata())
+
+    def create_archive(self, entries, metadata=None, key=None):
+        metadata = self.metadata if metadata is None else metadata
+        output = self.create_file()
+        with zipfile.ZipFile(output, 'w', zipfile.ZIP_DEFLATED) as archive:
+            for name, content in entries:
+                archive.writestr(name, content)
+            archive.writestr('metadata', metadata)
+            archive.writestr(
+                'signature', sign_bytes(metadata, key or self.key))
+        return output
+
+    def verify(self, fn, jobs=2):
+        return sorted(verify_archive(fn, self.key, jobs))
+
+    def test_can_verify_archive(self):
+        fn = self.create_archive(zip(self.names, self.contents))
+        self.assertEqual(self.verify(fn), sorted([
+            EntryVerification(name, len(content), None)
+            for name, content in zip(self.names, self.contents)]))
+
+    def test_reports_entries_with_wrong_content(self):
+        fn = self.create_archive(
+            [(self.names[0], self.contents[0]),
+             (self.names[1], self.contents[0])])
+        results = {result.name: result for result in self.verify(fn)}
+        self.assertIsNone(results[self.names[0]].error)
+        self.assertIsNotNone(results[self.names[1]].error)
+
+    def test_reports_missing_objects(self):
+        fn = self.create_archive([(self.names[0], self.contents[0])])
+        results = {result.name: result for result in self.verify(fn)}
+        self.assertIsNone(results[self.names[0]].error)
+        self.assertEqual(results[self.names[1]].error, 'Object is missing.')
+
+    def test_reports_corrupted_entries(self):
+        fn = self.create_archive(zip(self.names, self.contents))
+        with zipfile.ZipFile(fn) as archive:
+            info = archive.getinfo(self.names[0])
+        with open(fn, 'r+b') as fp:
+            fp.seek(info.header_offset + 30 + len(info.filename) + 10)
+            fp.write(b'\0' * 16)
+        results = {result.name: result for result in self.verify(fn)}
+        self.assertIsNotNone(results[self.names[0]].error)
+        self.assertIsNone(results[self.names[1]].error)
+
+    def test_raises_error_if_signature_is_not_valid(self):
+        other_key = self.create_file(RSA.generate(1024).exportKey())
+        fn = self.create_archive(
+            zip(self.names, self.contents), key=other_key)
+        with self.assertRaises(ValueError):
+            verify_archive(fn, self.key)
+
+    def test_raises_error_if_metadata_is_not_valid(self):
+        fn = self.create_archive(
+            zip(self.names, self.contents), metadata=b'{"spam": 1}')
+        with self.assertRaises(ValueError):
+            verify_archive(fn, self.key)
+
+    def test_raises_error_if_file_is_not_an_archive(self):
+        with self.assertRaises(ValueError):
+            verify_archive(self.create_file(b'spam'), self.key)
+
+    def test_archive_written_by_uhu_is_valid(self):
+        with ArchiveWriter(self.create_file(), 'deflate', 2) as writer:
+            writer.add(self.package.objects.group_by_file().values(), {})
+            writer.finish(self.metadata, sign_bytes(self.metadata, self.key))
+        results = self.verify(writer.archive.filename)
+        self.assertEqual([result.error for result in results], [None, None])
+
+
+class PushArchiveTestCase(ArchiveVerificationTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.archive = self.create_stored_archive(
+            zip(self.names, self.contents))
+
+    def create_stored_archive(self, entries, key=None):
+        output = self.create_file()
+        with zipfile.ZipFile(output, 'w') as archive:
+            for name, content in entries:
+                archive.writestr(name, content)
+            archive.writestr('metadata', self.metadata)
+            archive.writestr(
+                'signature', sign_bytes(self.metadata, key or self.key))
+        return output
+
+    def push(self, fn, key=None):
+        with patch('uhu.core.archive.push_package') as push_package:
+            push_package.return_value = 'package-uid'
+            self.assertEqual(push_archive(fn, key, jobs=2), 'package-uid')
+        return push_package.call_args
+
+    def test_uploads_objects_from_archive_entries(self):
+        (metadata, objects, *_), kwargs = self.push(self.archive, self.key)
+        self.assertEqual(metadata, self.metadata)
+        self.assertEqual(
+            kwargs['signature'], sign_bytes(self.metadata, self.key))
+        self.assertEqual(
+            sorted(obj['sha256sum'] for obj in objects), sorted(self.names))
+        for obj in objects:
+            content = self.contents[self.names.index(obj['sha256sum'])]
+            self.assertEqual(obj['filename'], self.archive)
+            self.assertEqual(obj['size'], len(content))
+            self.assertEqual(obj['md5'], hashlib.md5(content).hexdigest())
+            with open(self.archive, 'rb') as fp:
+                fp.seek(obj['start'])
+                self.assertEqual(fp.read(obj['size']), content)
+
+    def test_can_push_archive_written_by_uhu(self):
+        with ArchiveWriter(self.archive) as writer:
+            writer.add(self.package.objects.group_by_file().values(), {})
+            writer.finish(self.metadata, sign_bytes(self.metadata, self.key))
+        _, objects, *_ = self.push(self.archive, self.key)[0]
+        self.assertEqual(len(objects), 2)
+
+    def test_does_not_read_entries_whose_md5_are_cached(self):
+        past = time.time() - 60
+        os.utime(self.archive, (past, past))
+        self.push(self.archive)
+        with patch('uhu.core.archive.hashlib.md5') as md5:
+            _, objects, *_ = self.push(self.archive)[0]
+        self.assertFalse(md5.called)
+        for obj in objects:
+            content = self.contents[self.names.index(obj['sha256sum'])]
+            self.assertEqual(obj['md5'], hashlib.md5(content).hexdigest())
+
+    def test_raises_error_if_entry_content_does_not_match_its_name(self):
+        fn = self.create_stored_archive(
+            [(self.names[0], self.contents[0]),
+             (self.names[1], self.contents[0])])
+        with self.assertRaises(ValueError):
+            self.push(fn)
+
+    def test_raises_error_if_object_is_missing(self):
+        fn = self.create_stored_archive([(self.names[0], self.contents[0])])
+        with self.assertRaises(ValueError):
+            self.push(fn)
+
+    def test_raises_error_if_entries_are_compressed(self):
+        fn = self.create_archive(zip(self.names, self.contents))
+        with self.assertRaises(ValueError):
+            self.push(fn)
+
+    def test_raises_error_if_signature_is_not_valid(self):
+        other_key = self.create_file(RSA.generate(1024).exportKey())
+        with self.assertRaises(ValueError):
+            self.push(self.archive, other_key)
+
+    def test_does_not_check_signature_without_key(self):
+        other_key = self.create_file(RSA.generate(1024).exportKey())
+        fn = self.create_stored_archive(
+            zip(self.names, self.contents), key=other_key)
+        self.push(fn)
@@ -1,14 +1,17 @@
 # Copyright (C) 2017 O.S. Systems Software LTDA.
 # SPDX-License-Identifier: GPL-2.0
 
+import gzip
+import lzma
 import os
+import subprocess
 import unittest
 from unittest.mock import patch
 
 from uhu.core.object import Object
 import uhu.core.compression as utils
 
-from utils import UHUTestCase, FileFixtureMixin
+from utils import UHUTestCase, FileFixtureMixin, LegacyLZMADecompressor
 
 
 class CompressionUtilitiesTestCase(FileFixtureMixin, UHUTestCase):
@@ -51,17 +54,57 @@ class CompressionUtilitiesTestCase(FileFixtureMixin, UHUTestCase):
             utils.get_uncompressed_size(fn, 'bz2')
 
     @patch('uhu.core.compression.shutil.which', return_value=None)
-    def test_uncompressed_size_raises_error_if_not_supported_by_os(self, _):
-        fn = os.path.join(self.fixtures_dir, 'base.txt.lzo')
-        with self.assertRaises(SystemError):
+    def test_uncompressed_size_raises_error_if_corrupted_file(self, _):
+        fn = self.create_file(utils.COMPRESSORS['lzop']['signature'])
+        with self.assertRaises(ValueError):
             utils.get_uncompressed_size(fn, 'lzop')
 
-    @patch('uhu.core.compression.subprocess.check_call', return_value=1)
-    def test_uncompressed_size_raises_error_if_corrupted_file(self, _):
-        fn = os.path.join(self.fixtures_dir, 'base.txt.lzo')
+    @patch('uhu.core.compression.shutil.which', return_value='lzop')
+    @patch('uhu.core.compression.subprocess.check_call',
+           side_effect=subprocess.CalledProcessError(1, 'lzop'))
+    def test_utility_fallback_raises_error_if_corrupted_file(self, *_):
+        fn = self.create_file(utils.COMPRESSORS['lzop']['signature'])
         with self.assertRaises(ValueError):
             utils.get_uncompressed_size(fn, 'lzop')
 
+    @patch('uhu.core.compression.subprocess')
+    def test_uncompressed_size_does_not_call_external_utilities(self, cmd):
+        for fn, compressor in [('base.txt.gz', 'gzip'),
+                               ('base.txt.xz', 'xz')]:
+            fn = os.path.join(self.fixtures_dir, fn)
+            observed = utils.get_uncompressed_size(fn, compressor)
+            self.assertEqual(observed, self.size)
+        self.assertFalse(cmd.mock_calls)
+
+    def test_can_get_multiple_member_gzip_uncompressed_size(self):
+        fn = self.create_file(gzip.compress(b'spam') + gzip.compress(b'eggs'))
+        self.assertEqual(utils.verify_compressed_file(fn, 'gzip'), 8)
+
+    def test_can_get_concatenated_xz_streams_uncompressed_size(self):
+        content = lzma.compress(b'spam') + b'\0' * 4 + lzma.compress(b'eggs')
+        fn = self.create_file(content)
+        self.assertEqual(utils.verify_compressed_file(fn, 'xz'), 8)
+
+    @patch('uhu.core.compression.lzma.LZMADecompressor',
+           LegacyLZMADecompressor)
+    def test_can_get_xz_uncompressed_size_without_output_limit(self):
+        content = lzma.compress(b'spam') + b'\0' * 4 + lzma.compress(b'eggs')
+        fn = self.create_file(content)
+        self.assertEqual(utils.verify_compressed_file(fn, 'xz'), 8)
+
+    def test_verify_compressed_file_raises_error_if_file_is_not_parsable(self):
+        fn = self.create_file(b'spam' * 10)
+        for compressor in utils.SIZE_COUNTERS:
+            with self.assertRaises(ValueError):
+                utils.verify_compressed_file(fn, compressor)
+
+    @patch('uhu.core.compression.subprocess.check_output', return_value=b'4')
+    @patch('uhu.core.compression.subprocess.check_call', return_value=0)
+    @patch('uhu.core.compression.shutil.which', return_value='xz')
+    def test_uncompressed_size_fallbacks_to_utility_if_not_parsable(self, *_):
+        fn = self.create_file(utils.COMPRESSORS['xz']['signature'])
+        self.assertEqual(utils.get_uncompressed_size(fn, 'xz'), 4)
+
     def test_can_get_gzip_compressor_format_from_file(self):
         fn = os.path.join(self.fixtures_dir, 'base.txt.gz')
         observed = utils.get_compressor_format(fn)
@@ -91,6 +134,63 @@ class CompressionUtilitiesTestCase(FileFixtureMixin, UHUTestCase):
         fn = os.path.join(self.fixtures_dir, 'base.txt.bz2')
         self.assertFalse(utils.is_valid_compressed_file(fn, 'gzip'))
 
+    @patch('uhu.core.compression.subprocess')
+    def test_is_valid_compressed_file_does_not_call_utilities(self, cmd):
+        for fn, compressor in [('base.txt.gz', 'gzip'),
+                               ('base.txt.xz', 'xz')]:
+            fn = os.path.join(self.fixtures_dir, fn)
+            self.assertTrue(utils.is_valid_compressed_file(fn, compressor))
+        self.assertFalse(cmd.mock_calls)
+
+    def corrupt_lzop_compressed_block(self):
+        fn = os.path.join(self.fixtures_dir, 'base.txt.lzo')
+        with open(fn, 'rb') as fp:
+            content = bytearray(fp.read())
+        # Fixture has only uncompressed data checksums (lzop default),
+        # so a compressed block can't be checked without uncompressing
+        content[100] ^= 0xff
+        return self.create_file(bytes(content))
+
+    @patch('uhu.core.compression.shutil.which', return_value='lzop')
+    @patch('uhu.core.compression.subprocess.check_call')
+    def test_unverifiable_lzop_blocks_are_tested_by_lzop(self, cmd, _):
+        fn = os.path.join(self.fixtures_dir, 'base.txt.lzo')
+        self.assertEqual(utils.verify_compressed_file(fn, 'lzop'), self.size)
+        cmd.assert_called_once_with('lzop -t {}'.format(fn), shell=True)
+        fn = self.corrupt_lzop_compressed_block()
+        cmd.side_effect = subprocess.CalledProcessError(1, 'lzop')
+        self.assertFalse(utils.is_valid_compressed_file(fn, 'lzop'))
+
+    @patch('uhu.core.compression.shutil.which', return_value=None)
+    def test_unverifiable_lzop_file_is_not_valid_without_lzop(self, _):
+        fn = self.corrupt_lzop_compressed_block()
+        self.assertFalse(utils.is_valid_compressed_file(fn, 'lzop'))
+        with self.assertRaises(SystemError):
+            utils.verify_compressed_file(fn, 'lzop')
+
+    def test_is_valid_compressed_file_returns_false_if_truncated(self):
+        for fn in ['base.txt.gz', 'base.txt.xz', 'base.txt.lzo']:
+            with open(os.path.join(self.fixtures_dir, fn), 'rb') as fp:
+                content = fp.read()
+            fn = self.create_file(content[:-10])
+            compressor = utils.get_compressor_format(fn)
+            self.assertFalse(utils.is_valid_compressed_file(fn, compressor))
+
+    def test_is_valid_compressed_file_verifies_lzop_checksums(self):
+        fn = os.path.join(self.fixtures_dir, 'base.txt.lzo')
+        with open(fn, 'rb') as fp:
+            content = bytearray(fp.read())
+        # Header checksum
+        header = bytearray(content)
+        header[20] ^= 0xff
+        self.assertFalse(utils.is_valid_compressed_file(
+            self.create_file(bytes(header)), 'lzop'))
+        # Block sizes (uncompressed size is bigger than block limit)
+        block = bytearray(content)
+        block[46] = 0xff
+        self.assertFalse(utils.is_valid_compressed_file(
+            self.create_file(bytes(block)), 'lzop'))
+
 
 class CompressedObjectTestCase(unittest.TestCase):
 
@@ -0,0 +1,132 @@
+# Copyright (C) 2017 O.S. Systems Software LTDA.
+# SPDX-License-Identifier: GPL-2.0
+
+import gzip
+import hashlib
+import os
+from unittest.mock import Mock, patch
+
+from uhu.core.compression import CompressionConsumer
+from uhu.core.inspection import DigestConsumer, Inspection
+from uhu.core.install_condition import VersionConsumer
+from uhu.utils import CHUNK_SIZE_VAR
+
+from utils import EnvironmentFixtureMixin, FileFixtureMixin, UHUTestCase
+
+
+class InspectionTestCase(
+        EnvironmentFixtureMixin, FileFixtureMixin, UHUTestCase):
+
+    def setUp(self):
+        self.set_env_var(CHUNK_SIZE_VAR, 2)
+        self.content = b'spam 1.0\0eggs 2.0'
+        self.fn = self.create_file(self.content)
+
+    def test_feeds_all_consumers_in_a_single_read(self):
+        memo = {}
+        inspection = Inspection(self.fn, memo)
+        inspection.want('digests', DigestConsumer())
+        inspection.want('version', VersionConsumer(br'\d\.\d'))
+        with patch('uhu.core.inspection.open', create=True,
+                   side_effect=open) as read:
+            inspection.run()
+        self.assertEqual(read.call_count, 1)
+        self.assertEqual(memo['digests'], (
+            hashlib.sha256(self.content).hexdigest(),
+            hashlib.md5(self.content).hexdigest()))
+        self.assertEqual(memo['version'], '1.0')
+
+    def test_does_not_read_file_when_results_are_in_memo(self):
+        memo = {'digests': ('sha256', 'md5')}
+        inspection = Inspection(self.fn, memo)
+        inspection.want('digests', DigestConsumer())
+        with patch('uhu.core.inspection.open', create=True) as read:
+            inspection.run()
+        self.assertFalse(read.called)
+        self.assertEqual(memo['digests'], ('sha256', 'md5'))
+
+    def test_stops_reading_when_all_consumers_are_done(self):
+        callback = Mock()
+        inspection = Inspection(self.fn, {})
+        inspection.want('version', VersionConsumer(br'\d\.\d'))
+        inspection.run(callback)
+        # 'spam 1.0\0' is read in 5 chunks of 2 bytes
+        self.assertEqual(callback.object_read.call_count, 5)
+
+    def test_calls_hook_with_result(self):
+        hook = Mock()
+        inspection = Inspection(self.fn, {})
+        inspection.want('version', VersionConsumer(br'\d\.\d'), hook)
+        inspection.run()
+        hook.assert_called_once_with('1.0')
+
+    def test_version_consumer_can_seek(self):
+        memo = {}
+        inspection = Inspection(self.fn, memo)
+        inspection.want('version', VersionConsumer(br'\d\.\d', seek=9))
+        inspection.run()
+        self.assertEqual(memo['version'], '2.0')
+
+    def test_version_consumer_raises_error_when_version_is_missing(self):
+        inspection = Inspection(self.fn, {})
+        inspection.want('version', VersionConsumer(br'\d\.\d\.\d'))
+        with self.assertRaises(ValueError):
+            inspection.run()
+
+
+class CompressionConsumerTestCase(
+        EnvironmentFixtureMixin, FileFixtureMixin, UHUTestCase):
+
+    def setUp(self):
+        self.fixtures_dir = 'tests/core/fixtures/compression/'
+        self.size = os.path.getsize(
+            os.path.join(self.fixtures_dir, 'base.txt'))
+
+    def inspect(self, fn):
+        memo = {}
+        inspection = Inspection(fn, memo)
+        inspection.want('compression', CompressionConsumer(fn))
+        inspection.run()
+        return memo['compression']
+
+    def test_can_get_uncompressed_size(self):
+        expected = {
+            'compressed': True,
+            'required-uncompressed-size': self.size,
+        }
+        for chunk_size in [1, 3, 1024]:
+            self.set_env_var(CHUNK_SIZE_VAR, chunk_size)
+            for fn in ['base.txt.gz', 'base.txt.xz', 'symbolic.gz']:
+                fn = os.path.join(self.fixtures_dir, fn)
+                self.assertEqual(self.inspect(fn), expected)
+
+    @patch('uhu.core.compression.shutil.which', return_value='lzop')
+    @patch('uhu.core.compression.subprocess')
+    def test_fallbacks_to_compressor_when_file_is_not_verified(self, cmd, _):
+        cmd.check_output.return_value = b'4'
+        fn = self.create_file(b'\x1f\x8b' + b'spam')
+        metadata = self.inspect(fn)
+        self.assertEqual(metadata['required-uncompressed-size'], 4)
+        self.assertEqual(cmd.check_call.call_count, 1)
+
+    def test_returns_empty_metadata_when_not_compressed(self):
+        for fn in ['base.txt', 'base.txt.bz2', 'archive.tar']:
+            fn = os.path.join(self.fixtures_dir, fn)
+            self.assertEqual(self.inspect(fn), {})
+        self.assertEqual(self.inspect(self.create_file(b'\x1f')), {})
+
+    def test_can_get_uncompressed_size_of_multiple_gzip_members(self):
+        fn = self.create_file(gzip.compress(b'spam') + gzip.compress(b'eggs'))
+        metadata = self.inspect(fn)
+        self.assertEqual(metadata['required-uncompressed-size'], 8)
+
+    def test_raises_error_when_file_is_corrupted(self):
+        data = bytearray(gzip.compress(b'spam' * 100))
+        data[-5] ^= 0xff  # breaks CRC32
+        files = [
+            self.create_file(bytes(data)),
+            self.create_file(gzip.compress(b'spam')[:-4]),  # truncated
+        ]
+        for fn in files:
+            with self.assertRaises(ValueError):
+                self.inspect(fn)
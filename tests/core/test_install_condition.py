@@ -1,17 +1,26 @@
 # Copyright (C) 2017 O.S. Systems Software LTDA.
 # SPDX-License-Identifier: GPL-2.0
 
+import gzip
 import hashlib
+import io
+import lzma
 import os
+import struct
 import tempfile
 import unittest
+from unittest.mock import Mock, patch
 
 from uhu.core import install_condition as ic
 from uhu.core.install_condition import (
     normalize_install_if_different, KNOWN_PATTERNS, InstallCondition)
 from uhu.core.object import Object
+from uhu.core.objects import ObjectsManager
+from uhu.utils import CHUNK_SIZE_VAR
 
-from utils import FileFixtureMixin, UHUTestCase
+from utils import (
+    EnvironmentFixtureMixin, FileFixtureMixin, LegacyLZMADecompressor,
+    UHUTestCase)
 
 
 def create_u_boot_file():
@@ -118,6 +127,177 @@ class KernelVersionTestCase(unittest.TestCase):
             self.assertEqual(expected, observed)
 
 
+class ArmZImageVersionTestCase(
+        EnvironmentFixtureMixin, FileFixtureMixin, UHUTestCase):
+
+    def test_can_find_marker_split_between_windows(self):
+        self.set_env_var(CHUNK_SIZE_VAR, 3)
+        fn = self.create_file(b'spam' + b'\x1f\x8b\x08\0' + b'eggs')
+        with open(fn, 'rb') as fp:
+            self.assertEqual(ic.find_marker(fp, b'\x1f\x8b\x08\0'), 4)
+            self.assertIsNone(ic.find_marker(fp, b'\x1f\x8b\x08\1'))
+
+    def test_can_get_version_with_small_windows(self):
+        self.set_env_var(CHUNK_SIZE_VAR, 5)
+        fn = 'tests/core/fixtures/install-condition/kernel/arm-zImage'
+        with open(fn, 'rb') as fp:
+            self.assertEqual(ic.get_arm_z_image_version(fp), '4.4.1')
+
+    def test_stops_uncompressing_when_version_is_found(self):
+        content = b'Linux version 1.2.3 (spam)\n' + os.urandom(1024 * 1024)
+        fn = self.create_file(
+            b'spam' + gzip.compress(content, mtime=0) + b'eggs')
+        with open(fn, 'rb') as fp:
+            self.assertEqual(ic.get_arm_z_image_version(fp), '1.2.3')
+            self.assertLess(fp.tell(), os.path.getsize(fn))
+
+    def test_returns_None_when_there_is_no_compressed_kernel(self):
+        fn = self.create_file(b'spam')
+        with open(fn, 'rb') as fp:
+            self.assertIsNone(ic.get_arm_z_image_version(fp))
+
+
+def create_fdt_node(name, props, strings):
+    def pad(data):
+        return data + b'\0' * (-len(data) % 4)
+
+    node = struct.pack('>I', ic.FDT_BEGIN_NODE) + pad(name + b'\0')
+    for prop, value in props:
+        if isinstance(value, list):  # subnode
+            node += create_fdt_node(prop, value, strings)
+            continue
+        if prop + b'\0' not in strings:
+            strings += prop + b'\0'
+        node += struct.pack('>III', ic.FDT_PROP, len(value),
+                            strings.index(prop + b'\0')) + pad(value)
+    return node + struct.pack('>I', ic.FDT_END_NODE)
+
+
+def create_fit_image(kernel, compression):
+    strings = bytearray()
+    tree = create_fdt_node(b'', [
+        (b'images', [
+            (b'kernel-1', [
+                (b'data', kernel),
+                (b'type', b'kernel\0'),
+                (b'compression', compression + b'\0'),
+            ]),
+        ]),
+    ], strings) + struct.pack('>I', ic.FDT_END)
+    struct_offset = 40 + 16  # header and empty memory reservation map
+    strings_offset = struct_offset + len(tree)
+    header = struct.pack(
+        '>10I', ic.FIT_IMAGE, strings_offset + len(strings), struct_offset,
+        strings_offset, 40, 17, 16, 0, len(strings), len(tree))
+    return header + b'\0' * 16 + tree + bytes(strings)
+
+
+class KernelFormatsTestCase(FileFixtureMixin, UHUTestCase):
+
+    def setUp(self):
+        self.kernel = b'\0spam\0Linux version 5.4.0-rc1 (eggs)\n\0'
+
+    def get_version(self, content):
+        with open(self.create_file(content), 'rb') as fp:
+            return ic.get_kernel_version(fp)
+
+    def test_can_get_arm64_image_version(self):
+        content = bytearray(64) + self.kernel
+        content[56:60] = b'ARM\x64'
+        self.assertEqual(self.get_version(bytes(content)), '5.4.0-rc1')
+
+    def test_can_get_gzip_image_version(self):
+        content = gzip.compress(self.kernel)
+        self.assertEqual(self.get_version(content), '5.4.0-rc1')
+
+    def test_can_get_xz_image_version(self):
+        content = lzma.compress(self.kernel)
+        self.assertEqual(self.get_version(content), '5.4.0-rc1')
+
+    @patch('uhu.core.install_condition.lzma.LZMADecompressor',
+           LegacyLZMADecompressor)
+    def test_can_get_lzma_image_version_without_output_limit(self):
+        self.assertEqual(
+            self.get_version(lzma.compress(self.kernel)), '5.4.0-rc1')
+        content = create_fit_image(
+            lzma.compress(self.kernel, lzma.FORMAT_ALONE), b'lzma')
+        self.assertEqual(self.get_version(content), '5.4.0-rc1')
+
+    @unittest.skipIf(ic.lz4 is None, 'lz4 is not installed')
+    def test_can_get_lz4_image_version(self):
+        content = ic.lz4.frame.compress(self.kernel)
+        self.assertEqual(self.get_version(content), '5.4.0-rc1')
+
+    def test_can_get_fit_image_version(self):
+        kernels = [
+            (self.kernel, b'none'),
+            (gzip.compress(self.kernel), b'gzip'),
+            (lzma.compress(self.kernel, lzma.FORMAT_ALONE), b'lzma'),
+        ]
+        for kernel, compression in kernels:
+            content = create_fit_image(kernel, compression)
+            self.assertEqual(self.get_version(content), '5.4.0-rc1')
+
+    @unittest.skipIf(ic.lz4 is None, 'lz4 is not installed')
+    def test_can_get_lz4_legacy_image_version(self):
+        block = ic.lz4.block.compress(self.kernel, store_size=False)
+        content = struct.pack('<II', ic.LZ4_LEGACY, len(block)) + block
+        self.assertEqual(self.get_version(content), '5.4.0-rc1')
+
+    def test_can_get_version_of_kernel_image_within_fit_image(self):
+        fn = 'tests/core/fixtures/install-condition/kernel/arm-zImage'
+        with open(fn, 'rb') as fp:
+            content = create_fit_image(fp.read(), b'none')
+        self.assertEqual(self.get_version(content), '4.4.1')
+
+    def test_raises_error_when_fit_image_is_truncated(self):
+        content = create_fit_image(self.kernel, b'none')
+        # Truncates the tree within the first property
+        for size in [60, 76, 92, 96, 100]:
+            with self.assertRaises(ValueError):
+                self.get_version(content[:size])
+
+    def test_raises_error_when_compressed_kernel_is_corrupted(self):
+        images = [
+            b'\x1f\x8b\x08\0' + b'spam' * 100,
+            b'\xfd7zXZ\0' + b'spam' * 100,
+        ]
+        for image in images:
+            with self.assertRaises(ValueError):
+                self.get_version(image)
+
+    def test_can_register_kernel_format_before_generic_formats(self):
+        formats = list(ic.KERNEL_FORMATS)
+        with patch.object(ic, 'KERNEL_FORMATS', formats):
+            ic.register_kernel_format(
+                'spam', ic.match_gzip, Mock(return_value='1.0'), index=0)
+            ic.register_kernel_format(
+                'eggs', Mock(return_value=True), Mock(return_value='2.0'))
+            self.assertEqual(ic.get_kernel_format(gzip.compress(b'')), 'spam')
+            self.assertEqual(self.get_version(gzip.compress(b'')), '1.0')
+            self.assertEqual(self.get_version(b'eggs'), '2.0')
+
+    def test_can_detect_kernel_format_from_header(self):
+        fixtures = 'tests/core/fixtures/install-condition/kernel'
+        for image in ['arm-zImage', 'arm-uImage', 'x86-bzImage', 'x86-zImage']:
+            with open(os.path.join(fixtures, image), 'rb') as fp:
+                header = ic.read_header(fp)
+            self.assertEqual(ic.get_kernel_format(header), image)
+        self.assertEqual(ic.get_kernel_format(gzip.compress(b'')), 'gzip')
+        self.assertIsNone(ic.get_kernel_format(b'spam'))
+
+    def test_stops_on_first_format_with_version(self):
+        formats = [
+            ('first', Mock(return_value=True), Mock(return_value=None)),
+            ('second', Mock(return_value=True), Mock(return_value='1.0')),
+            ('third', Mock(return_value=True), Mock(return_value='2.0')),
+        ]
+        with patch.object(ic, 'KERNEL_FORMATS', formats):
+            self.assertEqual(self.get_version(b'spam'), '1.0')
+        self.assertFalse(formats[2][1].called)
+        self.assertFalse(formats[2][2].called)
+
+
 class UBootVersionTestCase(unittest.TestCase):
 
     def test_can_get_uboot_version(self):
@@ -141,6 +321,78 @@ class UBootVersionTestCase(unittest.TestCase):
             with self.assertRaises(ValueError):
                 ic.get_uboot_version(fp)
 
+    def test_can_get_uboot_version_from_unmappable_file(self):
+        fp = io.BytesIO(b'\0U-Boot 2017.01 (Jan 01 2017)\0')
+        self.assertEqual(ic.get_uboot_version(fp), '2017.01')
+
+    def test_direct_search_matches_printable_strings_scanning(self):
+        images = [
+            b'U-Boot 1.0\0 (spam)\0U-Boot 2.0 (eggs)',
+            b'U-Boot \x01 1.0 (spam)\nU-Boot 2.0 (eggs)\n',
+            b'\xffU-Boot SPL 1.0 (spam\xff) U-Boot 2.0 (eggs\t)\x7f',
+            b'U-Boot 1.0 (\nU-Boot 2.0 (eggs)',
+            b'U-Boot U-Boot 1.0 (spam) (eggs)',
+        ]
+        for image in images:
+            expected = ic.find(
+                io.BytesIO(image), ic.UBOOT_PATTERN, [image])
+            fp = tempfile.TemporaryFile()
+            self.addCleanup(fp.close)
+            fp.write(image)
+            fp.flush()
+            self.assertEqual(ic.get_uboot_version(fp), expected)
+
+    def test_uboot_scanner_matches_direct_search_on_any_chunk_size(self):
+        images = [
+            b'U-Boot 1.0\0 (spam)\0U-Boot 2.0 (eggs)',
+            b'U-Boot \x01 1.0 (spam)\nU-Boot 2.0 (eggs)\n',
+            b'\xffU-Boot SPL 1.0 (spam\xff) U-Boot 2.0 (eggs\t)\x7f',
+            b'U-Boot 1.0 (\nU-Boot 2.0 (eggs)',
+            b'U-Boot U-Boot 1.0 (spam) (eggs)',
+            b'U-BootU-Boot 1.0 (spam)',
+            b'\0' * 10 + b'U-Boot 1.0 (spam)' + b'\0' * 10,
+        ]
+        for image in images:
+            match = ic.UBOOT_REGEXP.search(image)
+            expected = match.group(1).decode() if match else None
+            for size in range(1, len(image) + 1):
+                scanner = ic.UBootScanner()
+                for i in range(0, len(image), size):
+                    if scanner.feed(image[i:i + size]):
+                        break
+                self.assertEqual(scanner.close(), expected)
+
+
+class VersionScannerTestCase(unittest.TestCase):
+
+    def scan(self, data, pattern, chunk_size):
+        scanner = ic.VersionScanner(pattern)
+        for i in range(0, len(data), chunk_size):
+            result = scanner.feed(data[i:i + chunk_size])
+            if result is not None:
+                return result
+        return scanner.close()
+
+    def test_finds_pattern_in_runs_across_chunks(self):
+        data = b'\0spam\xffversion 1.2.3 eggs\0'
+        for chunk_size in range(1, len(data) + 1):
+            observed = self.scan(data, br'version (\S+)', chunk_size)
+            self.assertEqual(observed, '1.2.3')
+
+    def test_returns_first_match(self):
+        data = b'1.0\x002.0\x00'
+        for chunk_size in [1, 2, 3, 100]:
+            self.assertEqual(self.scan(data, br'\d\.\d', chunk_size), '1.0')
+
+    def test_does_not_match_across_non_printable_characters(self):
+        data = b'version\0 1.0'
+        self.assertIsNone(self.scan(data, br'version (\S+)', 4))
+
+    def test_scans_unterminated_run_when_closed(self):
+        data = b'\0\0spam 1.0'
+        for chunk_size in [1, 3, 100]:
+            self.assertEqual(self.scan(data, br'\d\.\d', chunk_size), '1.0')
+
 
 class CustomObjectVersionTestCase(unittest.TestCase):
 
@@ -350,6 +602,19 @@ class KnownVersionPatternObjectIntegrationTestCase(unittest.TestCase):
         self.assertEqual(
             metadata['install-if-different']['version'], '13.08.1988')
 
+    def test_u_boot_version_is_inspected_with_direct_search(self):
+        self.options['install-condition-pattern-type'] = 'u-boot'
+        self.options['filename'] = create_u_boot_file()
+        manager = ObjectsManager(1)
+        manager.create(self.options)
+        feed = ic.UBootScanner.feed
+        with patch.object(ic.UBootScanner, 'feed', autospec=True,
+                          side_effect=feed) as scanner:
+            metadata = manager.to_metadata()[manager.metadata]
+        self.assertTrue(scanner.called)
+        self.assertEqual(
+            metadata[0][0]['install-if-different']['version'], '13.08.1988')
+
     def test_can_represent_linux_kernel_object_as_template(self):
         self.options['install-condition-pattern-type'] = 'linux-kernel'
         self.template['install-condition-pattern-type'] = 'linux-kernel'  # nopep8
@@ -3,9 +3,12 @@
 
 import hashlib
 import os
+import time
+from unittest.mock import patch
 
+from uhu.cache import cache
 from uhu.core.object import Object
-from uhu.utils import CHUNK_SIZE_VAR
+from uhu.utils import CACHE_FILE_VAR, CHUNK_SIZE_VAR
 
 from utils import EnvironmentFixtureMixin, FileFixtureMixin, UHUTestCase
 
@@ -67,6 +70,35 @@ class ObjectTestCase(EnvironmentFixtureMixin, FileFixtureMixin, UHUTestCase):
         self.assertEqual(obj.md5, md5)
         self.assertEqual(obj['sha256sum'], sha256sum)
 
+    def test_load_uses_cached_digests_when_file_has_not_changed(self):
+        self.set_env_var(CACHE_FILE_VAR, self.create_file(''))
+        content = b'spam'
+        self.options['filename'] = self.create_file(content)
+        past = time.time() - 60
+        os.utime(self.options['filename'], (past, past))
+        Object(self.options).load()
+        obj = Object(self.options)
+        with patch.object(obj, '_read_digests') as read:
+            obj.load()
+        self.assertFalse(read.called)
+        self.assertEqual(obj.md5, hashlib.md5(content).hexdigest())
+        self.assertEqual(
+            obj['sha256sum'], hashlib.sha256(content).hexdigest())
+
+    def test_load_reads_object_when_cache_is_disabled(self):
+        self.set_env_var(CACHE_FILE_VAR, self.create_file(''))
+        self.options['filename'] = self.create_file(b'spam')
+        past = time.time() - 60
+        os.utime(self.options['filename'], (past, past))
+        Object(self.options).load()
+        obj = Object(self.options)
+        cache.enabled = False
+        self.addCleanup(setattr, cache, 'enabled', True)
+        with patch.object(
+                obj, '_read_digests', return_value=('', '')) as read:
+            obj.load()
+        self.assertTrue(read.called)
+
     def test_can_generate_metadata(self):
         content = b'spam'
         fn = self.create_file(content)
@@ -5,6 +5,8 @@ import os
 import unittest
 from unittest.mock import Mock, patch
 
+from uhu.cache import cache
+from uhu.core._object import BaseObject
 from uhu.core.object import Object
 from uhu.core.objects import ObjectsManager
 
@@ -244,3 +246,84 @@ class ObjectsManagerTestCase(unittest.TestCase):
         observed = [objs[0].filename for objs in manager.objects]
         expected = [str(n) for n in range(1, 10)]
         self.assertEqual(observed, expected)
+
+
+class ObjectsManagerLoadTestCase(unittest.TestCase):
+
+    def setUp(self):
+        cache.enabled = False
+        self.addCleanup(setattr, cache, 'enabled', True)
+        self.options = {
+            'filename': __file__,
+            'mode': 'raw',
+            'target-type': 'device',
+            'target': '/dev/sda',
+            'install-condition': 'version-diverges',
+            'install-condition-pattern-type': 'regexp',
+            'install-condition-pattern': r'Copyright \(C\) (\d+)',
+        }
+
+    @patch.object(BaseObject, '_read_digests', return_value=('sha', 'md5'))
+    def test_reads_each_file_once_across_installation_sets(self, read):
+        manager = ObjectsManager(2)
+        manager.create(self.options)
+        manager.load()
+        self.assertEqual(read.call_count, 1)
+
+    def test_inspects_each_file_once_across_installation_sets(self):
+        manager = ObjectsManager(2)
+        manager.create(self.options)
+        with patch('uhu.core.inspection.open', create=True,
+                   side_effect=open) as read:
+            metadata = manager.to_metadata()[manager.metadata]
+        self.assertEqual(read.call_count, 1)
+        self.assertEqual(metadata[0], metadata[1])
+
+    def test_links_to_the_same_file_are_read_once(self):
+        link = '{}.link'.format(__file__)
+        os.symlink(__file__, link)
+        self.addCleanup(os.remove, link)
+        manager = ObjectsManager(1)
+        manager.create(self.options)
+        self.options['filename'] = link
+        manager.create(self.options)
+        with patch('uhu.core.inspection.open', create=True,
+                   side_effect=open) as read:
+            manager.to_metadata()
+        self.assertEqual(read.call_count, 1)
+
+    def test_asymmetric_patterns_are_inspected_per_set(self):
+        manager = ObjectsManager(2)
+        self.options['install-condition-pattern'] = (
+            r'Copyright \(C\) (\d+)', r'SPDX-License-Identifier: (\S+)')
+        manager.create(self.options)
+        with patch('uhu.core.inspection.open', create=True,
+                   side_effect=open) as read:
+            metadata = manager.to_metadata()[manager.metadata]
+        self.assertEqual(read.call_count, 1)
+        versions = [objs[0]['install-if-different']['version']
+                    for objs in metadata]
+        self.assertEqual(versions, ['2017', 'GPL-2.0'])
+
+    def test_metadata_does_not_depend_on_jobs(self):
+        manager = ObjectsManager(2)
+        for fn in ['__init__.py', 'test_object.py', 'test_options.py']:
+            self.options['filename'] = os.path.join(
+                os.path.dirname(__file__), fn)
+            manager.create(self.options)
+        expected = manager.to_metadata(jobs=1)
+        for jobs in [2, 8]:
+            self.assertEqual(manager.to_metadata(jobs=jobs), expected)
+
+    def test_can_load_objects_concurrently(self):
+        manager = ObjectsManager(2)
+        self.options['filename'] = os.path.join(
+            os.path.dirname(__file__), '__init__.py')
+        manager.create(self.options)
+        manager.create(dict(self.options, filename=__file__))
+        callback = Mock()
+        manager.load(callback, jobs=4)
+        for obj in manager.all():
+            self.assertIsNotNone(obj['sha256sum'])
+        callback.start_objects_load.assert_called_once_with()
+        callback.finish_objects_load.assert_called_once_with()
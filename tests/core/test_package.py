@@ -3,7 +3,11 @@
 
 import base64
 import hashlib
+import io
 import os
+import subprocess
+import sys
+import threading
 import zipfile
 import unittest
 from unittest.mock import patch
@@ -14,9 +18,12 @@ from Crypto.Signature import PKCS1_v1_5
 from pkgschema import ValidationError
 
 from uhu.core.hardware import SupportedHardwareManager
+from uhu.core.inspection import Inspection
 from uhu.core.objects import ObjectsManager
-from uhu.core.package import Package
-from uhu.core.utils import dump_package, load_package, dump_package_archive
+from uhu.core.package import Package, push_packages
+from uhu.core.utils import (
+    dump_package, load_package, dump_package_archive, stream_package_archive)
+from uhu.updatehub.api import UpdateHubError
 from uhu.utils import CHUNK_SIZE_VAR, PRIVATE_KEY_FN
 
 from utils import FileFixtureMixin, EnvironmentFixtureMixin, UHUTestCase
@@ -253,6 +260,107 @@ class PackageSerializationTestCase(PackageTestCase):
         with self.assertRaises(ValueError):
             dump_package_archive(pkg, output, force=True)
 
+    @patch('uhu.core.utils.pkgschema.validate_metadata',
+           side_effect=ValidationError(None))
+    def test_invalid_package_does_not_replace_output(self, mock):
+        pkg = self.create_package()[0]
+        output = self.create_file(b'previous archive')
+        files = sorted(os.listdir(os.path.dirname(output)))
+        with self.assertRaises(ValueError):
+            dump_package_archive(pkg, output, force=True)
+        with open(output, 'rb') as fp:
+            self.assertEqual(fp.read(), b'previous archive')
+        self.assertEqual(sorted(os.listdir(os.path.dirname(output))), files)
+
+    def test_cannot_archive_package_with_unknown_compression(self):
+        pkg = self.create_package()[0]
+        output = self.create_file()
+        with self.assertRaises(ValueError):
+            dump_package_archive(pkg, output, force=True, compression='zstd')
+
+    def test_can_archive_package_with_compression(self):
+        pkg = self.create_package()[0]
+        output = self.create_file()
+        dump_package_archive(pkg, output, force=True, compression='deflate')
+        self.verify_archive(output)
+
+    def test_archive_reads_each_object_once(self):
+        pkg = self.create_package()[0]
+        output = self.create_file()
+        with patch('uhu.core.inspection.open', create=True,
+                   side_effect=open) as read:
+            dump_package_archive(pkg, output, force=True)
+        self.assertEqual(read.call_count, 1)
+        self.verify_archive(output)
+
+    def test_archive_mode_follows_umask(self):
+        pkg = self.create_package()[0]
+        output = self.create_file()
+        umask = os.umask(0o027)
+        self.addCleanup(os.umask, umask)
+        dump_package_archive(pkg, output, force=True)
+        self.assertEqual(os.stat(output).st_mode & 0o777, 0o640)
+
+
+class StreamPackageArchiveTestCase(PackageTestCase):
+
+    def create_package(self):
+        pkg = Package(version=self.version, product=self.product)
+        pkg.objects.create(self.obj_options)
+        return pkg
+
+    def read_pipe(self, fd):
+        data = []
+
+        def read():
+            with open(fd, 'rb') as fp:
+                data.append(fp.read())
+        thread = threading.Thread(target=read)
+        thread.start()
+        self.addCleanup(thread.join)
+        return thread, data
+
+    def test_can_stream_archive_to_pipe(self):
+        read_fd, write_fd = os.pipe()
+        thread, data = self.read_pipe(read_fd)
+        with os.fdopen(write_fd, 'wb') as fp:
+            stream_package_archive(self.create_package(), fp)
+        thread.join()
+        with zipfile.ZipFile(io.BytesIO(data[0])) as archive:
+            self.assertIsNone(archive.testzip())
+            self.assertEqual(
+                archive.namelist(), [self.obj_sha256, 'signature', 'metadata'])
+            self.assertEqual(archive.read(self.obj_sha256), b'spam')
+            for info in archive.infolist():
+                self.assertTrue(info.flag_bits & 0x08)  # data descriptor
+
+    def test_can_stream_compressed_archive(self):
+        fp = io.BytesIO()
+        stream_package_archive(self.create_package(), fp, jobs=2,
+                               compression='lzma')
+        with zipfile.ZipFile(fp) as archive:
+            self.assertIsNone(archive.testzip())
+            self.assertEqual(archive.read(self.obj_sha256), b'spam')
+
+    @patch('uhu.core.utils.pkgschema.validate_metadata',
+           side_effect=ValidationError(None))
+    def test_does_not_stream_invalid_package(self, mock):
+        fp = io.BytesIO()
+        with self.assertRaises(ValueError):
+            stream_package_archive(self.create_package(), fp)
+        self.assertEqual(fp.getvalue(), b'')
+
+    def test_archive_is_streamed_to_fifo(self):
+        output = self.create_file()
+        os.remove(output)
+        os.mkfifo(output)
+        thread, data = self.read_pipe(output)  # opened once archive is
+        self.assertEqual(
+            dump_package_archive(self.create_package(), output), output)
+        thread.join()
+        with zipfile.ZipFile(io.BytesIO(data[0])) as archive:
+            self.assertEqual(archive.read(self.obj_sha256), b'spam')
+
 
 class PackagePushTestCase(unittest.TestCase):
 
@@ -262,3 +370,64 @@ class PackagePushTestCase(unittest.TestCase):
         uid = pkg.push()
         self.assertEqual(pkg.uid, '42')
         self.assertEqual(uid, '42')
+
+    @patch('uhu.updatehub.aio.push_package', return_value='42')
+    def test_push_can_use_asyncio_engine(self, mock):
+        self.assertEqual(Package().push(engine='asyncio'), '42')
+        self.assertTrue(mock.called)
+
+    def test_asyncio_engine_is_not_imported_by_default(self):
+        code = ('import sys, uhu.cli, uhu.core.package; '
+                'sys.exit("uhu.updatehub.aio" in sys.modules)')
+        self.assertEqual(subprocess.call([sys.executable, '-c', code]), 0)
+
+
+class PushPackagesTestCase(PackageTestCase):
+
+    def create_package(self, version):
+        pkg = Package(version=version, product=self.product)
+        pkg.objects.create(self.obj_options)
+        return pkg
+
+    @patch('uhu.core.package.push_package')
+    def test_reads_shared_objects_once(self, push_package):
+        push_package.side_effect = ['uid-1', 'uid-2']
+        packages = [self.create_package(v) for v in ('1.0', '2.0')]
+        with patch('uhu.core.objects.Inspection.run', autospec=True,
+                   side_effect=Inspection.run) as run:
+            uids = push_packages(packages, package_jobs=1)
+        self.assertEqual(uids, ['uid-1', 'uid-2'])
+        self.assertEqual(
+            len([c for c in run.call_args_list if c[0][0]._consumers]), 1)
+        for call, pkg in zip(push_package.call_args_list, packages):
+            self.assertEqual(call[0][0]['version'], pkg.version)
+            self.assertEqual(
+                call[0][0]['objects'][0][0]['sha256sum'], self.obj_sha256)
+
+    @patch('uhu.core.package.push_package')
+    def test_returns_errors_of_failed_packages(self, push_package):
+        def push(metadata, *args):
+            if metadata['version'] == '1.0':
+                raise UpdateHubError('failed')
+            return 'uid-2'
+        push_package.side_effect = push
+        packages = [self.create_package(v) for v in ('1.0', '2.0')]
+        results = push_packages(packages, package_jobs=2)
+        self.assertIsInstance(results[0], UpdateHubError)
+        self.assertEqual(results[1], 'uid-2')
+        self.assertIsNone(packages[0].uid)
+        self.assertEqual(packages[1].uid, 'uid-2')
+
+    @patch('uhu.core.package.push_package')
+    def test_does_not_push_packages_which_can_not_be_loaded(
+            self, push_package):
+        push_package.return_value = 'uid-2'
+        packages = [self.create_package(v) for v in ('1.0', '2.0')]
+        packages[0].objects.create(dict(
+            self.obj_options, filename='/missing/file'))
+        results = push_packages(packages, package_jobs=2)
+        self.assertIsInstance(results[0], UpdateHubError)
+        self.assertIn('/missing/file', str(results[0]))
+        self.assertEqual(results[1], 'uid-2')
+        self.assertEqual(push_package.call_count, 1)
+        self.assertEqual(push_package.call_args[0][0]['version'], '2.0')
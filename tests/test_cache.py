@@ -0,0 +1,139 @@
+# Copyright (C) 2017 O.S. Systems Software LTDA.
+# SPDX-License-Identifier: GPL-2.0
+
+import os
+import time
+from unittest.mock import patch
+
+from uhu.cache import DigestCache, get_file_identity
+from uhu.utils import CACHE_FILE_VAR, CACHE_SIZE_VAR
+
+from utils import UHUTestCase, EnvironmentFixtureMixin, FileFixtureMixin
+
+
+class DigestCacheTestCase(
+        FileFixtureMixin, EnvironmentFixtureMixin, UHUTestCase):
+
+    def setUp(self):
+        self.cache_fn = self.create_file('')
+        self.set_env_var(CACHE_FILE_VAR, self.cache_fn)
+        self.cache = DigestCache()
+
+    def create_old_file(self, content):
+        fn = self.create_file(content)
+        past = time.time() - 60
+        os.utime(fn, (past, past))
+        return fn
+
+    def test_returns_empty_dict_when_file_is_not_cached(self):
+        fn = self.create_old_file('spam')
+        self.assertEqual(self.cache.get(fn), {})
+
+    def test_can_store_values(self):
+        fn = self.create_old_file('spam')
+        self.cache.update(fn, sha256sum='sha256', md5='md5')
+        self.assertEqual(self.cache.get(fn), {
+            'sha256sum': 'sha256',
+            'md5': 'md5',
+        })
+
+    def test_can_update_values(self):
+        fn = self.create_old_file('spam')
+        self.cache.update(fn, sha256sum='sha256')
+        self.cache.update(fn, md5='md5')
+        self.assertEqual(self.cache.get(fn), {
+            'sha256sum': 'sha256',
+            'md5': 'md5',
+        })
+
+    def test_cache_persists_between_instances(self):
+        fn = self.create_old_file('spam')
+        self.cache.update(fn, sha256sum='sha256')
+        self.cache.flush()
+        self.assertEqual(DigestCache().get(fn), {'sha256sum': 'sha256'})
+
+    def test_cache_file_is_written_only_when_flushed(self):
+        fn = self.create_old_file('spam')
+        with patch.object(DigestCache, '_write') as write:
+            self.cache.update(fn, sha256sum='sha256')
+            for _ in range(3):
+                self.cache.get(fn)
+            self.assertFalse(write.called)
+            self.cache.flush()
+            self.cache.flush()  # nothing changed since last flush
+        self.assertEqual(write.call_count, 1)
+
+    def test_flush_keeps_entries_stored_by_other_processes(self):
+        fn1, fn2 = self.create_old_file('spam'), self.create_old_file('eggs')
+        self.cache.update(fn1, sha256sum='1')
+        other = DigestCache()
+        other.update(fn2, sha256sum='2')
+        other.flush()
+        self.cache.flush()
+        cache = DigestCache()
+        self.assertEqual(cache.get(fn1), {'sha256sum': '1'})
+        self.assertEqual(cache.get(fn2), {'sha256sum': '2'})
+
+    def test_entry_is_invalidated_when_file_changes(self):
+        fn = self.create_old_file('spam')
+        self.cache.update(fn, sha256sum='sha256')
+        with open(fn, 'w') as fp:
+            fp.write('eggs and spam')
+        self.assertEqual(self.cache.get(fn), {})
+
+    def test_does_not_store_recently_modified_files(self):
+        fn = self.create_file('spam')
+        self.cache.update(fn, sha256sum='sha256')
+        self.assertEqual(self.cache.get(fn), {})
+
+    def test_symbolic_links_share_entries(self):
+        fn = self.create_old_file('spam')
+        link = fn + '-link'
+        os.symlink(fn, link)
+        self.addCleanup(os.remove, link)
+        self.cache.update(link, sha256sum='sha256')
+        self.assertEqual(self.cache.get(fn), {'sha256sum': 'sha256'})
+
+    def test_file_identity_changes_with_file_size(self):
+        fn = self.create_old_file('spam')
+        before, _ = get_file_identity(fn)
+        with open(fn, 'a') as fp:
+            fp.write('eggs')
+        after, _ = get_file_identity(fn)
+        self.assertNotEqual(before, after)
+
+    def test_evicts_least_recently_used_entries(self):
+        self.set_env_var(CACHE_SIZE_VAR, 2)
+        files = [self.create_old_file(str(i)) for i in range(3)]
+        self.cache.update(files[0], sha256sum='0')
+        self.cache.update(files[1], sha256sum='1')
+        self.cache.get(files[0])
+        self.cache.update(files[2], sha256sum='2')
+        self.cache.flush()
+        self.assertEqual(self.cache.get(files[0]), {'sha256sum': '0'})
+        self.assertEqual(self.cache.get(files[1]), {})
+        self.assertEqual(self.cache.get(files[2]), {'sha256sum': '2'})
+
+    def test_disabled_cache_does_not_read_nor_store_values(self):
+        fn = self.create_old_file('spam')
+        self.cache.update(fn, sha256sum='sha256')
+        self.cache.enabled = False
+        self.assertEqual(self.cache.get(fn), {})
+        self.cache.update(fn, sha256sum='other')
+        self.cache.enabled = True
+        self.assertEqual(self.cache.get(fn), {'sha256sum': 'sha256'})
+
+    def test_ignores_corrupted_cache_file(self):
+        fn = self.create_old_file('spam')
+        with open(self.cache_fn, 'w') as fp:
+            fp.write('{corrupted')
+        self.assertEqual(self.cache.get(fn), {})
+        self.cache.update(fn, sha256sum='sha256')
+        self.assertEqual(self.cache.get(fn), {'sha256sum': 'sha256'})
+
+    def test_can_clear_cache(self):
+        fn = self.create_old_file('spam')
+        self.cache.update(fn, sha256sum='sha256')
+        self.cache.clear()
+        self.assertFalse(os.path.exists(self.cache_fn))
+        self.assertEqual(self.cache.get(fn), {})
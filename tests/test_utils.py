@@ -7,7 +7,7 @@ import json
 import os
 import tempfile
 import unittest
-from unittest.mock import patch
+from unittest.mock import Mock, patch
 
 from Crypto.Hash import SHA256
 from Crypto.PublicKey import RSA
@@ -26,6 +26,13 @@ class UtilsTestCase(EnvironmentFixtureMixin, UHUTestCase):
         self.addCleanup(self.remove_env_var, utils.LOCAL_CONFIG_VAR)
         self.addCleanup(self.remove_env_var, utils.SERVER_URL_VAR)
         self.addCleanup(self.remove_env_var, utils.CUSTOM_CA_CERTS_VAR)
+        self.addCleanup(self.remove_env_var, utils.JOBS_VAR)
+        self.addCleanup(self.remove_env_var, utils.HTTP_POOL_SIZE_VAR)
+        self.addCleanup(self.remove_env_var, utils.UPLOAD_JOBS_VAR)
+        self.addCleanup(self.remove_env_var, utils.CACHE_SIZE_VAR)
+        self.addCleanup(self.remove_env_var, utils.CACHE_FILE_VAR)
+        self.addCleanup(self.remove_env_var, utils.RETRIES_VAR)
+        self.addCleanup(self.remove_env_var, utils.COMPRESS_METADATA_VAR)
 
     def test_get_chunk_size_by_environment_variable(self):
         os.environ[utils.CHUNK_SIZE_VAR] = '1'
@@ -73,6 +80,90 @@ class UtilsTestCase(EnvironmentFixtureMixin, UHUTestCase):
         observed = utils.get_custom_ca_certs_file()
         self.assertEqual(observed, None)
 
+    def test_get_jobs_by_environment_variable(self):
+        os.environ[utils.JOBS_VAR] = '3'
+        self.assertEqual(utils.get_jobs(), 3)
+
+    def test_get_default_jobs(self):
+        self.assertEqual(utils.get_jobs(), utils.DEFAULT_JOBS)
+
+    def test_get_jobs_is_at_least_one(self):
+        os.environ[utils.JOBS_VAR] = '0'
+        self.assertEqual(utils.get_jobs(), 1)
+
+    def test_cache_file_is_next_to_global_config_file(self):
+        self.remove_env_var(utils.CACHE_FILE_VAR)
+        os.environ[utils.GLOBAL_CONFIG_VAR] = '/tmp/uhu/config'
+        self.assertEqual(utils.get_cache_file(), '/tmp/uhu/.uhu-cache')
+        os.environ[utils.CACHE_FILE_VAR] = '/tmp/cache'
+        self.assertEqual(utils.get_cache_file(), '/tmp/cache')
+
+    def test_job_variables_fallback_to_default_when_invalid(self):
+        os.environ[utils.JOBS_VAR] = 'spam'
+        os.environ[utils.UPLOAD_JOBS_VAR] = '2.5'
+        os.environ[utils.HTTP_POOL_SIZE_VAR] = ''
+        os.environ[utils.RETRIES_VAR] = 'many'
+        self.assertEqual(utils.get_jobs(), utils.DEFAULT_JOBS)
+        self.assertEqual(utils.get_upload_jobs(), utils.DEFAULT_UPLOAD_JOBS)
+        self.assertEqual(
+            utils.get_http_pool_size(), utils.DEFAULT_HTTP_POOL_SIZE)
+        self.assertEqual(utils.get_retries(), utils.DEFAULT_RETRIES)
+
+    def test_get_compress_metadata_fallbacks_to_default_when_invalid(self):
+        os.environ[utils.COMPRESS_METADATA_VAR] = 'yes'
+        self.assertFalse(utils.get_compress_metadata())
+        os.environ[utils.COMPRESS_METADATA_VAR] = '1'
+        self.assertTrue(utils.get_compress_metadata())
+
+    def test_get_cache_size_fallbacks_to_default_when_invalid(self):
+        os.environ[utils.CACHE_SIZE_VAR] = 'spam'
+        self.assertEqual(utils.get_cache_size(), utils.DEFAULT_CACHE_SIZE)
+
+    def test_get_http_pool_size_by_environment_variable(self):
+        self.assertEqual(
+            utils.get_http_pool_size(), utils.DEFAULT_HTTP_POOL_SIZE)
+        os.environ[utils.HTTP_POOL_SIZE_VAR] = '3'
+        self.assertEqual(utils.get_http_pool_size(), 3)
+
+    def test_get_upload_jobs_by_environment_variable(self):
+        self.assertEqual(utils.get_upload_jobs(), utils.DEFAULT_UPLOAD_JOBS)
+        os.environ[utils.UPLOAD_JOBS_VAR] = '2'
+        self.assertEqual(utils.get_upload_jobs(), 2)
+        os.environ[utils.UPLOAD_JOBS_VAR] = '0'
+        self.assertEqual(utils.get_upload_jobs(), 1)
+
+
+class ParallelMapTestCase(unittest.TestCase):
+
+    def test_returns_results_in_order(self):
+        items = list(range(20))
+        for jobs in [1, 4]:
+            observed = utils.parallel_map(lambda x: x * 2, items, jobs)
+            self.assertEqual(observed, [x * 2 for x in items])
+
+    def test_can_map_empty_iterable(self):
+        self.assertEqual(utils.parallel_map(str, [], 4), [])
+
+    def test_raises_worker_errors(self):
+        with self.assertRaises(ZeroDivisionError):
+            utils.parallel_map(lambda x: 1 / x, [1, 0], 2)
+
+
+class MemoizeTestCase(unittest.TestCase):
+
+    def test_calls_function_once_per_key(self):
+        memo = {}
+        func = Mock(return_value=42)
+        self.assertEqual(utils.memoize(memo, 'key', func, 1), 42)
+        self.assertEqual(utils.memoize(memo, 'key', func, 1), 42)
+        func.assert_called_once_with(1)
+
+    def test_always_calls_function_without_memo(self):
+        func = Mock(return_value=42)
+        utils.memoize(None, 'key', func)
+        utils.memoize(None, 'key', func)
+        self.assertEqual(func.call_count, 2)
+
 
 class StringUtilsTestCase(unittest.TestCase):
 
@@ -144,3 +235,32 @@ class SignDictTestCase(unittest.TestCase):
         self.addCleanup(os.remove, fn)
         with self.assertRaises(ValueError):
             utils.sign_dict({}, fn)
+
+
+class VerifyBytesTestCase(unittest.TestCase):
+
+    def create_key(self, key, public=False):
+        _, fn = tempfile.mkstemp()
+        self.addCleanup(os.remove, fn)
+        with open(fn, 'wb') as fp:
+            fp.write((key.publickey() if public else key).exportKey())
+        return fn
+
+    def test_can_verify_signature(self):
+        key = RSA.generate(1024)
+        signature = utils.sign_bytes(b'spam', self.create_key(key))
+        for public in (True, False):
+            fn = self.create_key(key, public)
+            self.assertTrue(utils.verify_bytes(b'spam', signature, fn))
+            self.assertFalse(utils.verify_bytes(b'eggs', signature, fn))
+            self.assertFalse(utils.verify_bytes(b'spam', 'not base64', fn))
+
+    def test_does_not_verify_signature_of_other_key(self):
+        signature = utils.sign_bytes(
+            b'spam', self.create_key(RSA.generate(1024)))
+        fn = self.create_key(RSA.generate(1024), public=True)
+        self.assertFalse(utils.verify_bytes(b'spam', signature, fn))
+
+    def test_raises_error_if_invalid_key_file(self):
+        with self.assertRaises(ValueError):
+            utils.verify_bytes(b'spam', '', __file__)
@@ -0,0 +1,131 @@
+# Copyright (C) 2017 O.S. Systems Software LTDA.
+# SPDX-License-Identifier: GPL-2.0
+
+import json
+import os
+import threading
+import unittest
+from unittest.mock import Mock, patch
+
+from uhu.updatehub import aio, api
+from uhu.updatehub.api import set_stored, UpdateHubError
+from uhu.utils import (
+    ACCESS_ID_VAR, ACCESS_SECRET_VAR, CHUNK_SIZE_VAR, SERVER_URL_VAR)
+
+from utils import (
+    EnvironmentFixtureMixin, FileFixtureMixin, ServerFixtureMixin,
+    UHUTestCase)
+
+
+class ReaderStreamTestCase(
+        EnvironmentFixtureMixin, FileFixtureMixin, UHUTestCase):
+
+    def test_reads_object_as_file(self):
+        self.set_env_var(CHUNK_SIZE_VAR, 1024)
+        content = os.urandom(4096 + 10)
+        callback = Mock()
+        reader = aio.ObjectReader(self.create_file(content), callback)
+        with aio.ReaderStream(reader) as stream:
+            self.assertEqual(stream.read(100), content[:100])
+            self.assertEqual(stream.read(), content[100:])
+            self.assertEqual(stream.read(100), b'')
+        self.assertEqual(callback.object_read.call_count, 5)
+
+
+@unittest.skipIf(aio.aiohttp is None, 'aiohttp is not installed')
+class AsyncioPushTestCase(EnvironmentFixtureMixin, FileFixtureMixin,
+                          ServerFixtureMixin, UHUTestCase):
+
+    def setUp(self):
+        self.set_env_var(CHUNK_SIZE_VAR, 1024)
+        self.set_env_var(ACCESS_ID_VAR, 'access')
+        self.set_env_var(ACCESS_SECRET_VAR, 'secret')
+        self.server = self.start_server()
+        self.set_env_var(SERVER_URL_VAR, self.server.url())
+        patcher = patch('uhu.updatehub.aio.prepare_metadata',
+                        return_value=(b'{"metadata": 1}', {}))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.objects = []
+        for i in range(3):
+            content = os.urandom(4096 + i)
+            fn = self.create_file(content)
+            os.utime(fn, (0, 0))  # files modified right now are never cached
+            self.objects.append({
+                'filename': fn,
+                'sha256sum': 'sha{}'.format(i),
+                'md5': 'md5{}'.format(i),
+                'chunks': (len(content) + 1023) // 1024,
+                'content': content,
+            })
+
+    def test_pushes_package(self):
+        self.server.barrier = threading.Barrier(2, timeout=5)
+        callback = Mock()
+        uid = aio.push_package({}, self.objects[:2], callback, jobs=2)
+        self.assertEqual(uid, 'pkg')
+        self.assertEqual(
+            json.loads(self.server.metadata.decode()), {'metadata': 1})
+        for obj in self.objects[:2]:
+            self.assertEqual(
+                self.server.objects[obj['sha256sum']], obj['content'])
+        self.assertEqual(self.server.max_in_flight, 2)
+        self.assertEqual(self.server.finished, ['/packages/pkg/finish'])
+        self.assertTrue(all(self.server.signed))
+        self.assertEqual(callback.object_read.call_count, 4 + 5)
+        callback.push_finish.assert_called_once_with('pkg')
+
+    def test_uploads_objects_with_loop(self):
+        self.server.storage = 'swift'
+        self.server.barrier = threading.Barrier(2, timeout=5)
+        with patch('uhu.updatehub.aio.upload_to_storage') as upload:
+            aio.push_package({}, self.objects[:2], jobs=2)
+        self.assertFalse(upload.called)
+        self.assertEqual(self.server.max_in_flight, 2)
+        for obj in self.objects[:2]:
+            self.assertEqual(
+                self.server.objects[obj['sha256sum']], obj['content'])
+
+    def test_resumable_uploads_are_sent_by_default_engine(self):
+        with patch('uhu.updatehub.api.put_object',
+                   wraps=api.put_object) as put:
+            aio.push_package({}, self.objects[:2], jobs=2)
+        self.assertEqual(put.call_count, 2)
+        for args in put.call_args_list:
+            self.assertTrue(args[1]['resumable'])
+        for obj in self.objects[:2]:
+            self.assertEqual(
+                self.server.objects[obj['sha256sum']], obj['content'])
+
+    @patch('uhu.updatehub.http.time.sleep')
+    def test_resumes_dropped_uploads(self, _):
+        self.server.drops = 1
+        self.server.drop_after = 1024
+        aio.push_package({}, self.objects[:1])
+        self.assertEqual(self.server.starts, [0, 1024])
+        self.assertEqual(
+            self.server.objects['sha0'], self.objects[0]['content'])
+
+    def test_does_not_upload_existing_objects(self):
+        self.server.objects['sha0'] = b'already there'
+        aio.push_package({}, self.objects[:2], jobs=1)
+        self.assertEqual(self.server.objects['sha0'], b'already there')
+        self.assertEqual(self.server.checked, ['sha0', 'sha1'])
+        self.assertEqual(self.server.max_in_flight, 1)
+
+    def test_does_not_check_stored_objects(self):
+        set_stored(self.objects[0])
+        aio.push_package({}, self.objects[:2])
+        self.assertEqual(self.server.checked, ['sha1'])
+
+    def test_raises_error_when_finish_fails(self):
+        self.server.finish_status = 400
+        callback = Mock()
+        with self.assertRaises(UpdateHubError):
+            aio.push_package({}, self.objects[:1], callback)
+        callback.push_finish.assert_called_once_with('pkg')
+
+    @patch('uhu.updatehub.aio.aiohttp', None)
+    def test_raises_error_without_aiohttp(self):
+        with self.assertRaises(UpdateHubError):
+            aio.push_package({}, self.objects)
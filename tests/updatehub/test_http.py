@@ -11,10 +11,13 @@ import requests
 
 from uhu import utils
 from uhu.updatehub._request import Request
+from uhu.updatehub._session import close_session, get_session
 from uhu.updatehub.http import (
     format_server_error, HTTPError, request, UNKNOWN_ERROR, get, post, put)
 from uhu.updatehub.auth import UHV1Signature
 
+from utils import ServerFixtureMixin
+
 
 def set_credentials():
     os.environ[utils.ACCESS_ID_VAR] = 'access'
@@ -38,7 +41,7 @@ class RequestTestCase(unittest.TestCase):
         put(url)
         mock.assert_called_with('PUT', url)
 
-    @patch('uhu.updatehub.http.requests.request')
+    @patch('uhu.updatehub._session.requests.Session.request')
     @patch('uhu.updatehub.http.get_custom_ca_certs_file',
            return_value=FAKE_CA_CERTS)
     def test_can_use_custom_ca_certs_in_requests(self, ca_cert_mock, mock):
@@ -111,14 +114,14 @@ class RequestTestCase(unittest.TestCase):
         for header in headers:
             self.assertEqual(str(headers[header]), prepared_headers[header])
 
-    @patch('uhu.updatehub._request.requests.request')
+    @patch('uhu.updatehub._session.requests.Session.request')
     def test_send_request(self, request):
         Request('localhost', 'GET').send()
         args, kwargs = request.call_args
         self.assertEqual(args, ('GET', 'localhost'))
         self.assertEqual(kwargs.get('timeout'), 30)
 
-    @patch('uhu.updatehub._request.requests.request')
+    @patch('uhu.updatehub._session.requests.Session.request')
     def test_request_is_signed(self, request):
         Request('/signed', 'GET').send()
         headers = request.call_args[1]['headers']
@@ -136,7 +139,7 @@ class RequestTestCase(unittest.TestCase):
         observed = req.headers.get('Host')
         self.assertEqual(observed, expected)
 
-    @patch('uhu.updatehub._request.requests.request')
+    @patch('uhu.updatehub._session.requests.Session.request')
     def test_can_pass_extra_kwargs_to_requests(self, mock):
         Request('http://localhost', 'GET', stream=True).send()
         observed = list(mock.call_args)[1].get('stream')
@@ -225,7 +228,7 @@ class SignedRequestTestCase(unittest.TestCase):
         header = request.headers.get('Authorization', None)
         self.assertIsNotNone(header)
 
-    @patch('uhu.updatehub._request.requests.request')
+    @patch('uhu.updatehub._session.requests.Session.request')
     def test_signatured_is_calculated_with_right_headers(self, mock):
         request = Request('localhost', 'POST')
         self.assertIsNone(request.headers.get('Authorization', None))
@@ -301,7 +304,7 @@ class RequestErrorsTestCase(unittest.TestCase):
     def setUp(self):
         set_credentials()
 
-    @patch('uhu.updatehub.http.requests.request')
+    @patch('uhu.updatehub._session.requests.Session.request')
     def test_returns_response_if_no_error_is_present(self, mock):
         mock.return_value.ok = True
         mock.return_value.status_code = 200
@@ -309,7 +312,7 @@ class RequestErrorsTestCase(unittest.TestCase):
         self.assertEqual(response.status_code, 200)
         self.assertTrue(response.ok)
 
-    @patch('uhu.updatehub.http.requests.request')
+    @patch('uhu.updatehub._session.requests.Session.request')
     def test_raises_error_when_invalid_url(self, mock):
         exceptions = [
             requests.exceptions.MissingSchema,
@@ -322,7 +325,7 @@ class RequestErrorsTestCase(unittest.TestCase):
             with self.assertRaises(HTTPError):
                 request('GET', 'foo')
 
-    @patch('uhu.updatehub.http.requests.request')
+    @patch('uhu.updatehub._session.requests.Session.request')
     def test_raises_error_when_server_is_unavailable(self, mock):
         exceptions = [requests.ConnectionError, requests.ConnectTimeout]
         mock.side_effect = exceptions
@@ -330,7 +333,7 @@ class RequestErrorsTestCase(unittest.TestCase):
             with self.assertRaises(HTTPError):
                 request('GET', 'foo')
 
-    @patch('uhu.updatehub.http.requests.request')
+    @patch('uhu.updatehub._session.requests.Session.request')
     def test_raises_error_with_any_other_requests_exception(self, mock):
         exceptions = [
             requests.exceptions.HTTPError,
@@ -357,13 +360,13 @@ class RequestErrorsTestCase(unittest.TestCase):
             with self.assertRaises(HTTPError):
                 request('GET', 'foo')
 
-    @patch('uhu.updatehub.http.requests.request')
+    @patch('uhu.updatehub._session.requests.Session.request')
     def test_raises_error_when_unathorized(self, mock):
         mock.return_value.status_code = 401
         with self.assertRaises(HTTPError):
             request('GET', 'foo')
 
-    @patch('uhu.updatehub.http.requests.request')
+    @patch('uhu.updatehub._session.requests.Session.request')
     def test_raises_error_if_response_is_not_ok(self, mock):
         mock.return_value.ok = False
         with self.assertRaises(HTTPError):
@@ -374,3 +377,32 @@ class RequestErrorsTestCase(unittest.TestCase):
         del os.environ[utils.ACCESS_SECRET_VAR]
         with self.assertRaises(HTTPError):
             request('GET', 'foo')
+
+
+class SessionTestCase(ServerFixtureMixin, unittest.TestCase):
+
+    def setUp(self):
+        set_credentials()
+        close_session()
+        self.addCleanup(close_session)
+        self.addCleanup(os.environ.pop, utils.HTTP_POOL_SIZE_VAR, None)
+
+    def test_session_is_shared(self):
+        session = get_session()
+        self.assertIs(get_session(), session)
+        close_session()
+        self.assertIsNot(get_session(), session)
+
+    def test_session_pool_size_by_environment_variable(self):
+        os.environ[utils.HTTP_POOL_SIZE_VAR] = '3'
+        adapter = get_session().get_adapter('https://localhost')
+        self.assertEqual(adapter._pool_maxsize, 3)
+        self.assertTrue(adapter._pool_block)
+
+    def test_connection_is_reused_between_requests(self):
+        server = self.start_server()
+        url = server.url('/')
+        for _ in range(5):
+            get(url)
+            get(url, sign=False)
+        self.assertEqual(server.connections, 1)
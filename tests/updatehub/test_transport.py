@@ -0,0 +1,105 @@
+# Copyright (C) 2017 O.S. Systems Software LTDA.
+# SPDX-License-Identifier: GPL-2.0
+
+import os
+import socket
+from unittest.mock import Mock, patch
+
+from uhu.updatehub import _transport
+from uhu.updatehub.api import ObjectReader, PartReader
+from uhu.updatehub.http import put, HTTPError, TransientHTTPError
+from uhu.utils import CHUNK_SIZE_VAR
+
+from utils import (
+    EnvironmentFixtureMixin, FileFixtureMixin, ServerFixtureMixin,
+    UHUTestCase)
+
+
+class TransportTestCase(EnvironmentFixtureMixin, FileFixtureMixin,
+                        ServerFixtureMixin, UHUTestCase):
+
+    def setUp(self):
+        self.addCleanup(self.remove_env_var, CHUNK_SIZE_VAR)
+        os.environ[CHUNK_SIZE_VAR] = str(128 * 1024)
+        self.content = os.urandom(_transport.SENDFILE_MIN_SIZE + 1024)
+        self.fn = self.create_file(self.content)
+
+    @staticmethod
+    def get_url(server):
+        return server.url('/storage/object?sig=1')
+
+    def test_accepts_only_large_readers(self):
+        url = 'http://localhost/object'
+        self.assertTrue(_transport.accepts(url, ObjectReader(self.fn)))
+        small = self.create_file(b'small')
+        self.assertFalse(_transport.accepts(url, ObjectReader(small)))
+        self.assertFalse(_transport.accepts(url, self.content))
+        self.assertFalse(_transport.accepts(url, None))
+
+    def test_leaves_tls_requests_to_session(self):
+        reader = ObjectReader(self.fn)
+        self.assertFalse(
+            _transport.accepts('https://storage/object', reader))
+
+    @patch('uhu.updatehub._transport.SENDFILE_SUPPORTED', False)
+    def test_does_not_accept_requests_without_sendfile(self):
+        reader = ObjectReader(self.fn)
+        self.assertFalse(
+            _transport.accepts('http://storage/object', reader))
+
+    def test_does_not_accept_requests_through_proxies(self):
+        self.addCleanup(self.remove_env_var, 'http_proxy')
+        os.environ['http_proxy'] = 'http://proxy:3128'
+        reader = ObjectReader(self.fn)
+        self.assertFalse(
+            _transport.accepts('http://storage/object', reader))
+
+    def test_sends_object_with_sendfile(self):
+        server = self.start_server()
+        callback = Mock()
+        reader = ObjectReader(self.fn, callback)
+        with patch.object(
+                socket.socket, 'sendfile', autospec=True,
+                side_effect=socket.socket.sendfile) as sendfile:
+            response = put(self.get_url(server), data=reader, sign=False)
+        self.assertTrue(sendfile.called)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.headers['etag'], '"etag"')
+        self.assertEqual(server.objects['object'], self.content)
+        self.assertEqual(server.paths, ['/storage/object?sig=1'])
+        self.assertEqual(callback.object_read.call_count, 9)
+
+    def test_sends_object_from_offset(self):
+        server = self.start_server()
+        reader = ObjectReader(self.fn, offset=1024)
+        put(self.get_url(server), data=reader, sign=False)
+        self.assertEqual(server.objects['object'], self.content[1024:])
+
+    def test_sends_part(self):
+        server = self.start_server()
+        fd = os.open(self.fn, os.O_RDONLY)
+        self.addCleanup(os.close, fd)
+        size = _transport.SENDFILE_MIN_SIZE
+        put(self.get_url(server), data=PartReader(fd, 512, size),
+            sign=False)
+        self.assertEqual(
+            server.objects['object'], self.content[512:512 + size])
+
+    def test_raises_transient_error_on_server_errors(self):
+        server = self.start_server(storage_status=503)
+        with self.assertRaises(TransientHTTPError):
+            put(self.get_url(server), data=ObjectReader(self.fn), sign=False)
+
+    def test_raises_error_on_client_errors(self):
+        server = self.start_server(storage_status=403)
+        with self.assertRaises(HTTPError) as context:
+            put(self.get_url(server), data=ObjectReader(self.fn), sign=False)
+        self.assertNotIsInstance(context.exception, TransientHTTPError)
+
+    def test_raises_transient_error_when_server_is_not_available(self):
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        url = 'http://127.0.0.1:{}/'.format(sock.getsockname()[1])
+        sock.close()
+        with self.assertRaises(TransientHTTPError):
+            put(url, data=ObjectReader(self.fn), sign=False)
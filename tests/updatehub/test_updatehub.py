@@ -1,13 +1,31 @@
 # Copyright (C) 2017 O.S. Systems Software LTDA.
 # SPDX-License-Identifier: GPL-2.0
 
+import base64
+import json
+import os
+import threading
 import unittest
-from unittest.mock import patch
+from unittest.mock import Mock, patch
 
+from Crypto.Hash import SHA256
+from Crypto.PublicKey import RSA
+from Crypto.Signature import PKCS1_v1_5
+
+from uhu.cache import cache, DigestCache
+from uhu.ui import BaseCallback
 from uhu.updatehub.api import (
     finish_package, ObjectUploadResult, push_package, get_package_status,
+    is_stored, put_object, s3_object_upload, set_stored, swift_object_upload,
     upload_metadata, upload_object, upload_objects, UpdateHubError)
-from uhu.updatehub.http import HTTPError
+from uhu.updatehub.http import HTTPError, TransientHTTPError
+from uhu.utils import (
+    ACCESS_ID_VAR, ACCESS_SECRET_VAR, CHUNK_SIZE_VAR, COMPRESS_METADATA_VAR,
+    RETRIES_VAR, SERVER_URL_VAR)
+
+from utils import (
+    EnvironmentFixtureMixin, FileFixtureMixin, ServerFixtureMixin,
+    UHUTestCase)
 
 
 class PushPackageTestCase(unittest.TestCase):
@@ -23,7 +41,7 @@ class PushPackageTestCase(unittest.TestCase):
 class UploadMetadataTestCase(unittest.TestCase):
 
     @patch('uhu.updatehub.api.config.get_private_key_path', return_value='fn')
-    @patch('uhu.updatehub.api.sign_dict', return_value='signature')
+    @patch('uhu.updatehub.api.sign_bytes', return_value='signature')
     @patch('uhu.updatehub.api.validate_metadata')
     @patch('uhu.updatehub.api.http.post')
     def test_returns_package_uid_when_successful(self, http, mock, sign, conf):
@@ -33,7 +51,7 @@ class UploadMetadataTestCase(unittest.TestCase):
         self.assertEqual(uid, '1234')
 
     @patch('uhu.updatehub.api.config.get_private_key_path', return_value='fn')
-    @patch('uhu.updatehub.api.sign_dict', return_value='signature')
+    @patch('uhu.updatehub.api.sign_bytes', return_value='signature')
     @patch('uhu.updatehub.api.validate_metadata')
     @patch('uhu.updatehub.api.http.post')
     def test_sends_header_with_package_signature(self, http, mock, sign, conf):
@@ -48,7 +66,7 @@ class UploadMetadataTestCase(unittest.TestCase):
             upload_metadata({})
 
     @patch('uhu.updatehub.api.config.get_private_key_path', return_value='fn')
-    @patch('uhu.updatehub.api.sign_dict', return_value='signature')
+    @patch('uhu.updatehub.api.sign_bytes', return_value='signature')
     @patch('uhu.updatehub.api.validate_metadata')
     @patch('uhu.updatehub.api.http.post', side_effect=HTTPError)
     def test_raises_error_if_invalid_request(self, http, mock, sign, conf):
@@ -56,6 +74,57 @@ class UploadMetadataTestCase(unittest.TestCase):
             upload_metadata({})
 
 
+class MetadataPayloadTestCase(EnvironmentFixtureMixin, FileFixtureMixin,
+                              ServerFixtureMixin, UHUTestCase):
+
+    def setUp(self):
+        self.key = RSA.generate(1024)
+        key_fn = self.create_file(self.key.exportKey())
+        patcher = patch('uhu.updatehub.api.config.get_private_key_path',
+                        return_value=key_fn)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = patch('uhu.updatehub.api.validate_metadata')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.server = self.start_server(package_uid='1234')
+        self.set_env_var(SERVER_URL_VAR, self.server.url())
+        self.set_env_var(ACCESS_ID_VAR, 'access')
+        self.set_env_var(ACCESS_SECRET_VAR, 'secret')
+        self.metadata = {'version': '2.0', 'objects': [[{'size': 1}]]}
+
+    def assertPayloadIsSigned(self):  # pylint: disable=invalid-name
+        self.assertEqual(
+            self.server.metadata, json.dumps(
+                self.metadata, sort_keys=True).encode())
+        signature = base64.b64decode(self.server.headers['UH-SIGNATURE'])
+        verifier = PKCS1_v1_5.new(self.key)
+        self.assertTrue(
+            verifier.verify(SHA256.new(self.server.metadata), signature))
+
+    def test_sends_canonical_payload(self):
+        self.assertEqual(upload_metadata(self.metadata), '1234')
+        self.assertIsNone(self.server.headers.get('Content-Encoding'))
+        self.assertPayloadIsSigned()
+        self.assertEqual(self.server.headers['Content-sha256'],
+                         self.server.body_sha256)
+
+    def test_can_send_gzip_encoded_payload(self):
+        self.set_env_var(COMPRESS_METADATA_VAR, 1)
+        self.assertEqual(upload_metadata(self.metadata), '1234')
+        self.assertEqual(self.server.headers['Content-Encoding'], 'gzip')
+        self.assertPayloadIsSigned()
+        self.assertEqual(self.server.headers['Content-sha256'],
+                         self.server.body_sha256)
+
+    def test_sends_signed_payload_as_it_is(self):
+        payload = json.dumps(self.metadata, indent=4).encode()
+        self.assertEqual(
+            upload_metadata(payload, signature='signature'), '1234')
+        self.assertEqual(self.server.metadata, payload)
+        self.assertEqual(self.server.headers['UH-SIGNATURE'], 'signature')
+
+
 class UploadObjectTestCase(unittest.TestCase):
 
     def setUp(self):
@@ -102,6 +171,359 @@ class UploadObjectTestCase(unittest.TestCase):
         self.assertEqual(result, ObjectUploadResult.FAIL)
 
 
+class UploadObjectRetryTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.obj = {
+            'filename': __file__,
+            'sha256sum': 'sha1234',
+            'md5': 'md51234',
+            'chunks': 10,
+        }
+        patcher = patch('uhu.updatehub.http.time.sleep')
+        self.sleep = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    @patch('uhu.updatehub.api.http.post')
+    def test_retries_existence_check_on_transient_errors(self, post):
+        response = Mock(status_code=200)
+        post.side_effect = [TransientHTTPError, TransientHTTPError, response]
+        result = upload_object(self.obj, '1234')
+        self.assertEqual(result, ObjectUploadResult.EXISTS)
+        self.assertEqual(post.call_count, 3)
+        self.assertEqual(self.sleep.call_count, 2)
+
+    @patch('uhu.updatehub.api.http.post')
+    @patch('uhu.updatehub.api.http.put')
+    def test_retries_upload_from_scratch_when_not_resumable(self, put, post):
+        post.return_value.status_code = 201
+        post.return_value.json.return_value = {
+            'storage': 's3',
+            'url': 'http://someplace',
+        }
+        put.side_effect = [TransientHTTPError, Mock()]
+        result = upload_object(self.obj, '1234')
+        self.assertEqual(result, ObjectUploadResult.SUCCESS)
+        self.assertEqual(put.call_count, 2)
+        for call in put.call_args_list:
+            self.assertEqual(call[1]['headers'], {})
+
+
+class ResumableUploadTestCase(EnvironmentFixtureMixin, FileFixtureMixin,
+                              ServerFixtureMixin, UHUTestCase):
+
+    def setUp(self):
+        self.addCleanup(self.remove_env_var, CHUNK_SIZE_VAR)
+        self.addCleanup(self.remove_env_var, RETRIES_VAR)
+        os.environ[CHUNK_SIZE_VAR] = '1024'
+        self.content = os.urandom(100 * 1024)
+        self.fn = self.create_file(self.content)
+        # Files modified right now are never cached
+        os.utime(self.fn, (0, 0))
+        patcher = patch('uhu.updatehub.http.time.sleep')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.server = self.start_server()
+        self.url = self.server.url('/storage/object')
+
+    def start_server(self, **attrs):
+        return super().start_server(drop_after=30 * 1024, **attrs)
+
+    def test_resumes_upload_from_confirmed_offset(self):
+        self.server.drops = 2
+        result = put_object(self.fn, self.url, resumable=True)
+        self.assertEqual(result, ObjectUploadResult.SUCCESS)
+        self.assertEqual(self.server.objects['object'], self.content)
+        self.assertEqual(self.server.starts, [0, 30 * 1024, 60 * 1024])
+
+    def test_upload_starts_over_when_not_resumable(self):
+        self.server.drops = 1
+        result = put_object(self.fn, self.url)
+        self.assertEqual(result, ObjectUploadResult.SUCCESS)
+        self.assertEqual(self.server.objects['object'], self.content)
+        self.assertEqual(self.server.starts, [0, 0])
+
+    def test_fails_when_retries_are_exhausted(self):
+        os.environ[RETRIES_VAR] = '1'
+        self.server.drops = 2
+        result = put_object(self.fn, self.url, resumable=True)
+        self.assertEqual(result, ObjectUploadResult.FAIL)
+        self.assertEqual(cache.get(self.fn).get('upload'), self.url)
+
+    def test_resumes_upload_interrupted_by_previous_process(self):
+        os.environ[RETRIES_VAR] = '0'
+        self.server.drops = 1
+        result = put_object(self.fn, self.url, resumable=True)
+        self.assertEqual(result, ObjectUploadResult.FAIL)
+
+        # New process, state comes from cache file
+        new_cache = DigestCache()
+        with patch('uhu.updatehub.api.cache', new_cache):
+            result = put_object(self.fn, self.url, resumable=True)
+        self.assertEqual(result, ObjectUploadResult.SUCCESS)
+        self.assertEqual(self.server.objects['object'], self.content)
+        self.assertEqual(self.server.starts, [0, 30 * 1024])
+        self.assertIsNone(new_cache.get(self.fn)['upload'])
+
+    def test_progress_counts_each_chunk_once(self):
+        self.server.drops = 2
+        callback = Mock()
+        put_object(self.fn, self.url, callback, resumable=True)
+        self.assertEqual(callback.object_read.call_count, 100)
+
+    def test_can_upload_part_of_file(self):
+        self.server.drops = 1
+        callback = Mock()
+        result = put_object(self.fn, self.url, callback, resumable=True,
+                            start=1024, size=50 * 1024)
+        self.assertEqual(result, ObjectUploadResult.SUCCESS)
+        self.assertEqual(
+            self.server.objects['object'], self.content[1024:51 * 1024])
+        self.assertEqual(self.server.starts, [0, 30 * 1024])
+        self.assertEqual(callback.object_read.call_count, 50)
+
+    def test_each_part_of_file_resumes_its_own_upload(self):
+        os.environ[RETRIES_VAR] = '0'
+        self.server.drops = 1
+        url = self.url + '/0'
+        result = put_object(self.fn, url, resumable=True, start=0,
+                            size=50 * 1024)
+        self.assertEqual(result, ObjectUploadResult.FAIL)
+        other = self.start_server()
+        other_url = other.url('/storage/object/1')
+        result = put_object(self.fn, other_url, resumable=True,
+                            start=50 * 1024, size=50 * 1024)
+        self.assertEqual(result, ObjectUploadResult.SUCCESS)
+        self.assertEqual(other.objects['object/1'], self.content[50 * 1024:])
+
+        # New process, state comes from cache file
+        new_cache = DigestCache()
+        with patch('uhu.updatehub.api.cache', new_cache):
+            result = put_object(self.fn, url, resumable=True, start=0,
+                                size=50 * 1024)
+        self.assertEqual(result, ObjectUploadResult.SUCCESS)
+        self.assertEqual(
+            self.server.objects['object/0'], self.content[:50 * 1024])
+        self.assertEqual(self.server.starts, [0, 30 * 1024])
+
+
+class MultipartUploadTestCase(
+        EnvironmentFixtureMixin, FileFixtureMixin, UHUTestCase):
+
+    def setUp(self):
+        self.addCleanup(self.remove_env_var, CHUNK_SIZE_VAR)
+        os.environ[CHUNK_SIZE_VAR] = '1024'
+        self.content = os.urandom(10 * 1024 + 512)
+        self.fn = self.create_file(self.content)
+        self.parts = ['http://storage/v1/account/bucket/obj/{}'.format(i)
+                      for i in range(3)]
+        self.uploaded = {}
+        self.barrier = threading.Barrier(3, timeout=5)
+
+    def put(self, url, data, sign):
+        self.assertFalse(sign)
+        if not isinstance(data, bytes):
+            data = b''.join(data)
+        self.uploaded[url] = data
+        if url in self.parts:
+            self.barrier.wait()  # breaks unless parts are sent at once
+        return Mock(headers={'ETag': '"etag{}"'.format(url[-1])})
+
+    @patch('uhu.updatehub.api.http.post')
+    @patch('uhu.updatehub.api.http.put')
+    def test_s3_uploads_parts_in_parallel(self, put, post):
+        put.side_effect = self.put
+        post.return_value = Mock(text='<CompleteMultipartUploadResult/>')
+        result = s3_object_upload(
+            self.fn, 'http://storage/complete', parts=self.parts,
+            part_size=4 * 1024)
+        self.assertEqual(result, ObjectUploadResult.SUCCESS)
+        content = b''.join(self.uploaded[url] for url in self.parts)
+        self.assertEqual(content, self.content)
+        self.assertEqual(len(self.uploaded[self.parts[2]]), 2560)
+        body = post.call_args[1]['data'].decode()
+        self.assertEqual(body, (
+            '<CompleteMultipartUpload>'
+            '<Part><PartNumber>1</PartNumber><ETag>"etag0"</ETag></Part>'
+            '<Part><PartNumber>2</PartNumber><ETag>"etag1"</ETag></Part>'
+            '<Part><PartNumber>3</PartNumber><ETag>"etag2"</ETag></Part>'
+            '</CompleteMultipartUpload>'))
+
+    @patch('uhu.updatehub.api.http.put')
+    def test_swift_commits_manifest(self, put):
+        put.side_effect = self.put
+        result = swift_object_upload(
+            self.fn, 'http://storage/v1/account/bucket/obj?sig=1',
+            parts=self.parts, part_size=4 * 1024)
+        self.assertEqual(result, ObjectUploadResult.SUCCESS)
+        manifest = self.uploaded[
+            'http://storage/v1/account/bucket/obj?sig=1'
+            '&multipart-manifest=put']
+        self.assertEqual(json.loads(manifest.decode()), [{
+            'path': '/bucket/obj/{}'.format(i),
+            'etag': 'etag{}'.format(i),
+            'size_bytes': size,
+        } for i, size in enumerate([4096, 4096, 2560])])
+
+    @patch('uhu.updatehub.api.http.post')
+    @patch('uhu.updatehub.api.http.put')
+    def test_progress_counts_each_chunk_once(self, put, post):
+        put.side_effect = self.put
+        post.return_value = Mock(text='')
+        callback = Mock()
+        s3_object_upload(self.fn, 'http://storage/complete', callback,
+                         parts=self.parts, part_size=4 * 1024)
+        self.assertEqual(callback.object_read.call_count, 11)
+
+    @patch('uhu.updatehub.api.http.post')
+    @patch('uhu.updatehub.api.http.put', side_effect=HTTPError)
+    def test_returns_FAIL_when_part_upload_fails(self, put, post):
+        result = s3_object_upload(
+            self.fn, 'http://storage/complete', parts=self.parts,
+            part_size=4 * 1024)
+        self.assertEqual(result, ObjectUploadResult.FAIL)
+        self.assertFalse(post.called)
+
+    @patch('uhu.updatehub.api.http.put')
+    def test_returns_FAIL_when_parts_do_not_match_object(self, put):
+        result = s3_object_upload(
+            self.fn, 'http://storage/complete', parts=self.parts,
+            part_size=1024)
+        self.assertEqual(result, ObjectUploadResult.FAIL)
+        self.assertFalse(put.called)
+
+    @patch('uhu.updatehub.api.http.post')
+    @patch('uhu.updatehub.api.http.put')
+    def test_can_upload_part_of_file_in_parts(self, put, post):
+        put.side_effect = self.put
+        post.return_value = Mock(text='')
+        result = s3_object_upload(
+            self.fn, 'http://storage/complete', parts=self.parts,
+            part_size=3 * 1024, start=1024, size=9 * 1024)
+        self.assertEqual(result, ObjectUploadResult.SUCCESS)
+        content = b''.join(self.uploaded[url] for url in self.parts)
+        self.assertEqual(content, self.content[1024:10 * 1024])
+
+    @patch('uhu.updatehub.api.http.post')
+    def test_upload_object_passes_parts_to_storage(self, post):
+        upload = Mock()
+        post.return_value.status_code = 201
+        post.return_value.json.return_value = {
+            'storage': 's3',
+            'url': 'http://storage/complete',
+            'parts': self.parts,
+            'part_size': 4096,
+        }
+        with patch.dict('uhu.updatehub.api.STORAGES', {'s3': upload}):
+            upload_object({'filename': self.fn, 'sha256sum': 'sha',
+                           'md5': 'md5', 'chunks': 11}, '1234')
+        upload.assert_called_once_with(
+            self.fn, 'http://storage/complete', None, parts=self.parts,
+            part_size=4096)
+
+
+class LedgerTestCase(EnvironmentFixtureMixin, FileFixtureMixin, UHUTestCase):
+
+    def setUp(self):
+        self.addCleanup(self.remove_env_var, SERVER_URL_VAR)
+        os.environ[SERVER_URL_VAR] = 'http://server-a'
+        fn = self.create_file('spam')
+        os.utime(fn, (0, 0))  # files modified right now are never cached
+        self.obj = {
+            'filename': fn,
+            'sha256sum': 'sha1234',
+            'md5': 'md51234',
+            'chunks': 2,
+        }
+
+    @patch('uhu.updatehub.api.http.post')
+    def test_does_not_check_objects_stored_in_server(self, post):
+        set_stored(self.obj)
+        callback = Mock()
+        result = upload_object(self.obj, '1234', callback)
+        self.assertEqual(result, ObjectUploadResult.STORED)
+        self.assertFalse(post.called)
+        callback.object_read.assert_called_once_with(2)
+
+    def test_ledger_is_kept_for_each_server(self):
+        set_stored(self.obj)
+        os.environ[SERVER_URL_VAR] = 'http://server-b'
+        self.assertFalse(is_stored(self.obj))
+        set_stored(self.obj)
+        set_stored(self.obj, False)
+        os.environ[SERVER_URL_VAR] = 'http://server-a'
+        self.assertTrue(is_stored(self.obj))
+
+    def test_ledger_is_kept_for_each_archive_entry(self):
+        entries = [dict(self.obj, start=0, size=2, sha256sum='sha0'),
+                   dict(self.obj, start=2, size=2, sha256sum='sha1')]
+        set_stored(entries[0])
+        self.assertTrue(is_stored(entries[0]))
+        self.assertFalse(is_stored(entries[1]))
+        self.assertFalse(is_stored(self.obj))
+
+    @patch('uhu.updatehub.api.http.post')
+    def test_upload_object_passes_archive_entry_to_storage(self, post):
+        upload = Mock(return_value=ObjectUploadResult.SUCCESS)
+        post.return_value.status_code = 201
+        post.return_value.json.return_value = {
+            'storage': 'dummy', 'url': 'http://someplace'}
+        entry = dict(self.obj, start=2, size=2)
+        with patch.dict('uhu.updatehub.api.STORAGES', {'dummy': upload}):
+            upload_object(entry, '1234')
+        upload.assert_called_once_with(
+            self.obj['filename'], 'http://someplace', None, start=2, size=2)
+        self.assertTrue(is_stored(entry))
+
+    @patch('uhu.updatehub.api.http.post')
+    def test_existing_objects_are_stored(self, post):
+        post.return_value.status_code = 200
+        upload_object(self.obj, '1234')
+        self.assertTrue(is_stored(self.obj))
+
+    @patch('uhu.updatehub.api.http.post')
+    @patch('uhu.updatehub.api.http.put')
+    def test_uploaded_objects_are_stored(self, put, post):
+        post.return_value.status_code = 201
+        post.return_value.json.return_value = {
+            'storage': 'swift',
+            'url': 'http://someplace',
+        }
+        upload_object(self.obj, '1234')
+        self.assertTrue(is_stored(self.obj))
+
+    @patch('uhu.updatehub.api.http.post', side_effect=HTTPError)
+    def test_failed_objects_are_not_stored(self, post):
+        upload_object(self.obj, '1234')
+        self.assertFalse(is_stored(self.obj))
+
+    @patch('uhu.updatehub.api.upload_metadata', return_value='1')
+    @patch('uhu.updatehub.api.finish_package')
+    @patch('uhu.updatehub.api.http.post')
+    def test_push_uploads_stored_objects_when_server_disagrees(
+            self, post, finish, metadata):
+        post.return_value.status_code = 200
+        set_stored(self.obj)
+        finish.side_effect = [UpdateHubError, None]
+        callback = Mock()
+        self.assertEqual(push_package({}, [self.obj], callback), '1')
+        self.assertEqual(post.call_count, 1)
+        self.assertEqual(finish.call_count, 2)
+        finish.assert_called_with('1', callback)
+
+    @patch('uhu.updatehub.api.upload_metadata', return_value='1')
+    @patch('uhu.updatehub.api.http.put')
+    @patch('uhu.updatehub.api.http.post')
+    def test_push_finishes_once_when_server_agrees(self, post, put, metadata):
+        set_stored(self.obj)
+        callback = Mock()
+        push_package({}, [self.obj], callback)
+        self.assertFalse(post.called)
+        put.assert_called_once_with(
+            'http://server-a/packages/1/finish')
+        callback.push_finish.assert_called_once_with('1')
+
+
 class UploadObjectsTestCase(unittest.TestCase):
 
     @patch('uhu.updatehub.api.upload_object')
@@ -123,6 +545,46 @@ class UploadObjectsTestCase(unittest.TestCase):
         with self.assertRaises(UpdateHubError):
             upload_objects('1234', [{}, {}])
 
+    @patch('uhu.updatehub.api.upload_object')
+    def test_uploads_objects_concurrently(self, mock):
+        barrier = threading.Barrier(3, timeout=5)
+
+        def upload(obj, package_uid, callback):
+            barrier.wait()  # breaks unless 3 uploads run at once
+            return ObjectUploadResult.SUCCESS
+        mock.side_effect = upload
+        self.assertIsNone(upload_objects('1234', [{}, {}, {}], jobs=3))
+
+    @patch('uhu.updatehub.api.upload_object')
+    def test_raises_error_when_some_concurrent_upload_fails(self, mock):
+        mock.side_effect = lambda obj, *args: obj['result']
+        objects = [{'result': ObjectUploadResult.SUCCESS},
+                   {'result': ObjectUploadResult.FAIL},
+                   {'result': ObjectUploadResult.EXISTS}]
+        with self.assertRaises(UpdateHubError):
+            upload_objects('1234', objects, jobs=3)
+
+    @patch('uhu.updatehub.api.upload_object')
+    def test_progress_is_correct_when_uploading_concurrently(self, mock):
+        def upload(obj, package_uid, callback):
+            for _ in range(obj['chunks']):
+                callback.object_read()
+            return ObjectUploadResult.SUCCESS
+        mock.side_effect = upload
+        callback = BaseCallback()
+        callback.read = 0
+
+        def object_read_upload_callback():
+            read = callback.read
+            threading.Event().wait(0.0001)  # lose updates if unlocked
+            callback.read = read + 1
+        callback.object_read_upload_callback = object_read_upload_callback
+        callback.start_package_upload_callback = lambda: None
+        callback.finish_package_upload_callback = lambda: None
+        objects = [{'chunks': 50} for _ in range(8)]
+        upload_objects('1234', objects, callback, jobs=8)
+        self.assertEqual(callback.read, callback.max)
+
 
 class FinishPackageTestCase(unittest.TestCase):
 
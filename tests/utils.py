@@ -1,11 +1,21 @@
 # Copyright (C) 2017 O.S. Systems Software LTDA.
 # SPDX-License-Identifier: GPL-2.0
 
+import gzip
 import hashlib
+import json
+import lzma
 import os
+import re
 import shutil
 import tempfile
+import threading
 import unittest
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import urlparse
+
+from uhu.updatehub._session import close_session
 
 
 class UHUTestCase(unittest.TestCase):
@@ -18,6 +28,25 @@ class UHUTestCase(unittest.TestCase):
         pass
 
 
+class LegacyLZMADecompressor:
+    """LZMADecompressor as in Python 3.4, whose output can't be limited."""
+    decompressor_class = lzma.LZMADecompressor  # tests may patch lzma
+
+    def __init__(self, *args, **kwargs):
+        self._decompressor = self.decompressor_class(*args, **kwargs)
+
+    def decompress(self, data):
+        return self._decompressor.decompress(data)
+
+    @property
+    def eof(self):
+        return self._decompressor.eof
+
+    @property
+    def unused_data(self):
+        return self._decompressor.unused_data
+
+
 class FileFixtureMixin:
 
     def __init__(self, *args, **kwargs):
@@ -79,3 +108,153 @@ class EnvironmentFixtureMixin:
         super().clean()
         for var in self._vars:
             self.remove_env_var(var)
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    """Handles requests to StandInServer, keeping connections alive."""
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        super().setup()
+        with self.server.lock:
+            self.server.connections += 1
+
+    def reply(self, status, body=None, headers=()):
+        content = json.dumps(body).encode() if body is not None else b''
+        self.send_response(status)
+        for header in headers:
+            self.send_header(*header)
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def read_body(self):
+        return self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+    def do_GET(self):
+        self.reply(200)
+
+    def do_POST(self):
+        server = self.server
+        body = self.read_body()
+        server.signed.append('Authorization' in self.headers)
+        if self.path == '/packages':
+            return self.receive_metadata(body)
+        name = self.path.split('/')[-1]
+        server.checked.append(name)
+        if name in server.objects:
+            return self.reply(200)
+        url = server.url('/storage/{}'.format(name))
+        return self.reply(201, {'storage': server.storage, 'url': url})
+
+    def do_PUT(self):
+        server = self.server
+        if self.path.startswith('/storage/'):
+            return self.store()
+        self.read_body()
+        server.signed.append('Authorization' in self.headers)
+        server.finished.append(self.path)
+        return self.reply(server.finish_status)
+
+    def receive_metadata(self, body):
+        server = self.server
+        server.body_sha256 = hashlib.sha256(body).hexdigest()
+        server.headers = self.headers
+        if self.headers.get('Content-Encoding') == 'gzip':
+            body = gzip.decompress(body)
+        server.metadata = body
+        self.reply(201, {'uid': server.package_uid})
+
+    def store(self):
+        """Stores an object, resuming uploads like uhu.updatehub.api."""
+        server = self.server
+        name = urlparse(self.path).path[len('/storage/'):]
+        with server.lock:
+            data = server.objects.setdefault(name, bytearray())
+        content_range = self.headers.get('Content-Range', '')
+        if content_range.startswith('bytes */'):
+            self.read_body()
+            headers = []
+            if data:
+                headers.append(('Range', 'bytes=0-{}'.format(len(data) - 1)))
+            return self.reply(308, headers=headers)
+        start = int(re.match(r'(?:bytes (\d+)-)?', content_range).group(1)
+                    or 0)
+        length = int(self.headers['Content-Length'])
+        with server.lock:
+            server.paths.append(self.path)
+            server.starts.append(start)
+            server.in_flight += 1
+            server.max_in_flight = max(server.max_in_flight, server.in_flight)
+            drop = server.drops > 0
+            if drop:
+                server.drops -= 1
+        try:
+            if server.barrier is not None:
+                server.barrier.wait()  # uploads must overlap
+            del data[start:]
+            if drop:
+                data += self.rfile.read(min(length, server.drop_after))
+                self.close_connection = True
+                return None
+            data += self.rfile.read(length)
+        finally:
+            with server.lock:
+                server.in_flight -= 1
+        return self.reply(server.storage_status, headers=[('ETag', '"etag"')])
+
+    def log_message(self, *args):  # pylint: disable=arguments-differ
+        pass  # keeps test output clean
+
+
+class StandInServer(ThreadingMixIn, HTTPServer):
+    """Stand-in UpdateHub server and object storage.
+
+    Package metadata, object checks and finish requests are answered
+    like UpdateHub does. Objects are stored, by name, in objects when
+    PUT to /storage/<name>; the first drops uploads are dropped after
+    receiving drop_after bytes. If barrier is set, every upload waits
+    for it, so uploads must overlap.
+    """
+    # Connections dropped by client may be left half open, so server
+    # must not wait for their handlers when shutting down
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), StandInHandler)
+        self.lock = threading.Lock()
+        self.connections = 0
+        self.package_uid = 'pkg'
+        self.storage = 'dummy'
+        self.objects = {}
+        self.checked = []
+        self.signed = []
+        self.finished = []
+        self.finish_status = 200
+        self.paths = []
+        self.starts = []
+        self.storage_status = 200
+        self.drops = 0
+        self.drop_after = 0
+        self.barrier = None
+        self.in_flight = self.max_in_flight = 0
+
+    def url(self, path=''):
+        return 'http://127.0.0.1:{}{}'.format(self.server_address[1], path)
+
+
+class ServerFixtureMixin:
+
+    def start_server(self, **attrs):
+        server = StandInServer()
+        for name, value in attrs.items():
+            setattr(server, name, value)
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        self.addCleanup(thread.join)
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        # Pooled connections must be closed before shutting server down,
+        # otherwise they wait for their next keep-alive request
+        self.addCleanup(close_session)
+        return server
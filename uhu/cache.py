@@ -0,0 +1,165 @@
+# Copyright (C) 2017 O.S. Systems Software LTDA.
+# SPDX-License-Identifier: GPL-2.0
+
+import atexit
+import json
+import os
+import tempfile
+import threading
+import time
+
+from .utils import get_cache_file, get_cache_size
+
+
+# Filesystem timestamps are coarse grained, so a file modified less
+# than RACY_INTERVAL seconds ago may still change without getting a
+# new mtime. Such files are never cached.
+RACY_INTERVAL = 2
+
+
+def get_file_identity(fn):
+    """Returns a key which changes whenever file content may change.
+
+    The key is built from file device, inode, size, modification time
+    and real path.
+    """
+    realpath = os.path.realpath(fn)
+    stat = os.stat(realpath)
+    identity = '{}:{}:{}:{}:{}'.format(
+        stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns, realpath)
+    return identity, stat
+
+
+class DigestCache:
+    """This is the wrapper to manage ~/.uhu-cache file.
+
+    It persists values computed from object files (like its digests),
+    so they are not recomputed while the file does not change. When
+    the cache grows over UHU_CACHE_SIZE entries, the least recently
+    used ones are evicted.
+
+    Cache file is read once, on first use, and changes (including
+    last use timestamps) are kept in memory until flush() writes them
+    back. flush() is called at exit, but long running operations may
+    call it as soon as they are done.
+    """
+
+    def __init__(self):
+        # When disabled, values are neither read nor stored
+        self.enabled = True
+        self._lock = threading.Lock()
+        self._fn = None
+        self._entries = {}
+        self._dirty = False
+
+    def get(self, fn):
+        """Returns all cached values for a given file.
+
+        If there is no valid entry for the file, returns an empty dict.
+        """
+        if not self.enabled:
+            return {}
+        try:
+            key, _ = get_file_identity(fn)
+        except OSError:
+            return {}
+        with self._lock:
+            entry = self._load().get(key)
+            if entry is None:
+                return {}
+            entry['used'] = time.time()
+            self._dirty = True
+            return dict(entry.get('values', {}))
+
+    def update(self, fn, **values):
+        """Stores the given values for a file."""
+        if not self.enabled:
+            return
+        try:
+            key, stat = get_file_identity(fn)
+        except OSError:
+            return
+        if time.time() - stat.st_mtime < RACY_INTERVAL:
+            return
+        with self._lock:
+            entries = self._load()
+            entry = entries.setdefault(key, {'values': {}})
+            entry['values'].update(values)
+            entry['used'] = time.time()
+            self._evict(entries)
+            self._dirty = True
+
+    def flush(self):
+        """Writes changes back to cache file."""
+        with self._lock:
+            self._flush()
+
+    def clear(self):
+        """Removes all cache entries."""
+        with self._lock:
+            self._entries = {}
+            self._dirty = False
+            try:
+                os.remove(get_cache_file())
+            except FileNotFoundError:
+                pass  # already cleared
+
+    def _load(self):
+        fn = get_cache_file()
+        if fn != self._fn:
+            self._flush()  # cache file has changed, keep the old one
+            self._fn = fn
+            self._entries = self._read(fn)
+        return self._entries
+
+    def _flush(self):
+        if not self._dirty:
+            return
+        # Entries stored by other uhu processes since we read the
+        # cache are kept, unless we have a newer version of them
+        entries = self._read(self._fn)
+        entries.update(self._entries)
+        self._write(self._fn, self._evict(entries))
+        self._dirty = False
+
+    @staticmethod
+    def _evict(entries):
+        size = get_cache_size()
+        if len(entries) <= size:
+            return entries
+        keys = sorted(entries, key=lambda key: entries[key]['used'])
+        for key in keys[:len(entries) - size]:
+            del entries[key]
+        return entries
+
+    @staticmethod
+    def _read(fn):
+        try:
+            with open(fn) as fp:
+                entries = json.load(fp)
+        except (OSError, ValueError):
+            return {}  # missing or corrupted cache, start over
+        if not isinstance(entries, dict):
+            return {}
+        return entries
+
+    @staticmethod
+    def _write(fn, entries):
+        # Writes to a temporary file and replaces the cache with it, so
+        # concurrent uhu processes never see a partially written cache
+        dirname = os.path.dirname(os.path.abspath(fn))
+        try:
+            descriptor, tmp = tempfile.mkstemp(
+                prefix='.uhu-cache-', dir=dirname)
+        except OSError:
+            return  # cache is an optimization, never fail because of it
+        try:
+            with os.fdopen(descriptor, 'w') as fp:
+                json.dump(entries, fp)
+            os.replace(tmp, fn)
+        except OSError:
+            os.remove(tmp)
+
+
+cache = DigestCache()  # pylint: disable=invalid-name
+atexit.register(cache.flush)
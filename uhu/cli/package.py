@@ -2,14 +2,20 @@
 # SPDX-License-Identifier: GPL-2.0
 
 import json
+import time
 
 import click
 
 from pkgschema import validate_metadata, ValidationError
 
+from ..cache import cache
+from ..config import config
+from ..core.archive import COMPRESSIONS, push_archive, verify_archive
 from ..core.object import Modes
+from ..core.package import push_packages
 from ..updatehub.api import get_package_status, UpdateHubError
-from ..core.utils import dump_package, dump_package_archive
+from ..core.utils import (
+    dump_package, dump_package_archive, load_package, stream_package_archive)
 from ..ui import get_callback, show_cursor
 
 from ._object import CLICK_ADD_OPTIONS
@@ -97,18 +103,70 @@ def remove_object_command(object_id):
 # Transaction commands
 
 @package_cli.command(name='push')
-def push_command():
+@click.option('--no-cache', is_flag=True,
+              help='Reads objects even if their digests are cached')
+@click.option('--jobs', '-j', type=click.IntRange(min=1),
+              help='How many objects are read at the same time')
+@click.option('--upload-jobs', type=click.IntRange(min=1),
+              help='How many objects are uploaded at the same time')
+@click.option('--engine', type=click.Choice(['threads', 'asyncio']),
+              default='threads', show_default=True,
+              help='How requests are sent (asyncio requires aiohttp)')
+def push_command(no_cache, jobs, upload_jobs, engine):
     """Pushes a package file to server with the given version."""
+    cache.enabled = not no_cache
     callback = get_callback()
     with open_package(read_only=True) as package:
         try:
-            package.push(callback)
+            package.push(callback, jobs=jobs, upload_jobs=upload_jobs,
+                         engine=engine)
         except UpdateHubError as err:
             error(2, err)
         finally:
             show_cursor()
 
 
+@package_cli.command(name='batch-push')
+@click.argument('package-files', nargs=-1, required=True,
+                type=click.Path(exists=True, dir_okay=False))
+@click.option('--no-cache', is_flag=True,
+              help='Reads objects even if their digests are cached')
+@click.option('--jobs', '-j', type=click.IntRange(min=1),
+              help='How many objects are read at the same time')
+@click.option('--upload-jobs', type=click.IntRange(min=1),
+              help='How many objects of each package are uploaded at the '
+              'same time')
+@click.option('--package-jobs', type=click.IntRange(min=1),
+              help='How many packages are pushed at the same time')
+def batch_push_command(package_files, no_cache, jobs, upload_jobs,
+                       package_jobs):
+    """Pushes many package files to server."""
+    cache.enabled = not no_cache
+    packages = []
+    for fn in package_files:
+        try:
+            packages.append(load_package(fn))
+        except ValueError as err:
+            error(1, 'Invalid package file {}: {}'.format(fn, err))
+    try:
+        results = push_packages(
+            packages, get_callback(), jobs=jobs, upload_jobs=upload_jobs,
+            package_jobs=package_jobs)
+    finally:
+        show_cursor()
+    print()
+    failures = 0
+    for fn, result in zip(package_files, results):
+        if isinstance(result, UpdateHubError):
+            failures += 1
+            print('{}: failed: {}'.format(fn, result))
+        else:
+            print('{}: {}'.format(fn, result))
+    if failures:
+        error(2, '{} of {} packages could not be pushed.'.format(
+            failures, len(package_files)))
+
+
 @package_cli.command(name='status')
 @click.argument('package-uid')
 def status_command(package_uid):
@@ -120,10 +178,15 @@ def status_command(package_uid):
 
 
 @package_cli.command(name='metadata')
-def metadata_command():
+@click.option('--no-cache', is_flag=True,
+              help='Reads objects even if their digests are cached')
+@click.option('--jobs', '-j', type=click.IntRange(min=1),
+              help='How many objects are read at the same time')
+def metadata_command(no_cache, jobs):
     """Loads package and prints its metadata."""
+    cache.enabled = not no_cache
     with open_package(read_only=True) as package:
-        metadata = package.to_metadata()
+        metadata = package.to_metadata(jobs=jobs)
         print(json.dumps(metadata, indent=4, sort_keys=True))
     try:
         validate_metadata(metadata)
@@ -133,16 +196,103 @@ def metadata_command():
 
 
 @package_cli.command(name='archive')
-@click.option('--output', type=click.Path(dir_okay=False),
-              help="Where to write archive")
+@click.option('--output', type=click.Path(dir_okay=False, allow_dash=True),
+              help="Where to write archive ('-' streams it to stdout)")
 @click.option('--force', is_flag=True,
               help="Overwrites output file if output exists")
-def archive_command(output, force):
+@click.option('--no-cache', is_flag=True,
+              help='Reads objects even if their digests are cached')
+@click.option('--jobs', '-j', type=click.IntRange(min=1),
+              help='How many objects are compressed at the same time')
+@click.option('--compression', type=click.Choice(list(COMPRESSIONS)),
+              help='Compresses archive entries')
+def archive_command(output, force, no_cache, jobs, compression):
     """Saves package as archive."""
+    cache.enabled = not no_cache
+    streaming = output == '-'  # stdout is archive, errors go to stderr
     with open_package(read_only=True) as package:
         try:
-            dump_package_archive(package, output, force)
+            if streaming:
+                stream_package_archive(
+                    package, click.get_binary_stream('stdout'), jobs=jobs,
+                    compression=compression)
+            else:
+                dump_package_archive(
+                    package, output, force, jobs=jobs,
+                    compression=compression)
         except FileExistsError as err:
             error(1, err)
         except ValueError as err:
-            error(2, err)
+            error(2, err, stderr=streaming)
+
+
+@package_cli.command(name='verify-archive')
+@click.argument('archives', nargs=-1, required=True,
+                type=click.Path(exists=True, dir_okay=False))
+@click.option('--public-key', type=click.Path(exists=True, dir_okay=False),
+              help='Key which signed archives (defaults to private key)')
+@click.option('--jobs', '-j', type=click.IntRange(min=1),
+              help='How many entries are verified at the same time')
+def verify_archive_command(archives, public_key, jobs):
+    """Verifies package archives signature and objects."""
+    try:
+        key = public_key or config.get_private_key_path()
+    except ValueError as err:
+        error(1, err)
+    failures = 0
+    for fn in archives:
+        start = time.monotonic()
+        size = entries = invalid = 0
+        try:
+            for result in verify_archive(fn, key, jobs):
+                entries += 1
+                size += result.size
+                if result.error is not None:
+                    invalid += 1
+                print('{}: {}: {}'.format(
+                    fn, result.name, result.error or 'OK'))
+        except ValueError as err:
+            invalid += 1
+            print('{}: {}'.format(fn, err))
+        else:
+            elapsed = max(time.monotonic() - start, 0.001)
+            mib = size / 2 ** 20
+            print('{}: {} entries, {:.1f} MiB in {:.1f}s ({:.1f} MiB/s)'
+                  .format(fn, entries, mib, elapsed, mib / elapsed))
+        if invalid:
+            failures += 1
+    if failures:
+        error(2, '{} of {} archives are not valid.'.format(
+            failures, len(archives)))
+
+
+@package_cli.command(name='push-archive')
+@click.argument('archive', type=click.Path(exists=True, dir_okay=False))
+@click.option('--public-key', type=click.Path(exists=True, dir_okay=False),
+              help='Key which signed archive (defaults to private key)')
+@click.option('--trust', is_flag=True,
+              help='Does not check archive signature')
+@click.option('--no-cache', is_flag=True,
+              help='Reads objects even if their digests are cached')
+@click.option('--jobs', '-j', type=click.IntRange(min=1),
+              help='How many objects are read at the same time')
+@click.option('--upload-jobs', type=click.IntRange(min=1),
+              help='How many objects are uploaded at the same time')
+def push_archive_command(archive, public_key, trust, no_cache, jobs,
+                         upload_jobs):
+    """Pushes a package archive to server."""
+    # pylint: disable=too-many-arguments
+    cache.enabled = not no_cache
+    key = None
+    if not trust:
+        try:
+            key = public_key or config.get_private_key_path()
+        except ValueError as err:
+            error(1, err)
+    try:
+        push_archive(archive, key, get_callback(), jobs=jobs,
+                     upload_jobs=upload_jobs)
+    except (ValueError, UpdateHubError) as err:
+        error(2, err)
+    finally:
+        show_cursor()
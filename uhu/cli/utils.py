@@ -30,8 +30,15 @@ def open_package(read_only=False):
         dump_package(package.to_template(), pkg_file)
 
 
-def error(code, msg):
-    """Terminates cli with an error code and message for the user."""
-    print('Error: {}'.format(msg))
-    show_cursor()
+def error(code, msg, stderr=False):
+    """Terminates cli with an error code and message for the user.
+
+    If stderr, nothing is written to stdout (e.g. when it is streaming
+    data), message included.
+    """
+    if stderr:
+        print('Error: {}'.format(msg), file=sys.stderr)
+    else:
+        print('Error: {}'.format(msg))
+        show_cursor()
     sys.exit(code)
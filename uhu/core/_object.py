@@ -5,10 +5,12 @@ import hashlib
 import math
 import os
 
-from ..utils import call, get_chunk_size
+from ..cache import cache
+from ..utils import call, get_chunk_size, memoize
 
 from ._options import Options
-from .compression import compression_to_metadata
+from .compression import CompressionConsumer, compression_to_metadata
+from .inspection import DigestConsumer
 from .install_condition import InstallCondition
 from .validators import validate_options
 
@@ -87,23 +89,59 @@ class BaseObject(metaclass=ObjectType):
         template['mode'] = self.mode
         return template
 
-    def to_metadata(self, callback=None):
-        self.load(callback)
+    def to_metadata(self, callback=None, memo=None):
+        """Serializes object as metadata.
+
+        memo is a dict shared by all objects serialized in the same
+        run. Since results read from the object file are stored there
+        under its real path, objects pointing to the same file read it
+        only once.
+        """
+        self.load(callback, memo)
         metadata = {opt.metadata: value for opt, value in self._values.items()}
         metadata['mode'] = self.mode
-        metadata.update(self._metadata_install_condition(metadata))
-        metadata.update(self._metadata_compression())
+        metadata.update(self._metadata_install_condition(metadata, memo))
+        metadata.update(self._metadata_compression(memo))
         return metadata
 
-    def _metadata_install_condition(self, metadata):
+    def inspect(self, inspection):
+        """Registers in inspection the consumers needed by metadata.
+
+        Values already cached are not registered.
+        """
+        cached = cache.get(self.filename)
+        if 'sha256sum' not in cached or 'md5' not in cached:
+            inspection.want(
+                ('digests', self.realpath), DigestConsumer(),
+                lambda digests: self._cache_digests(*digests))
+        if self.allow_compression and 'compression' not in cached:
+            inspection.want(
+                ('compression', self.realpath),
+                CompressionConsumer(self.filename),
+                lambda value: cache.update(self.filename, compression=value))
+        if self.allow_install_condition:
+            metadata = {opt.metadata: value
+                        for opt, value in self._values.items()}
+            InstallCondition(metadata).inspect(inspection)
+
+    def _metadata_install_condition(self, metadata, memo=None):
         if not self.allow_install_condition:
             return {}
-        return InstallCondition(metadata).to_metadata()
+        return InstallCondition(metadata, memo).to_metadata()
 
-    def _metadata_compression(self):
+    def _metadata_compression(self, memo=None):
         if not self.allow_compression:
             return {}
-        return compression_to_metadata(self.filename)
+        return memoize(
+            memo, ('compression', self.realpath), self._compression)
+
+    def _compression(self):
+        cached = cache.get(self.filename).get('compression')
+        if cached is not None:
+            return cached
+        compression = compression_to_metadata(self.filename)
+        cache.update(self.filename, compression=compression)
+        return compression
 
     def to_upload(self):
         return {
@@ -119,6 +157,11 @@ class BaseObject(metaclass=ObjectType):
         """Shortcut to returns object filename option."""
         return self['filename']
 
+    @property
+    def realpath(self):
+        """Returns object filename with all links resolved."""
+        return os.path.realpath(self.filename)
+
     @property
     def size(self):
         """Returns the size of object file."""
@@ -133,17 +176,38 @@ class BaseObject(metaclass=ObjectType):
         """Updates a given option value."""
         self[option] = value
 
-    def load(self, callback=None):
-        """Reads object to set its size, sha256sum and MD5."""
+    def load(self, callback=None, memo=None):
+        """Reads object to set its size, sha256sum and MD5.
+
+        Digests are taken from cache when object file has not changed
+        since it was last read.
+        """
+        sha256sum, md5 = memoize(
+            memo, ('digests', self.realpath), self._digests, callback)
+        self['sha256sum'] = sha256sum
+        self['size'] = self.size
+        self.md5 = md5
+
+    def _digests(self, callback=None):
+        cached = cache.get(self.filename)
+        if 'sha256sum' in cached and 'md5' in cached:
+            call(callback, 'object_read', len(self))
+            return cached['sha256sum'], cached['md5']
+        sha256sum, md5 = self._read_digests(callback)
+        self._cache_digests(sha256sum, md5)
+        return sha256sum, md5
+
+    def _cache_digests(self, sha256sum, md5):
+        cache.update(self.filename, sha256sum=sha256sum, md5=md5)
+
+    def _read_digests(self, callback=None):
         sha256sum = hashlib.sha256()
         md5 = hashlib.md5()
         for chunk in self:
             sha256sum.update(chunk)
             md5.update(chunk)
             call(callback, 'object_read')
-        self['sha256sum'] = sha256sum.hexdigest()
-        self['size'] = self.size
-        self.md5 = md5.hexdigest()
+        return sha256sum.hexdigest(), md5.hexdigest()
 
     def __setitem__(self, key, value):
         try:
@@ -0,0 +1,447 @@
+# Copyright (C) 2017 O.S. Systems Software LTDA.
+# SPDX-License-Identifier: GPL-2.0
+
+"""Package archives (.uhupkg).
+
+An archive is a zip file with package metadata, its signature and
+every object file, named after its sha256sum.
+"""
+
+import hashlib
+import json
+import math
+import os
+import struct
+import sys
+import tempfile
+import threading
+import time
+import zipfile
+from collections import namedtuple, OrderedDict
+from concurrent.futures import as_completed, ThreadPoolExecutor
+
+import pkgschema
+
+from ..cache import cache
+from ..updatehub.api import push_package
+from ..utils import (
+    call, get_chunk_size, get_jobs, parallel_map, verify_bytes)
+from .compression import get_compressor_format
+from .inspection import Inspection
+
+
+# Object entries are named after their sha256sum, which is only known
+# after they are written. Until then, they have a placeholder name of
+# the same length, so entry header does not change size.
+SHA256SUM_LENGTH = 64
+
+# Supported entry compressions
+COMPRESSIONS = OrderedDict([
+    ('deflate', zipfile.ZIP_DEFLATED),
+    ('bzip2', zipfile.ZIP_BZIP2),
+    ('lzma', zipfile.ZIP_LZMA),
+])
+
+COPY_CHUNK_SIZE = 1024 * 1024  # bytes
+
+# zipfile can open entries for writing since Python 3.6; before that,
+# entries are spooled (see SpooledEntry)
+WRITABLE_ENTRIES = sys.version_info >= (3, 6)
+
+# Entries are dated as zipfile does by default, so archive content
+# depends only on package
+ZIP_EPOCH = time.mktime((1980, 1, 1, 0, 0, 0, 0, 0, -1))
+
+# Entries which are not objects
+METADATA_ENTRIES = ('metadata', 'signature')
+
+# Result of an object entry verification. error is None if entry is
+# valid, otherwise it tells what is wrong.
+EntryVerification = namedtuple('EntryVerification', 'name size error')
+
+
+class EntryConsumer:
+    """Inspection consumer which writes file into an archive entry."""
+
+    def __init__(self, writer, archive, filename, name=None):
+        self.done = False  # all data is needed
+        self.writer = writer
+        self.archive = archive
+        self.filename = filename
+        self.name = name
+        self.info = self.entry = None
+
+    def feed(self, chunk):
+        if self.entry is None:
+            self.info, self.entry = self.writer.open_entry(
+                self.archive, self.filename, self.name)
+        self.entry.write(chunk)
+
+    def result(self):
+        if self.entry is None:  # empty file
+            self.info, self.entry = self.writer.open_entry(
+                self.archive, self.filename, self.name)
+        return self.info, self.entry
+
+
+class SpooledEntry:
+    """Archive entry opened for writing, for Pythons before 3.6.
+
+    Data is written to a temporary file, which is added to archive on
+    close under info name (so entry may still be renamed). Object
+    files are still read only once.
+    """
+
+    def __init__(self, archive, info):
+        self.archive = archive
+        self.info = info
+        self.spool = tempfile.NamedTemporaryFile(delete=False)
+
+    def write(self, data):
+        self.spool.write(data)
+
+    def close(self):
+        self.spool.close()
+        try:
+            os.utime(self.spool.name, (ZIP_EPOCH, ZIP_EPOCH))
+            self.archive.write(
+                self.spool.name, self.info.filename, self.info.compress_type)
+        finally:
+            os.remove(self.spool.name)
+        self.archive.filelist[-1].external_attr = self.info.external_attr
+
+
+class ArchiveWriter:
+    """Writes a package archive reading every object file only once.
+
+    Object files are written while they are inspected for metadata
+    (see add), so the same read computes their digests and fills their
+    entries. Metadata and signature are written last, by finish.
+
+    Entries may be compressed (see COMPRESSIONS), except objects which
+    are already compressed. Compression is done by a pool of jobs
+    threads, each one writing entries into a temporary archive which
+    is then copied to this one in package order. Archive content does
+    not depend on jobs.
+
+    Archive may be a file name or a file object. Files whose digests
+    are not known (in memo or cache) before they are written must be
+    renamed after that, so it must be seekable to write them. Other
+    files are written straight under their names, which lets archives
+    be streamed to pipes (see uhu.core.utils.stream_package_archive).
+    """
+
+    def __init__(self, fn, compression=None, jobs=None):
+        if compression is None:
+            self.compress_type = zipfile.ZIP_STORED
+        else:
+            self.compress_type = COMPRESSIONS[compression]
+        self.jobs = get_jobs() if jobs is None else jobs
+        self.archive = zipfile.ZipFile(fn, mode='w')
+        self.names = set()
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.archive.close()
+
+    def add(self, groups, memo, callback=None):
+        """Writes the file of each group of objects.
+
+        Objects of a group must share the same real path. Values needed
+        by objects metadata are computed in the same read and stored in
+        memo, so serializing them later does not read their files
+        again, except linux-kernel install conditions, whose version is
+        extracted from the image afterwards (see get_kernel_version).
+        Files with the same content are written only once.
+        """
+        groups = list(groups)
+        if self.compress_type == zipfile.ZIP_STORED or self.jobs <= 1:
+            for objs in groups:
+                entry = self.write(self.archive, objs, memo, callback)
+                if entry is not None and not self.claim(entry[0].filename):
+                    self.drop_last_entry()
+            return
+
+        def compress(objs):
+            spool = tempfile.TemporaryFile()
+            with zipfile.ZipFile(spool, mode='w') as archive:
+                entry = self.write(archive, objs, memo, callback)
+            return spool, entry
+        # Entries are claimed in package order, so the same one is kept
+        # no matter which file with its content is compressed first
+        for spool, entry in parallel_map(compress, groups, self.jobs):
+            with spool:
+                if entry is not None and self.claim(entry[0].filename):
+                    self.copy_entry(spool, *entry)
+
+    def write(self, archive, objs, memo, callback=None):
+        """Writes the file of objs into archive.
+
+        Returns written entry info and size, or None if the file
+        content is known to be written already.
+        """
+        obj = objs[0]
+        inspection = Inspection(obj.filename, memo)
+        for each in objs:
+            each.inspect(inspection)
+        digests = memo.get(('digests', obj.realpath))
+        if digests is not None:
+            sha256sum = digests[0]
+        else:
+            sha256sum = cache.get(obj.filename).get('sha256sum')
+        if sha256sum in self.names:
+            inspection.run(callback)
+            return None
+        key = ('archive', obj.realpath)
+        consumer = EntryConsumer(self, archive, obj.filename, sha256sum)
+        inspection.want(key, consumer)
+        try:
+            inspection.run(callback)
+        except BaseException:
+            if consumer.entry is not None:
+                consumer.entry.close()  # so archive can be closed
+            raise
+        del memo[key]
+        obj.load(memo=memo)
+        if sha256sum is None:
+            # Header is written again on close, now with the right name
+            consumer.info.filename = obj['sha256sum']
+        consumer.entry.close()
+        info = archive.filelist[-1]
+        return info, archive.fp.tell() - info.header_offset
+
+    def claim(self, sha256sum):
+        """Returns if sha256sum entry was not written yet, marking it."""
+        with self._lock:
+            if sha256sum in self.names:
+                return False
+            self.names.add(sha256sum)
+            return True
+
+    def open_entry(self, archive, filename, name=None):
+        if name is None:
+            name = '{:0{}x}'.format(len(archive.filelist), SHA256SUM_LENGTH)
+        info = zipfile.ZipInfo(name)
+        info.external_attr = 0o644 << 16
+        # Lets zipfile know if entry needs zip64 extensions
+        info.file_size = os.path.getsize(filename)
+        if get_compressor_format(filename) is None:
+            info.compress_type = self.compress_type
+        if not WRITABLE_ENTRIES:
+            return info, SpooledEntry(archive, info)
+        return info, archive.open(info, mode='w')
+
+    def copy_entry(self, spool, info, size):
+        """Copies an entry (header and data) written to spool."""
+        archive = self.archive
+        spool.seek(info.header_offset)
+        info.header_offset = archive.fp.tell()
+        while size:
+            chunk = spool.read(min(size, COPY_CHUNK_SIZE))
+            archive.fp.write(chunk)
+            size -= len(chunk)
+        archive.start_dir = archive.fp.tell()
+        archive.filelist.append(info)
+        archive.NameToInfo[info.filename] = info
+
+    def drop_last_entry(self):
+        """Removes last entry written, whose content was already written."""
+        info = self.archive.filelist.pop()
+        self.archive.NameToInfo[info.filename] = next(
+            kept for kept in self.archive.filelist
+            if kept.filename == info.filename)
+        self.archive.fp.seek(info.header_offset)
+        self.archive.fp.truncate()
+        self.archive.start_dir = info.header_offset
+
+    def finish(self, metadata, signature):
+        """Writes metadata and its signature."""
+        for name, data in (('signature', signature), ('metadata', metadata)):
+            info = zipfile.ZipInfo(name)
+            info.external_attr = 0o644 << 16
+            info.compress_type = self.compress_type
+            self.archive.writestr(info, data)
+
+
+def read_archive_metadata(archive, key):
+    """Returns the metadata of an archive opened as a ZipFile.
+
+    Metadata signature is checked against key (see verify_bytes), if
+    given, and metadata is validated against package schema. Raises
+    ValueError if metadata is not valid.
+    """
+    try:
+        metadata = archive.read('metadata')
+        signature = archive.read('signature')
+    except KeyError:
+        raise ValueError('Archive has no metadata or signature.')
+    signature = signature.decode(errors='replace')
+    if key is not None and not verify_bytes(metadata, signature, key):
+        raise ValueError('Archive metadata signature is not valid.')
+    try:
+        metadata = json.loads(metadata.decode())
+        pkgschema.validate_metadata(metadata)
+    except (ValueError, pkgschema.ValidationError):
+        raise ValueError('Archive metadata is not valid.')
+    return metadata
+
+
+def verify_entry(archive, info):
+    """Checks if an object entry content matches its name (sha256sum)."""
+    sha256sum = hashlib.sha256()
+    chunk_size = get_chunk_size()
+    try:
+        with archive.open(info) as fp:
+            for chunk in iter(lambda: fp.read(chunk_size), b''):
+                sha256sum.update(chunk)
+    except (zipfile.BadZipFile, EOFError, OSError, ValueError) as error:
+        # zipfile checks entry CRC, and decompressors their data
+        return EntryVerification(info.filename, info.file_size, str(error))
+    if sha256sum.hexdigest() != info.filename:
+        return EntryVerification(
+            info.filename, info.file_size, 'sha256sum does not match.')
+    return EntryVerification(info.filename, info.file_size, None)
+
+
+def open_archive(fn):
+    try:
+        return zipfile.ZipFile(fn)
+    except zipfile.BadZipFile:
+        raise ValueError('File is not a package archive.')
+
+
+def verify_archive(fn, key, jobs=None):
+    """Verifies a package archive.
+
+    Metadata is checked first (see read_archive_metadata), raising
+    ValueError if it is not valid. Then, every object entry is hashed,
+    by a pool of jobs threads. Returns an iterator which yields an
+    EntryVerification as soon as each entry is verified; objects in
+    metadata which have no entry are yielded first.
+    """
+    archive = open_archive(fn)
+    try:
+        metadata = read_archive_metadata(archive, key)
+    except BaseException:
+        archive.close()
+        raise
+    return _verify_entries(archive, metadata, jobs)
+
+
+def _verify_entries(archive, metadata, jobs):
+    with archive:
+        entries = [info for info in archive.infolist()
+                   if info.filename not in METADATA_ENTRIES]
+        names = {info.filename for info in entries}
+        missing = OrderedDict()
+        for set_ in metadata.get('objects', []):
+            for obj in set_:
+                if obj['sha256sum'] not in names:
+                    missing[obj['sha256sum']] = obj.get('size', 0)
+        for sha256sum, size in missing.items():
+            yield EntryVerification(sha256sum, size, 'Object is missing.')
+        jobs = get_jobs() if jobs is None else jobs
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            futures = [executor.submit(verify_entry, archive, info)
+                       for info in entries]
+            for future in as_completed(futures):
+                yield future.result()
+
+
+def push_archive(fn, key=None, callback=None, jobs=None, upload_jobs=None):
+    """Pushes a package archive to UpdateHub server. Returns package uid.
+
+    Metadata is sent with the signature found in archive, so private
+    key is not needed. If key is given, the signature is checked
+    against it first; otherwise, archive is trusted.
+
+    Objects are uploaded straight from archive file, by offset, so
+    their entries must not be compressed. Server needs objects MD5,
+    which is not in metadata, so entries are read once by a pool of
+    jobs threads (unless cached by a previous push), being checked
+    against their names in the same read.
+    """
+    with open_archive(fn) as archive:
+        metadata = read_archive_metadata(archive, key)
+        payload = archive.read('metadata')
+        signature = archive.read('signature').decode()
+        objects = _archive_objects(archive, metadata)
+    call(callback, 'start_objects_load')
+    parallel_map(lambda obj: _load_entry(obj, callback), objects, jobs)
+    cache.flush()
+    call(callback, 'finish_objects_load')
+    # Entries read last are more likely to be in page cache
+    return push_package(
+        payload, objects[::-1], callback, upload_jobs, signature=signature)
+
+
+def _archive_objects(archive, metadata):
+    """Returns the objects to upload, one for each distinct entry."""
+    objects = OrderedDict()
+    with open(archive.filename, 'rb') as fp:
+        for set_ in metadata['objects']:
+            for obj in set_:
+                sha256sum = obj['sha256sum']
+                if sha256sum in objects:
+                    continue
+                try:
+                    info = archive.getinfo(sha256sum)
+                except KeyError:
+                    raise ValueError(
+                        'Archive has no object {}.'.format(sha256sum))
+                if info.compress_type != zipfile.ZIP_STORED:
+                    raise ValueError(
+                        'Archive object {} is compressed. Only archives '
+                        'without compression can be pushed.'.format(
+                            sha256sum))
+                objects[sha256sum] = {
+                    'filename': archive.filename,
+                    'start': _entry_data_offset(fp, info),
+                    'size': info.file_size,
+                    'sha256sum': sha256sum,
+                    'chunks': math.ceil(info.file_size / get_chunk_size()),
+                }
+    return list(objects.values())
+
+
+def _entry_data_offset(fp, info):
+    """Returns where entry data starts, after its local header."""
+    fp.seek(info.header_offset)
+    header = fp.read(zipfile.sizeFileHeader)
+    if (len(header) != zipfile.sizeFileHeader or
+            header[:4] != zipfile.stringFileHeader):
+        raise ValueError('Archive is corrupted.')
+    name_size, extra_size = struct.unpack('<HH', header[26:30])
+    return info.header_offset + len(header) + name_size + extra_size
+
+
+def _load_entry(obj, callback=None):
+    """Sets obj MD5, checking entry content against its sha256sum."""
+    key = 'md5-{}'.format(obj['sha256sum'])
+    md5 = cache.get(obj['filename']).get(key)
+    if md5 is not None:
+        obj['md5'] = md5
+        call(callback, 'object_read', obj['chunks'])
+        return
+    sha256sum = hashlib.sha256()
+    md5 = hashlib.md5()
+    chunk_size = get_chunk_size()
+    with open(obj['filename'], 'rb') as fp:
+        fp.seek(obj['start'])
+        remaining = obj['size']
+        while remaining:
+            chunk = fp.read(min(chunk_size, remaining))
+            if not chunk:
+                break  # archive was truncated
+            sha256sum.update(chunk)
+            md5.update(chunk)
+            remaining -= len(chunk)
+            call(callback, 'object_read')
+    if sha256sum.hexdigest() != obj['sha256sum']:
+        raise ValueError(
+            'Archive object {} is corrupted.'.format(obj['sha256sum']))
+    obj['md5'] = md5.hexdigest()
+    cache.update(obj['filename'], **{key: obj['md5']})
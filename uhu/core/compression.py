@@ -1,8 +1,13 @@
 # Copyright (C) 2017 O.S. Systems Software LTDA.
 # SPDX-License-Identifier: GPL-2.0
 
+import lzma
 import shutil
+import struct
 import subprocess
+import zlib
+
+from ..utils import get_chunk_size
 
 
 COMPRESSORS = {
@@ -31,6 +36,9 @@ COMPRESSORS = {
 MAX_COMPRESSOR_SIGNATURE_SIZE = max(
     [len(compressor['signature']) for compressor in COMPRESSORS.values()])
 
+# Maximum amount of data uncompressed at once by decompressors
+DECOMPRESS_CHUNK_SIZE = 1024 * 1024  # 1 MiB
+
 
 def get_compressor_format(fn):
     """Returns the compression backend for a given file.
@@ -40,6 +48,11 @@ def get_compressor_format(fn):
     """
     with open(fn, 'rb') as fp:
         header = fp.read(MAX_COMPRESSOR_SIGNATURE_SIZE)
+    return sniff_compressor_format(header)
+
+
+def sniff_compressor_format(header):
+    """Same as get_compressor_format, but given the file header."""
     for fmt, compressor in COMPRESSORS.items():
         signature = compressor['signature']
         if signature == header[:len(signature)]:
@@ -58,34 +71,65 @@ def is_compressor_supported(compressor):
 
 def is_valid_compressed_file(fn, compressor_name):
     """Checks if compressed file is a valid one."""
-    compressor = COMPRESSORS.get(compressor_name)
-    test_cmd = compressor['test'] % fn
     try:
-        result = subprocess.check_call(test_cmd, shell=True)
-        if result == 0:
-            return True
+        verify_compressed_file(fn, compressor_name)
+    except ValueError:
+        return False  # file is corrupted
+    except SystemError:
+        return False  # file could not be verified
+    return True
+
+
+def test_with_compressor(fn, compressor_name):
+    """Checks compressed file with compressor utility (e.g. gzip -t).
+
+    Raises SystemError if compressor is not installed and ValueError
+    if file is corrupted.
+    """
+    if not is_compressor_supported(compressor_name):
+        err = '"{}" is not supported by your system.'
+        raise SystemError(err.format(compressor_name))
+    cmd = COMPRESSORS[compressor_name]['test'] % fn
+    try:
+        subprocess.check_call(cmd, shell=True)
     except subprocess.CalledProcessError:
-        pass  # file is corrupted
-    return False
+        err = '"{}" is a bad/corrupted {} file.'
+        raise ValueError(err.format(fn, compressor_name))
+
+
+def get_size_from_compressor(fn, compressor_name):
+    """Fallback used when file can't be verified in-process.
+
+    Compressor utility has the final word on the file. Without it,
+    file is considered corrupted.
+    """
+    try:
+        test_with_compressor(fn, compressor_name)
+    except SystemError:
+        err = '"{}" is a bad/corrupted {} file.'
+        raise ValueError(err.format(fn, compressor_name))
+    cmd = COMPRESSORS[compressor_name]['cmd'] % fn
+    size = subprocess.check_output(cmd, shell=True)
+    return int(size.decode())
 
 
 def get_uncompressed_size(fn, compressor_name):
-    """Returns uncompressed size of a given compressed file."""
+    """Returns uncompressed size of a given compressed file.
+
+    File is verified and its size is computed in-process, in a single
+    pass (see verify_compressed_file). If it fails, compressor utility
+    is used as a fallback, when available.
+    """
     if compressor_name is None:
         return  # It is not a compressed file
     compressor = COMPRESSORS.get(compressor_name)
     if compressor is None:
         err = '"{}" is not supported'
         raise ValueError(err.format(compressor_name))
-    if not is_compressor_supported(compressor_name):
-        err = '"{}" is not supported by your system.'
-        raise SystemError(err.format(compressor_name))
-    if not is_valid_compressed_file(fn, compressor_name):
-        err = '"{}" is a bad/corrupted {} file.'
-        raise ValueError(err.format(fn, compressor_name))
-    cmd = compressor['cmd'] % fn
-    size = subprocess.check_output(cmd, shell=True)
-    return int(size.decode())
+    try:
+        return verify_compressed_file(fn, compressor_name)
+    except ValueError:
+        return get_size_from_compressor(fn, compressor_name)
 
 
 def compression_to_metadata(filename):
@@ -97,3 +141,345 @@ def compression_to_metadata(filename):
         'compressed': True,
         'required-uncompressed-size': size,
     }
+
+
+# lzop header flags
+LZOP_F_ADLER32_D = 0x00000001
+LZOP_F_ADLER32_C = 0x00000002
+LZOP_F_H_EXTRA_FIELD = 0x00000040
+LZOP_F_CRC32_D = 0x00000100
+LZOP_F_CRC32_C = 0x00000200
+LZOP_F_H_FILTER = 0x00000800
+LZOP_F_H_CRC32 = 0x00001000
+LZOP_MAX_BLOCK_SIZE = 64 * 1024 * 1024
+
+
+def _lzop_checksum(flags, data):
+    if flags & LZOP_F_H_CRC32:
+        return zlib.crc32(data)
+    return zlib.adler32(data)
+
+
+def _parse_lzop_header(data):
+    """Parses and verifies lzop file header.
+
+    Returns a tuple with header flags and header size, or None if data
+    is not long enough to hold the whole header.
+    """
+    signature = COMPRESSORS['lzop']['signature']
+    if data[:len(signature)] != signature[:len(data)]:
+        raise ValueError('Invalid lzop signature.')
+    offset = len(signature)
+
+    def unpack(fmt):
+        nonlocal offset
+        size = struct.calcsize(fmt)
+        if offset + size > len(data):
+            raise EOFError
+        values = struct.unpack_from(fmt, data, offset)
+        offset += size
+        return values
+
+    try:
+        version, _ = unpack('>HH')
+        if version >= 0x0940:
+            unpack('>H')  # version needed to extract
+        unpack('>B')  # method
+        if version >= 0x0940:
+            unpack('>B')  # level
+        flags, = unpack('>I')
+        if flags & LZOP_F_H_FILTER:
+            unpack('>I')
+        unpack('>II')  # mode and mtime
+        if version >= 0x0940:
+            unpack('>I')  # mtime high
+        name_size, = unpack('>B')
+        offset += name_size
+        header_end = offset
+        checksum, = unpack('>I')
+        if checksum != _lzop_checksum(flags, data[len(signature):header_end]):
+            raise ValueError('Invalid lzop header checksum.')
+        if flags & LZOP_F_H_EXTRA_FIELD:
+            extra_size, = unpack('>I')
+            offset += extra_size
+            unpack('>I')  # extra field checksum
+    except EOFError:
+        return None
+    return flags, offset
+
+
+def _get_lzop_checksums_size(flags, src_size, dst_size):
+    """Returns the size of the checksums which follow a block header."""
+    size = 4 * (bool(flags & LZOP_F_ADLER32_D) + bool(flags & LZOP_F_CRC32_D))
+    if src_size < dst_size:
+        size += 4 * (
+            bool(flags & LZOP_F_ADLER32_C) + bool(flags & LZOP_F_CRC32_C))
+    return size
+
+
+def _check_lzop_block_sizes(src_size, dst_size):
+    if dst_size > LZOP_MAX_BLOCK_SIZE or src_size > dst_size:
+        raise ValueError('Invalid lzop block sizes.')
+
+
+# Streaming uncompressed size
+
+class GzipSizeCounter:
+    """Counts the uncompressed size of a gzip stream.
+
+    Concatenated gzip members are supported. zlib checks CRC32 of
+    every member, so a corrupted stream raises ValueError.
+    """
+    errors = (zlib.error,)
+    verified = True  # all data is checked
+
+    def __init__(self):
+        self.size = 0
+        self._decompressor = None
+
+    @staticmethod
+    def _new_decompressor():
+        return zlib.decompressobj(zlib.MAX_WBITS | 16)
+
+    def feed(self, data):
+        try:
+            while data:
+                if self._decompressor is None:
+                    self._decompressor = self._new_decompressor()
+                data = self._decompress(data)
+        except self.errors as error:
+            raise ValueError(error)
+
+    def _decompress(self, data):
+        """Uncompress data. Returns data left after the end of stream."""
+        decompressor = self._decompressor
+        self.size += len(
+            decompressor.decompress(data, DECOMPRESS_CHUNK_SIZE))
+        while decompressor.unconsumed_tail:
+            self.size += len(decompressor.decompress(
+                decompressor.unconsumed_tail, DECOMPRESS_CHUNK_SIZE))
+        if not decompressor.eof:
+            return b''
+        # A new member may start right after this one
+        self._decompressor = None
+        return decompressor.unused_data
+
+    def close(self):
+        """Returns uncompressed size when there is no more data."""
+        if self._decompressor is not None:
+            raise ValueError('Compressed data ended before end of stream.')
+        return self.size
+
+
+class XzSizeCounter(GzipSizeCounter):
+    """Counts the uncompressed size of a xz stream.
+
+    Concatenated streams and stream padding are supported. Blocks are
+    verified against their integrity checks.
+    """
+    errors = (lzma.LZMAError,)
+
+    @staticmethod
+    def _new_decompressor():
+        return lzma.LZMADecompressor(format=lzma.FORMAT_XZ)
+
+    def feed(self, data):
+        if self._decompressor is None:
+            # Stream padding (null bytes) may follow any stream
+            data = data.lstrip(b'\0')
+        super().feed(data)
+
+    def _decompress(self, data):
+        decompressor = self._decompressor
+        if not hasattr(decompressor, 'needs_input'):
+            # Python < 3.5 can't limit output size
+            self.size += len(decompressor.decompress(data))
+        else:
+            self.size += len(
+                decompressor.decompress(data, DECOMPRESS_CHUNK_SIZE))
+            while not decompressor.eof and not decompressor.needs_input:
+                self.size += len(
+                    decompressor.decompress(b'', DECOMPRESS_CHUNK_SIZE))
+        if not decompressor.eof:
+            return b''
+        self._decompressor = None
+        return decompressor.unused_data.lstrip(b'\0')
+
+
+class LzopSizeCounter:
+    """Counts the uncompressed size of a lzop stream.
+
+    Python has no LZO decompressor, so block data is verified only
+    when it is possible without uncompressing it: the header checksum,
+    block sizes, compressed data checksums and the checksums of blocks
+    stored uncompressed. Any inconsistency raises ValueError.
+
+    lzop only stores compressed data checksums when asked to, so
+    verified is set to False when any block could not be checked.
+    """
+
+    def __init__(self):
+        self.size = 0
+        self.verified = True
+        self._buffer = bytearray()
+        self._flags = None
+        self._eof = False
+
+    def feed(self, data):
+        self._buffer += data
+        if self._flags is None:
+            header = _parse_lzop_header(self._buffer)
+            if header is None:
+                return
+            self._flags, offset = header
+            del self._buffer[:offset]
+        while not self._eof and self._read_block():
+            pass
+        if self._eof and self._buffer:
+            raise ValueError('Unexpected data after lzop end of file.')
+
+    def _read_block(self):
+        """Consumes a whole block from buffer, if available."""
+        buf = self._buffer
+        if len(buf) < 4:
+            return False
+        dst_size, = struct.unpack_from('>I', buf)
+        if dst_size == 0:
+            self._eof = True
+            del buf[:4]
+            return False
+        if len(buf) < 8:
+            return False
+        src_size, = struct.unpack_from('>I', buf, 4)
+        _check_lzop_block_sizes(src_size, dst_size)
+        checksums_size = _get_lzop_checksums_size(
+            self._flags, src_size, dst_size)
+        block_size = 8 + checksums_size + src_size
+        if len(buf) < block_size:
+            return False
+        checksums = struct.unpack_from(
+            '>{}I'.format(checksums_size // 4), buf, 8)
+        data = bytes(buf[8 + checksums_size:block_size])
+        self._verify_block(checksums, data, src_size == dst_size)
+        self.size += dst_size
+        del buf[:block_size]
+        return True
+
+    def _verify_block(self, checksums, data, stored):
+        checksums = iter(checksums)
+        flags = self._flags
+        expected = []
+        # Uncompressed data checksums can only be verified if the block
+        # was stored as is. Compressed data checksums are only present
+        # for blocks which were really compressed.
+        for flag, func in [(LZOP_F_ADLER32_D, zlib.adler32),
+                           (LZOP_F_CRC32_D, zlib.crc32)]:
+            if flags & flag:
+                checksum = next(checksums)
+                if stored:
+                    expected.append((checksum, func))
+        if not stored:
+            for flag, func in [(LZOP_F_ADLER32_C, zlib.adler32),
+                               (LZOP_F_CRC32_C, zlib.crc32)]:
+                if flags & flag:
+                    expected.append((next(checksums), func))
+        if not expected:
+            self.verified = False
+        for checksum, func in expected:
+            if checksum != func(data):
+                raise ValueError('Invalid lzop block checksum.')
+
+    def close(self):
+        """Returns uncompressed size when there is no more data."""
+        if not self._eof:
+            raise ValueError('Compressed data ended before end of file.')
+        return self.size
+
+
+SIZE_COUNTERS = {
+    'gzip': GzipSizeCounter,
+    'lzop': LzopSizeCounter,
+    'xz': XzSizeCounter,
+}
+
+
+def verify_compressed_file(fn, compressor_name):
+    """Verifies a compressed file, returning its uncompressed size.
+
+    File is checked in-process while it is read. Compressor utility is
+    only used for data which can't be checked in-process (see
+    LzopSizeCounter). Raises ValueError if file is corrupted and
+    SystemError if it needs a compressor which is not installed.
+    """
+    counter = SIZE_COUNTERS[compressor_name]()
+    with open(fn, 'rb') as fp:
+        for chunk in iter(lambda: fp.read(get_chunk_size()), b''):
+            counter.feed(chunk)
+    size = counter.close()
+    if not counter.verified:
+        test_with_compressor(fn, compressor_name)
+    return size
+
+
+class CompressionConsumer:
+    """Inspection consumer which generates object compression metadata.
+
+    It sniffs the compressor signature from the first bytes. If the
+    format can be uncompressed in-process, the uncompressed size is
+    counted while data is read, so the object is not read again.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.done = False
+        self.format = None
+        self._buffer = b''
+        self._counter = None
+        self._error = None
+
+    def feed(self, chunk):
+        if self._counter is None:
+            # Waits until there is enough data to sniff the signature
+            self._buffer += chunk
+            if len(self._buffer) < MAX_COMPRESSOR_SIGNATURE_SIZE:
+                return
+            chunk, self._buffer = self._buffer, b''
+            self._start(chunk)
+            if self.done:
+                return
+        try:
+            self._counter.feed(chunk)
+        except ValueError as error:
+            self._error = error
+            self.done = True
+
+    def _start(self, header):
+        self.format = sniff_compressor_format(header)
+        counter_class = SIZE_COUNTERS.get(self.format)
+        if counter_class is None:
+            self.done = True
+        else:
+            self._counter = counter_class()
+
+    def result(self):
+        if self._counter is None and not self.done:
+            # File is smaller than the largest signature
+            data, self._buffer = self._buffer, b''
+            self._start(data)
+            if not self.done:
+                self.feed(data)
+        if self.format is None:
+            return {}
+        try:
+            if self._error is not None:
+                raise self._error
+            size = self._counter.close()
+            if not self._counter.verified:
+                test_with_compressor(self.filename, self.format)
+        except ValueError:
+            # Same fallback used by get_uncompressed_size
+            size = get_size_from_compressor(self.filename, self.format)
+        return {
+            'compressed': True,
+            'required-uncompressed-size': size,
+        }
@@ -0,0 +1,78 @@
+# Copyright (C) 2017 O.S. Systems Software LTDA.
+# SPDX-License-Identifier: GPL-2.0
+
+import hashlib
+from collections import OrderedDict
+
+from ..utils import call, get_chunk_size
+
+
+class DigestConsumer:
+    """Inspection consumer which computes sha256sum and MD5 digests."""
+
+    def __init__(self):
+        self.done = False  # all data is needed
+        self.sha256sum = hashlib.sha256()
+        self.md5 = hashlib.md5()
+
+    def feed(self, chunk):
+        self.sha256sum.update(chunk)
+        self.md5.update(chunk)
+
+    def result(self):
+        return self.sha256sum.hexdigest(), self.md5.hexdigest()
+
+
+class Inspection:
+    """Reads a file once, feeding every chunk to many consumers.
+
+    A consumer is anything that computes some value from file data
+    (digests, compression info, versions...). It must implement:
+
+    - feed(chunk): called for every chunk read, in order;
+    - done: True when consumer does not need more data;
+    - result(): returns the computed value after file is read.
+
+    Consumers are registered with the memo key under which their
+    result is going to be stored. Keys already present in memo are
+    not computed again, and if there is no consumer at all, the file
+    is not even opened.
+    """
+
+    def __init__(self, filename, memo):
+        self.filename = filename
+        self.memo = memo
+        self._consumers = OrderedDict()
+        self._hooks = {}
+
+    def want(self, key, consumer, hook=None):
+        """Registers consumer to generate the value of key.
+
+        If given, hook is called with the result after it is stored in
+        memo.
+        """
+        if key in self.memo or key in self._consumers:
+            return
+        self._consumers[key] = consumer
+        if hook is not None:
+            self._hooks[key] = hook
+
+    def run(self, callback=None):
+        """Reads file feeding consumers and stores results in memo."""
+        if not self._consumers:
+            return
+        consumers = list(self._consumers.values())
+        chunk_size = get_chunk_size()
+        with open(self.filename, 'rb') as fp:
+            for chunk in iter(lambda: fp.read(chunk_size), b''):
+                consumers = [c for c in consumers if not c.done]
+                if not consumers:
+                    break  # nobody is interested in the rest of file
+                for consumer in consumers:
+                    consumer.feed(chunk)
+                call(callback, 'object_read')
+        for key, consumer in self._consumers.items():
+            self.memo[key] = result = consumer.result()
+            hook = self._hooks.get(key)
+            if hook is not None:
+                hook(result)
@@ -1,12 +1,24 @@
 # Copyright (C) 2017 O.S. Systems Software LTDA.
 # SPDX-License-Identifier: GPL-2.0
 
+import lzma
+import mmap
+import os
 import re
 import string
 import struct
 import zlib
 from copy import deepcopy
 
+try:
+    import lz4.block
+    import lz4.frame
+except ImportError:
+    lz4 = None  # pylint: disable=invalid-name
+
+from ..utils import get_chunk_size, memoize
+from .compression import DECOMPRESS_CHUNK_SIZE
+
 
 # Utilities
 
@@ -31,57 +43,270 @@ def check(phrase, regexp):
         return results[0].decode()
 
 
+class VersionScanner:
+    """Finds a pattern within the printable strings of a byte stream.
+
+    Data is pushed through feed() as it is read, so the same stream
+    may be shared with other readers. Printable runs are found with a
+    compiled regexp, so scanning is linear on the stream size. A run
+    which reaches the end of a chunk is kept until it is terminated by
+    the next chunks. The result of the first printable string that
+    matches the pattern is kept in result.
+    """
+
+    RUN = re.compile(b'[' + re.escape(PRINTABLE) + b']+')
+
+    def __init__(self, pattern):
+        self.regexp = re.compile(pattern)
+        self.result = None
+        self.done = False
+        self._run = []  # pieces of an unterminated printable run
+
+    def feed(self, chunk):
+        """Scans chunk. Returns the result if found, None otherwise."""
+        if self.done:
+            return self.result
+        start = 0
+        if self._run:
+            match = self.RUN.match(chunk)
+            start = match.end() if match else 0
+            self._run.append(chunk[:start])
+            if start == len(chunk):
+                return None  # run goes on through the next chunk
+            if self._check(b''.join(self._run)):
+                return self.result
+        for match in self.RUN.finditer(chunk, start):
+            if match.end() == len(chunk):
+                self._run = [match.group()]
+                return None
+            if self._check(match.group()):
+                return self.result
+        self._run = []
+        return None
+
+    def _check(self, phrase):
+        self._run = []
+        self.result = check(phrase, self.regexp)
+        if self.result:
+            self.done = True
+        return self.done
+
+    def close(self):
+        """Scans the remaining data when stream is over."""
+        if not self.done:
+            self.result = check(b''.join(self._run), self.regexp)
+            self._run = []
+            self.done = True
+        return self.result
+
+
 def find(fp, pattern, iterable, seek=0):
     """Generic function to find some text in some iterable."""
     fp.seek(seek)
-    regexp = re.compile(pattern)
-    phrase = b''
+    scanner = VersionScanner(pattern)
     for chunk in iterable:
-        for char in chunk:
-            if char in PRINTABLE:
-                phrase += bytes([char])
-            else:
-                result = check(phrase, regexp)
-                if result:
-                    return result
-                phrase = b''
-    return check(phrase, regexp)
+        result = scanner.feed(chunk)
+        if result:
+            return result
+    return scanner.close()
 
 
 # Linux Kernel utilities
 
 ARM_Z_IMAGE = 0x016F2818
 ARM_U_IMAGE = 0x27051956
+ARM64_IMAGE = 0x644d5241  # "ARM\x64"
+FIT_IMAGE = 0xd00dfeed  # flattened device tree
 X86_BZ_IMAGE = (0xaa55, 1)
 X86_Z_IMAGE = (0xaa55, 0)
+LZ4_FRAME = 0x184d2204
+LZ4_LEGACY = 0x184c2102
+
+# All known kernel formats can be detected within this header
+KERNEL_HEADER_SIZE = 4096
+
+LINUX_VERSION_PATTERN = br'Linux version (\S+).*'
+
+# Errors raised by extractors when an image is corrupted
+# (lz4 raises RuntimeError on corrupted frames)
+KERNEL_ERRORS = (
+    zlib.error, lzma.LZMAError, struct.error, EOFError, IndexError) + (
+        (RuntimeError, lz4.block.LZ4BlockError) if lz4 is not None else ())
+
+
+def read_header(fp):
+    """Reads the first KERNEL_HEADER_SIZE bytes of a file."""
+    fp.seek(0)
+    return fp.read(KERNEL_HEADER_SIZE)
+
+
+def unpack(header, offset, type_):
+    """Retrives a value from header. Returns None if header is short."""
+    try:
+        return struct.unpack_from(type_, header, offset)[0]
+    except struct.error:
+        return None
+
+
+def match_arm_u_image(header):
+    return unpack(header, 0, '>I') == ARM_U_IMAGE
+
+
+def match_arm_z_image(header):
+    return unpack(header, 36, '<I') == ARM_Z_IMAGE
+
+
+def match_arm64_image(header):
+    return unpack(header, 56, '<I') == ARM64_IMAGE
+
+
+def match_fit_image(header):
+    return unpack(header, 0, '>I') == FIT_IMAGE
+
+
+def get_x86_generic_header_info(header):
+    data = unpack(header, 529, '<c')
+    compression = ord(data) if data is not None else None
+    return (unpack(header, 510, '<H'), compression)
+
+
+def match_x86_bz_image(header):
+    return get_x86_generic_header_info(header) == X86_BZ_IMAGE
+
+
+def match_x86_z_image(header):
+    return get_x86_generic_header_info(header) == X86_Z_IMAGE
+
+
+def match_gzip(header):
+    return header.startswith(b'\x1f\x8b\x08')
+
+
+def match_xz(header):
+    return header.startswith(b'\xfd7zXZ\x00')
+
+
+def match_lz4(header):
+    return unpack(header, 0, '<I') in (LZ4_FRAME, LZ4_LEGACY)
 
 
 def is_arm_u_image(fp):
     """Checks if an image is ARM uImage."""
-    return read(fp, 0, '>I', 4) == ARM_U_IMAGE
+    return match_arm_u_image(read_header(fp))
 
 
 def is_arm_z_image(fp):
     """Checks if an image is ARM zImage."""
-    return read(fp, 36, '<I', 4) == ARM_Z_IMAGE
+    return match_arm_z_image(read_header(fp))
 
 
 def get_x86_generic_image_info(fp):
     """Generic function to retrive Linux kernel info from x86 images."""
-    magic = read(fp, 510, '<H', 2)
-    data = read(fp, 529, '<c', 1)
-    compression = ord(data) if data is not None else None
-    return (magic, compression)
+    return get_x86_generic_header_info(read_header(fp))
 
 
 def is_x86_bz_image(fp):
     """Checks if an image is x86 bzImage."""
-    return get_x86_generic_image_info(fp) == X86_BZ_IMAGE
+    return match_x86_bz_image(read_header(fp))
 
 
 def is_x86_z_image(fp):
     """Checks if an image is x86 zImage."""
-    return get_x86_generic_image_info(fp) == X86_Z_IMAGE
+    return match_x86_z_image(read_header(fp))
+
+
+def find_marker(fp, marker, seek=0):
+    """Returns the offset of the first marker found in file.
+
+    File is read in fixed size windows, so memory usage does not grow
+    with file size. Returns None if marker is not found.
+    """
+    fp.seek(seek)
+    offset = seek
+    tail = b''
+    while True:
+        data = fp.read(get_chunk_size())
+        if not data:
+            return None
+        window = tail + data
+        index = window.find(marker)
+        if index != -1:
+            return offset - len(tail) + index
+        # Marker may be split between this window and the next one
+        tail = window[-(len(marker) - 1):]
+        offset += len(data)
+
+
+def gunzip(fp):
+    """Yields data uncompressed from the gzip stream at file position.
+
+    Both read and uncompressed data sizes are bounded and nothing is
+    read beyond what the consumer of this generator needs, so it can
+    stop as soon as it finds what it is looking for.
+    """
+    decompressor = zlib.decompressobj(zlib.MAX_WBITS | 16)
+    while not decompressor.eof:
+        data = fp.read(get_chunk_size())
+        if not data:
+            return
+        while data:
+            yield decompressor.decompress(data, DECOMPRESS_CHUNK_SIZE)
+            data = decompressor.unconsumed_tail
+
+
+def unlzma(fp, decompressor):
+    """Yields data uncompressed from a lzma (or alike) decompressor.
+
+    Works like gunzip() for decompressors with the LZMADecompressor
+    interface (lzma, bz2 and lz4 frames).
+    """
+    if not hasattr(decompressor, 'needs_input'):
+        # Python < 3.5 can't limit output size
+        for data in iter(lambda: fp.read(get_chunk_size()), b''):
+            yield decompressor.decompress(data)
+            if decompressor.eof:
+                return
+        return
+    while not decompressor.eof:
+        data = b''
+        if decompressor.needs_input:
+            data = fp.read(get_chunk_size())
+            if not data:
+                return
+        yield decompressor.decompress(data, DECOMPRESS_CHUNK_SIZE)
+
+
+def unlz4(fp):
+    """Yields data uncompressed from a lz4 (frame or legacy) stream.
+
+    lz4 support depends on the optional lz4 package.
+    """
+    if lz4 is None:
+        return
+    position = fp.tell()
+    magic = unpack(fp.read(4), 0, '<I')
+    if magic == LZ4_FRAME:
+        fp.seek(position)
+        yield from unlzma(fp, lz4.frame.LZ4FrameDecompressor())
+        return
+    # Legacy format: a sequence of compressed blocks which uncompress
+    # to 8 MiB at most, each one prefixed by its size
+    while True:
+        size = unpack(fp.read(4), 0, '<I')
+        if size is None or size == LZ4_LEGACY:
+            return
+        yield lz4.block.decompress(
+            fp.read(size), uncompressed_size=8 * 1024 * 1024)
+
+
+def read_range(fp, size):
+    """Yields size bytes read from file position."""
+    while size > 0:
+        data = fp.read(min(size, get_chunk_size()))
+        if not data:
+            return
+        size -= len(data)
+        yield data
 
 
 def get_arm_z_image_version(fp):
@@ -90,15 +315,12 @@ def get_arm_z_image_version(fp):
     # its version, we need find the compressed kernel, uncompress it,
     # and extract the version from the uncompressed data.
 
-    fp.seek(0)
     # "0x1f 0x8b 0x08" is the beginning of the gzipped kernel file
-    start = bytearray.fromhex('1f 8b 08 00 00 00 00 00')
-    # This could be improved so we don't have to read all file in memory
-    seek = fp.read().index(start)
-    pattern = br'Linux version (\S+).*'
-    decompressor = zlib.decompressobj(zlib.MAX_WBITS | 16)
-    iterable = iter(lambda: decompressor.decompress(fp.read(30)), b'')
-    return find(fp, pattern, iterable, seek)
+    start = bytes.fromhex('1f 8b 08 00 00 00 00 00')
+    seek = find_marker(fp, start)
+    if seek is None:
+        return None
+    return find(fp, LINUX_VERSION_PATTERN, gunzip(fp), seek)
 
 
 def get_arm_u_image_version(fp):
@@ -129,23 +351,251 @@ def get_x86_z_image_version(fp):
     return get_x86_generic_version(fp)
 
 
+def get_arm64_image_version(fp):
+    """Returns Linux kernel version of an uncompressed arm64 Image."""
+    return find(fp, LINUX_VERSION_PATTERN, read_range(fp, float('inf')))
+
+
+def get_gzip_image_version(fp):
+    """Returns Linux kernel version of a gzipped kernel (Image.gz)."""
+    return find(fp, LINUX_VERSION_PATTERN, gunzip(fp))
+
+
+def get_xz_image_version(fp):
+    """Returns Linux kernel version of a xz compressed kernel."""
+    decompressor = lzma.LZMADecompressor(format=lzma.FORMAT_XZ)
+    return find(fp, LINUX_VERSION_PATTERN, unlzma(fp, decompressor))
+
+
+def get_lz4_image_version(fp):
+    """Returns Linux kernel version of a lz4 compressed kernel."""
+    return find(fp, LINUX_VERSION_PATTERN, unlz4(fp))
+
+
+# Flattened device tree structure tokens
+FDT_BEGIN_NODE = 1
+FDT_END_NODE = 2
+FDT_PROP = 3
+FDT_NOP = 4
+FDT_END = 9
+
+
+def _align(value):
+    return (value + 3) & ~3
+
+
+def get_fit_kernel(fp):
+    """Finds the kernel within a FIT image.
+
+    Device tree structure is walked looking for the first /images
+    subnode whose type is "kernel". Property values are read only
+    when small, so the kernel data itself is never read here.
+
+    Returns a tuple with the kernel data offset, its size and its
+    compression, or None if there is no kernel or the tree is
+    malformed.
+    """
+    fp.seek(0)
+    header = fp.read(40)
+    if len(header) < 36:
+        return None
+    (_, total_size, struct_offset, strings_offset, _,
+     _, _, _, strings_size) = struct.unpack_from('>9I', header)
+    fp.seek(strings_offset)
+    strings = fp.read(strings_size)
+    offset = struct_offset
+    path, nodes = [], []
+    while True:
+        fp.seek(offset)
+        token = unpack(fp.read(4), 0, '>I')
+        offset += 4
+        if token == FDT_BEGIN_NODE:
+            name = fp.read(256).split(b'\0', 1)[0]
+            offset += _align(len(name) + 1)
+            path.append(name)
+            nodes.append({})
+        elif token == FDT_END_NODE and nodes:
+            props = nodes.pop()
+            if (len(path) == 3 and path[1] == b'images' and
+                    props.get(b'type', b'').rstrip(b'\0') == b'kernel'):
+                return _get_fit_kernel_data(total_size, props)
+            path.pop()
+        elif token == FDT_PROP and nodes:
+            prop = _read_fit_prop(fp, strings, offset)
+            if prop is None:
+                return None  # truncated tree
+            name, value, offset = prop
+            if value is not None:
+                nodes[-1][name] = value
+        elif token == FDT_NOP:
+            continue
+        else:  # FDT_END or a corrupted tree
+            return None
+
+
+def _read_fit_prop(fp, strings, offset):
+    """Reads the FDT property at offset (just after its token).
+
+    Returns a tuple with the property name, its value and the offset
+    of the next token. Value is an (offset, size) tuple for kernel
+    data, the property bytes if small or None otherwise.
+    """
+    data = fp.read(8)
+    size = unpack(data, 0, '>I')
+    name_offset = unpack(data, 4, '>I')
+    if name_offset is None:
+        return None
+    name = strings[name_offset:].split(b'\0', 1)[0]
+    offset += 8
+    value = None
+    if name == b'data':
+        value = (offset, size)
+    elif size <= 256:
+        value = fp.read(size)
+    return name, value, offset + _align(size)
+
+
+def _get_fit_kernel_data(total_size, props):
+    compression = props.get(b'compression', b'none').rstrip(b'\0')
+    size = unpack(props.get(b'data-size', b''), 0, '>I')
+    if b'data' in props:
+        offset, size = props[b'data']
+    elif b'data-offset' in props:
+        # External data (mkimage -E) starts right after the tree
+        offset = unpack(props[b'data-offset'], 0, '>I')
+        if offset is not None:
+            offset += _align(total_size)
+    else:
+        offset = unpack(props.get(b'data-position', b''), 0, '>I')
+    if offset is None or size is None:
+        return None
+    return offset, size, compression.decode(errors='replace')
+
+
+class FileSlice:
+    """Read-only file object over a region of another file.
+
+    It allows kernel images embedded in other images (like FIT) to
+    be handled by the same functions used for standalone images.
+    """
+
+    def __init__(self, fp, offset, size):
+        self._fp = fp
+        self._offset = offset
+        self._size = size
+        self._position = 0
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self._position
+        elif whence == os.SEEK_END:
+            offset += self._size
+        self._position = max(0, offset)
+        return self._position
+
+    def tell(self):
+        return self._position
+
+    def read(self, size=-1):
+        left = max(0, self._size - self._position)
+        if size is None or size < 0 or size > left:
+            size = left
+        self._fp.seek(self._offset + self._position)
+        data = self._fp.read(size)
+        self._position += len(data)
+        return data
+
+
+def get_fit_image_version(fp):
+    """Returns Linux kernel version of a FIT image.
+
+    Uncompressed kernels are handled as standalone images, so any
+    known kernel format can be embedded in a FIT image.
+    """
+    kernel = get_fit_kernel(fp)
+    if kernel is None:
+        return None
+    offset, size, compression = kernel
+    if compression == 'none':
+        version = get_known_kernel_version(FileSlice(fp, offset, size))
+        if version is not None:
+            return version
+    fp.seek(offset)
+    if compression == 'none':
+        iterable = read_range(fp, size)
+    elif compression == 'gzip':
+        iterable = gunzip(fp)
+    elif compression == 'lzma':
+        iterable = unlzma(fp, lzma.LZMADecompressor(lzma.FORMAT_ALONE))
+    elif compression == 'lz4':
+        iterable = unlz4(fp)
+    else:
+        return None
+    return find(fp, LINUX_VERSION_PATTERN, iterable, offset)
+
+
 # Linux Kernel
 
+# Known kernel formats, in detection order. Each one is registered as
+# a (name, match, extract) tuple, where match receives the first
+# KERNEL_HEADER_SIZE bytes of the image and extract receives the
+# image file.
+KERNEL_FORMATS = [
+    ('arm-uImage', match_arm_u_image, get_arm_u_image_version),
+    ('arm-zImage', match_arm_z_image, get_arm_z_image_version),
+    ('x86-bzImage', match_x86_bz_image, get_x86_bz_image_version),
+    ('x86-zImage', match_x86_z_image, get_x86_z_image_version),
+    ('arm64-Image', match_arm64_image, get_arm64_image_version),
+    ('FIT', match_fit_image, get_fit_image_version),
+    ('gzip', match_gzip, get_gzip_image_version),
+    ('xz', match_xz, get_xz_image_version),
+    ('lz4', match_lz4, get_lz4_image_version),
+]
+
+
+def register_kernel_format(name, match, extract, index=None):
+    """Registers a new kernel format for get_kernel_version.
+
+    Formats are tried in KERNEL_FORMATS order. By default, a new
+    format is tried last, after the generic gzip, xz and lz4 formats,
+    which match any compressed file; use index to try it before them.
+    """
+    if index is None:
+        index = len(KERNEL_FORMATS)
+    KERNEL_FORMATS.insert(index, (name, match, extract))
+
+
+def get_kernel_format(header):
+    """Returns the name of the first kernel format matching header."""
+    for name, match, _ in KERNEL_FORMATS:
+        if match(header):
+            return name
+    return None
+
+
+def get_known_kernel_version(fp):
+    """Returns Linux kernel version, or None if it can't be found.
+
+    Image header is read once and dispatched to the extractor of the
+    first format it matches. Images which look like a known format but
+    are corrupted are skipped.
+    """
+    header = read_header(fp)
+    for _, match, extract in KERNEL_FORMATS:
+        if not match(header):
+            continue
+        try:
+            result = extract(fp)
+        except KERNEL_ERRORS:
+            continue
+        if result is not None:
+            return result
+    return None
+
+
 def get_kernel_version(fp):
     """Returns Linux kernel object version."""
-    result = None
-    # ARM uImage
-    if is_arm_u_image(fp):
-        result = get_arm_u_image_version(fp)
-    # ARM zImage
-    if is_arm_z_image(fp):
-        result = get_arm_z_image_version(fp)
-    # x86 bzImage
-    if is_x86_bz_image(fp):
-        result = get_x86_bz_image_version(fp)
-    # x86 zImage
-    if is_x86_z_image(fp):
-        result = get_x86_z_image_version(fp)
+    result = get_known_kernel_version(fp)
     if result is not None:
         return result
     raise ValueError('Cannot retrive kernel version')
@@ -153,11 +603,83 @@ def get_kernel_version(fp):
 
 # U-Boot
 
+UBOOT_PATTERN = br'U-Boot(?: SPL)? (\S+) \(.*\)'
+
+# UBOOT_PATTERN restricted to printable characters, so it can be
+# searched directly over the whole image with the same result of
+# scanning it printable string by printable string.
+UBOOT_REGEXP = re.compile(
+    br'U-Boot(?: SPL)? ([!-~]+) \([\t\x0b\x0c\r -~]*\)')
+
+# Window size used when image can't be memory mapped
+UBOOT_WINDOW_SIZE = 1024 * 1024  # 1 MiB
+
+
+class UBootScanner:
+    """Searches UBOOT_REGEXP directly over the chunks of a byte stream.
+
+    Since UBOOT_REGEXP only matches printable characters, a match can't
+    cross a non-printable byte. So, only the trailing printable run of
+    each chunk, starting at its first "U-Boot", is carried to the next
+    one. Has the same interface of VersionScanner.
+    """
+
+    NON_PRINTABLE = re.compile(b'[^' + re.escape(PRINTABLE) + b']')
+    PREFIX = b'U-Boot'
+
+    def __init__(self):
+        self.result = None
+        self.done = False
+        self._tail = b''
+
+    def feed(self, chunk):
+        """Scans chunk. Returns the result if found, None otherwise."""
+        if self.done:
+            return self.result
+        data = self._tail + chunk
+        match = UBOOT_REGEXP.search(data)
+        if match:
+            self._tail = b''
+            self.result = match.group(1).decode()
+            self.done = True
+            return self.result
+        self._tail = self._carry(data)
+        return None
+
+    def _carry(self, data):
+        start = data.find(self.PREFIX)
+        while start != -1:
+            stop = self.NON_PRINTABLE.search(data, start)
+            if stop is None:
+                return data[start:]
+            start = data.find(self.PREFIX, stop.end())
+        # The chunk may end with the beginning of a "U-Boot"
+        return data[-(len(self.PREFIX) - 1):]
+
+    def close(self):
+        """Finishes scanning when stream is over."""
+        self._tail = b''
+        self.done = True
+        return self.result
+
+
 def get_uboot_version(fp):
-    """Returns U-Boot object version."""
-    pattern = br'U-Boot(?: SPL)? (\S+) \(.*\)'
-    iterable = iter(lambda: fp.read(30), b'')
-    result = find(fp, pattern, iterable, 0)
+    """Returns U-Boot object version.
+
+    Image is memory mapped and searched at once, stopping on the first
+    match. If it can't be mapped, it is scanned in large windows.
+    """
+    try:
+        with mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            match = UBOOT_REGEXP.search(data)
+            result = match.group(1).decode() if match else None
+    except (OSError, ValueError):  # not a regular file or empty file
+        fp.seek(0)
+        scanner = UBootScanner()
+        for window in iter(lambda: fp.read(UBOOT_WINDOW_SIZE), b''):
+            if scanner.feed(window):
+                break
+        result = scanner.close()
     if result is not None:
         return result
     raise ValueError('Cannot retrive U-Boot version')
@@ -185,6 +707,47 @@ def get_version(fn, type_, **kwargs):
             return get_object_version(fp, **kwargs)
 
 
+def version_key(fn, type_, **kwargs):
+    """Returns the key used to memoize a version read from a file."""
+    return ('version', os.path.realpath(fn), type_,
+            tuple(sorted(kwargs.items())))
+
+
+class VersionConsumer:
+    """Inspection consumer which extracts an object version.
+
+    Only patterns which can be found by scanning the object from a
+    given offset are supported (U-Boot and custom regexps). A scanner
+    other than VersionScanner(pattern) may be given.
+    """
+
+    def __init__(self, pattern=None, seek=0, error='Cannot retrive version',
+                 scanner=None):
+        if scanner is None:
+            scanner = VersionScanner(pattern)
+        self.scanner = scanner
+        self.seek = seek
+        self.error = error
+        self.offset = 0
+
+    @property
+    def done(self):
+        return self.scanner.done
+
+    def feed(self, chunk):
+        start = self.offset
+        self.offset += len(chunk)
+        if self.offset <= self.seek:
+            return
+        self.scanner.feed(chunk[max(0, self.seek - start):])
+
+    def result(self):
+        version = self.scanner.close()
+        if version is None:
+            raise ValueError(self.error)
+        return version
+
+
 def normalize_install_if_different(values):
     """Converts metadata install-if-different key to install-condition."""
     values = deepcopy(values)
@@ -240,11 +803,12 @@ class InstallCondition:  # pylint: disable=too-few-public-methods
     CONTENT_DIVERGES = 'content-diverges'
     VERSION_DIVERGES = 'version-diverges'
 
-    def __init__(self, metadata):
+    def __init__(self, metadata, memo=None):
         self.filename = metadata['filename']
         self.condition = metadata.pop('install-condition', None)
         self.metadata = metadata
         self.pattern = None
+        self.memo = memo
 
     def to_metadata(self):
         if self.condition == self.CONTENT_DIVERGES:
@@ -267,16 +831,16 @@ class InstallCondition:  # pylint: disable=too-few-public-methods
     def _metadata_known_pattern(self):
         return self._format_metadata({
             'pattern': self.pattern,
-            'version': get_version(self.filename, self.pattern),
+            'version': self._get_version(self.pattern),
         })
 
     def _metadata_custom_pattern(self):
         regexp = self.metadata.pop('install-condition-pattern')
         seek = self.metadata.pop('install-condition-seek')
         buffer_size = self.metadata.pop('install-condition-buffer-size')
-        version = get_version(
-            self.filename, CUSTOM_PATTERN, pattern=regexp.encode(),
-            seek=seek, buffer_size=buffer_size)
+        version = self._get_version(
+            CUSTOM_PATTERN, **self._custom_pattern_kwargs(
+                regexp, seek, buffer_size))
         return self._format_metadata({
             'version': version,
             'pattern': {
@@ -286,5 +850,47 @@ class InstallCondition:  # pylint: disable=too-few-public-methods
             },
         })
 
+    @staticmethod
+    def _custom_pattern_kwargs(regexp, seek, buffer_size):
+        return {
+            'pattern': regexp.encode(),
+            'seek': seek,
+            'buffer_size': buffer_size,
+        }
+
+    def _get_version(self, type_, **kwargs):
+        # Objects may share the same file with different patterns, so
+        # versions are memoized by file and by all pattern options.
+        key = version_key(self.filename, type_, **kwargs)
+        return memoize(
+            self.memo, key, get_version, self.filename, type_, **kwargs)
+
+    def inspect(self, inspection):
+        """Registers in inspection the consumer to read object version.
+
+        Linux kernel versions are not read this way, since kernel
+        images must be randomly accessed.
+        """
+        if self.condition != self.VERSION_DIVERGES:
+            return
+        pattern = self.metadata.get('install-condition-pattern-type')
+        if pattern == 'u-boot':
+            key = version_key(self.filename, pattern)
+            consumer = VersionConsumer(
+                scanner=UBootScanner(),
+                error='Cannot retrive U-Boot version')
+        elif pattern == CUSTOM_PATTERN:
+            kwargs = self._custom_pattern_kwargs(
+                self.metadata.get('install-condition-pattern'),
+                self.metadata.get('install-condition-seek'),
+                self.metadata.get('install-condition-buffer-size'))
+            key = version_key(self.filename, pattern, **kwargs)
+            consumer = VersionConsumer(
+                kwargs['pattern'], seek=kwargs['seek'],
+                error='Cannot retrive object version')
+        else:
+            return
+        inspection.want(key, consumer)
+
     def _format_metadata(self, value):
         return {self.METADATA_KEY: value}
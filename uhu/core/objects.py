@@ -1,12 +1,16 @@
 # Copyright (C) 2017 O.S. Systems Software LTDA.
 # SPDX-License-Identifier: GPL-2.0
 
+import os
+from collections import OrderedDict
 from itertools import chain
 
+from .inspection import Inspection
 from .object import Object
 from ._options import Options
 
-from ..utils import call, list_to_str
+from ..cache import cache
+from ..utils import call, list_to_str, parallel_map
 
 
 class ObjectsManager:
@@ -46,12 +50,29 @@ class ObjectsManager:
             raise ValueError(error.format(self.MIN_N_SETS, self.MAX_N_SETS))
         return n_sets
 
-    def load(self, callback=None):
+    def load(self, callback=None, jobs=None):
+        """Loads all objects.
+
+        Distinct files are loaded concurrently by a pool of jobs
+        threads (see uhu.utils.get_jobs).
+        """
         call(callback, 'start_objects_load')
-        for obj in self.all():
-            obj.load(callback=callback)
+        memo = {}
+
+        def load_group(objs):
+            for obj in objs:
+                obj.load(callback=callback, memo=memo)
+        parallel_map(load_group, self.group_by_file().values(), jobs)
+        cache.flush()
         call(callback, 'finish_objects_load')
 
+    def group_by_file(self):
+        """Groups all objects by the real path of their files."""
+        groups = OrderedDict()
+        for obj in self.all():
+            groups.setdefault(os.path.realpath(obj.filename), []).append(obj)
+        return groups
+
     def create(self, options):
         """Creates a new object in all installation sets."""
         normalized_options = self._normalize_create_options_values(options)
@@ -122,9 +143,30 @@ class ObjectsManager:
         """Checks if it is single mode."""
         return self.n_sets == 1
 
-    def to_metadata(self, callback=None):
+    def to_metadata(self, callback=None, memo=None, jobs=None):
+        """Serializes all installation sets as metadata.
+
+        Objects are grouped by their real path through memo, so each
+        physical file is read only once even when it is listed in many
+        installation sets: values needed by all of them are computed in
+        a single read. Distinct files are inspected concurrently by a
+        pool of jobs threads; metadata is then serialized in order from
+        memo, so it does not depend on jobs.
+        """
+        memo = {} if memo is None else memo
+
+        def inspect_group(objs):
+            inspection = Inspection(objs[0].filename, memo)
+            for obj in objs:
+                obj.inspect(inspection)
+            inspection.run(callback)
+            for obj in objs:
+                obj.to_metadata(callback, memo)
+        parallel_map(inspect_group, self.group_by_file().values(), jobs)
+        cache.flush()
+
         sets = self._to_list_of_sets()
-        objects = [[obj.to_metadata(callback) for obj in set_]
+        objects = [[obj.to_metadata(callback, memo) for obj in set_]
                    for set_ in sets]
         return {self.metadata: objects}
 
@@ -1,13 +1,17 @@
 # Copyright (C) 2017 O.S. Systems Software LTDA.
 # SPDX-License-Identifier: GPL-2.0
 
-from uhu.updatehub.api import push_package
-from uhu.utils import call
+from uhu.updatehub.api import push_package, UpdateHubError
+from uhu.utils import call, parallel_map
 
 from .hardware import SupportedHardwareManager
 from .objects import ObjectsManager
 
 
+# How many packages push_packages pushes at the same time
+DEFAULT_PACKAGE_JOBS = 4
+
+
 class Package:
     """A package represents a group of objects."""
 
@@ -24,14 +28,19 @@ class Package:
             self.supported_hardware = SupportedHardwareManager(dump=dump)
         self.uid = None
 
-    def to_metadata(self, callback=None):
-        """Serialize package as metadata."""
+    def to_metadata(self, callback=None, jobs=None, memo=None):
+        """Serialize package as metadata.
+
+        Values read from object files are stored in memo (see
+        ObjectsManager.to_metadata), which may be shared by packages.
+        """
         metadata = {
             'product': self.product,
             'version': self.version,
         }
         metadata.update(self.supported_hardware.to_metadata())
-        metadata.update(self.objects.to_metadata(callback))
+        metadata.update(
+            self.objects.to_metadata(callback, memo=memo, jobs=jobs))
         return metadata
 
     def to_template(self, with_version=True):
@@ -42,13 +51,24 @@ class Package:
         template.update(self.supported_hardware.to_template())
         return template
 
-    def push(self, callback=None):
-        """Uploads package to UpdateHub server."""
+    def push(self, callback=None, jobs=None, upload_jobs=None,
+             engine='threads', memo=None):
+        """Uploads package to UpdateHub server.
+
+        Requests are sent by a pool of threads or, if engine is
+        'asyncio', by an event loop (see uhu.updatehub.aio). memo is
+        passed to to_metadata.
+        """
         call(callback, 'start_objects_load')
-        metadata = self.to_metadata(callback)
+        metadata = self.to_metadata(callback, jobs, memo)
         call(callback, 'finish_objects_load')
         objects = self.objects.to_upload()
-        self.uid = push_package(metadata, objects, callback)
+        push = push_package
+        if engine == 'asyncio':
+            # aio needs Python 3.5, so it is imported only when used
+            from uhu.updatehub import aio
+            push = aio.push_package
+        self.uid = push(metadata, objects, callback, upload_jobs)
         return self.uid
 
     def __str__(self):
@@ -58,3 +78,38 @@ class Package:
             str(self.supported_hardware),
             str(self.objects),
         ])
+
+
+def push_packages(packages, callback=None, jobs=None, upload_jobs=None,
+                  package_jobs=None):
+    """Pushes many packages to UpdateHub server.
+
+    Objects of all packages are loaded first, sharing a memo, so a
+    file listed by many packages is read only once. Packages are then
+    pushed by package_jobs threads, which share the connection pool
+    of the UpdateHub session. Returns, for each package, its uid or
+    the UpdateHubError which made its push fail. Packages whose
+    objects can not be loaded are not pushed.
+    """
+    memo = {}
+    errors = {}
+    call(callback, 'start_objects_load')
+    for index, package in enumerate(packages):
+        try:
+            package.to_metadata(callback, jobs, memo)
+        except Exception as error:  # pylint: disable=broad-except
+            errors[index] = UpdateHubError(
+                'Could not load package objects: {}'.format(error))
+    call(callback, 'finish_objects_load')
+
+    def push(item):
+        index, package = item
+        if index in errors:
+            return errors[index]
+        try:
+            return package.push(upload_jobs=upload_jobs, memo=memo)
+        except UpdateHubError as error:
+            return error
+    if package_jobs is None:
+        package_jobs = DEFAULT_PACKAGE_JOBS
+    return parallel_map(push, enumerate(packages), package_jobs)
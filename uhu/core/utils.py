@@ -3,13 +3,15 @@
 
 import json
 import os
-import zipfile
+import stat
+import tempfile
 from collections import OrderedDict
 
 import pkgschema
 
 from ..config import config
-from ..utils import sign_dict
+from ..utils import canonical_json, sign_bytes
+from .archive import ArchiveWriter, COMPRESSIONS
 
 
 def dump_package(package, fn):
@@ -33,46 +35,110 @@ def _generate_archive_name(package, output):
     return '{0.product}-{0.version}.uhupkg'.format(package)
 
 
-def dump_package_archive(package, output=None, force=False):
-    """Saves package as an archive. Returns genereted archive filename.
-
-    Generated archive is a gz compressed tar file with current package
-    metadata and all objects files.
-
-    All objects are renamed to its hash and moved to the archive
-    root. Objects are included without duplication and links are
-    resolved.
-    """
-    # Checks minimum package requirements
+def _check_archive_package(package, compression):
+    """Checks minimum package requirements to archive it."""
     if package.version is None:
         raise ValueError('Cannot generate archive without package version.')
     if package.product is None:
         raise ValueError('Cannot generate archive without product UID.')
     if not package.objects.all():
         raise ValueError('Cannot generate archive without objects.')
+    if compression is not None and compression not in COMPRESSIONS:
+        raise ValueError(
+            'Unknown archive compression: {}.'.format(compression))
+
+
+def _sign_archive_metadata(package, memo, jobs):
+    """Returns package metadata, as stored in archive, and its signature."""
+    metadata = package.to_metadata(jobs=jobs, memo=memo)
     # Checks metadata complience
-    metadata = package.to_metadata()
     try:
         pkgschema.validate_metadata(metadata)
     except pkgschema.ValidationError:
         raise ValueError('Cannot generate archive with invalid metadata.')
+    metadata = canonical_json(metadata)
+    return metadata, sign_bytes(metadata, config.get_private_key_path())
+
+
+def _is_stream(fn):
+    """Checks if fn is an existing FIFO, socket or character device."""
+    try:
+        return not stat.S_ISREG(os.stat(fn).st_mode)
+    except FileNotFoundError:
+        return False
+
+
+def _get_umask():
+    umask = os.umask(0)
+    os.umask(umask)
+    return umask
+
+
+def dump_package_archive(package, output=None, force=False, jobs=None,
+                         compression=None):
+    """Saves package as an archive. Returns genereted archive filename.
+
+    Generated archive is a zip file with current package metadata and
+    all objects files.
+
+    All objects are renamed to its hash and moved to the archive
+    root. Objects are included without duplication and links are
+    resolved. Each object file is read only once, while it is written
+    (see ArchiveWriter); archive is built in a temporary file, which
+    replaces output only if package is valid.
+
+    Entries may be compressed with any of archive.COMPRESSIONS by a
+    pool of jobs threads.
+
+    If output is a FIFO (or any other file which is not a regular
+    file), archive is streamed to it (see stream_package_archive).
+    """
+    _check_archive_package(package, compression)
 
     # Checks archive output
     output = _generate_archive_name(package, output)
+    if _is_stream(output):
+        with open(output, 'wb') as fp:
+            stream_package_archive(package, fp, jobs, compression)
+        return output
     if os.path.exists(output) and not force:
         raise FileExistsError('Archive "{}" already exists.'.format(output))
 
     # Writes archive
-    cache = set()
-    signature = sign_dict(metadata, config.get_private_key_path())
-    metadata = json.dumps(metadata, sort_keys=True)
-    with zipfile.ZipFile(output, mode='w') as archive:
-        archive.writestr('signature', signature)
-        archive.writestr('metadata', metadata)
-        for obj in package.objects.all():
-            sha256sum = obj['sha256sum']
-            if sha256sum in cache:
-                continue
-            cache.add(sha256sum)
-            archive.write(os.path.realpath(obj.filename), sha256sum)
+    descriptor, tmp = tempfile.mkstemp(
+        dir=os.path.dirname(os.path.abspath(output)), suffix='.tmp')
+    os.close(descriptor)
+    try:
+        memo = {}
+        with ArchiveWriter(tmp, compression, jobs) as writer:
+            writer.add(package.objects.group_by_file().values(), memo)
+            writer.finish(*_sign_archive_metadata(package, memo, jobs))
+        # Archive gets the mode a new file would (mkstemp creates 0600)
+        os.chmod(tmp, 0o666 & ~_get_umask())
+        os.replace(tmp, output)
+    except BaseException:
+        os.remove(tmp)
+        raise
     return output
+
+
+def stream_package_archive(package, fp, jobs=None, compression=None):
+    """Writes package archive to a binary file object, as a stream.
+
+    fp need not be seekable (e.g. stdout, a pipe or a socket file):
+    entries are written only once, with data descriptors, and zip64
+    extensions are used whenever sizes or offsets need them. zipfile
+    writes to unseekable files since Python 3.5.
+
+    Since entry names must be known before entries are written,
+    package metadata is computed (and validated) first, by a pool of
+    jobs threads; objects whose digests are not cached are read twice.
+    Entries are then compressed one at a time, since compressing them
+    in parallel would stage them on disk.
+    """
+    _check_archive_package(package, compression)
+    memo = {}
+    metadata, signature = _sign_archive_metadata(package, memo, jobs)
+    with ArchiveWriter(fp, compression, jobs=1) as writer:
+        writer.add(package.objects.group_by_file().values(), memo)
+        writer.finish(metadata, signature)
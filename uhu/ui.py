@@ -3,6 +3,7 @@
 
 import math
 import sys
+import threading
 
 from progress.spinner import Spinner
 from progress.bar import Bar
@@ -13,11 +14,14 @@ class BaseCallback:
     def __init__(self):
         self.uploading = False
         self.max = None
+        # Objects may be read by many threads at once
+        self._lock = threading.Lock()
 
     def object_read(self, n_steps=1):
         """Calls self._object_read for n_steps needed."""
-        for _ in range(n_steps):
-            self._object_read()
+        with self._lock:
+            for _ in range(n_steps):
+                self._object_read()
 
     def _object_read(self):
         if self.uploading:
@@ -10,6 +10,7 @@ import requests
 from .. import get_version
 from ..config import config
 
+from ._session import get_session
 from .auth import UHV1Signature
 
 
@@ -17,6 +18,10 @@ class HTTPError(requests.RequestException):
     """A generic error for HTTP requests."""
 
 
+class TransientHTTPError(HTTPError):
+    """A request error which may not happen if request is retried."""
+
+
 class Request:
 
     # pylint: disable=too-many-arguments
@@ -92,10 +97,14 @@ class Request:
         """
         return {header: str(self.headers[header]) for header in self.headers}
 
-    def send(self):
+    def prepare(self):
+        """Signs request and returns the headers to be sent."""
         self._sign()
-        headers = self._prepare_headers()
-        response = requests.request(
+        return self._prepare_headers()
+
+    def send(self):
+        headers = self.prepare()
+        response = get_session().request(
             self.method,
             self.url,
             headers=headers,
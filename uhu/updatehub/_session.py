@@ -0,0 +1,53 @@
+# Copyright (C) 2017 O.S. Systems Software LTDA.
+# SPDX-License-Identifier: GPL-2.0
+
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from ..utils import get_http_pool_size
+
+
+# Number of hosts whose connections are kept (UpdateHub server and
+# storage services)
+POOL_CONNECTIONS = 4
+
+_session = None  # pylint: disable=invalid-name
+_lock = threading.Lock()  # pylint: disable=invalid-name
+
+
+def create_session():
+    """Creates a session which pools connections.
+
+    Connections are kept alive and reused between requests to the same
+    host, so TCP and TLS handshakes happen once per connection instead
+    of once per request. Each host gets at most UHU_HTTP_POOL_SIZE
+    connections; requests beyond that wait for a free connection.
+    """
+    session = requests.Session()
+    pool_size = get_http_pool_size()
+    for prefix in ('http://', 'https://'):
+        session.mount(prefix, HTTPAdapter(
+            pool_connections=POOL_CONNECTIONS,
+            pool_maxsize=pool_size,
+            pool_block=True))
+    return session
+
+
+def get_session():
+    """Returns the session shared by all UpdateHub requests."""
+    global _session  # pylint: disable=global-statement,invalid-name
+    with _lock:
+        if _session is None:
+            _session = create_session()
+        return _session
+
+
+def close_session():
+    """Closes shared session and all its pooled connections."""
+    global _session  # pylint: disable=global-statement,invalid-name
+    with _lock:
+        if _session is not None:
+            _session.close()
+            _session = None
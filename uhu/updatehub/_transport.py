@@ -0,0 +1,108 @@
+# Copyright (C) 2017 O.S. Systems Software LTDA.
+# SPDX-License-Identifier: GPL-2.0
+
+import http.client
+import io
+import socket
+from urllib.parse import urlparse
+
+import requests
+from requests.structures import CaseInsensitiveDict
+
+
+# Smaller bodies are sent through the pooled session, since the copies
+# saved would not pay for a new connection
+SENDFILE_MIN_SIZE = 1024 * 1024  # bytes
+
+# socket.sendfile exists since Python 3.5
+SENDFILE_SUPPORTED = hasattr(socket.socket, 'sendfile')
+
+# Size of each sendfile call
+SEND_BUFFER_SIZE = 1024 * 1024  # bytes
+
+TIMEOUT = 30  # seconds
+
+
+def accepts(url, data):
+    """Checks if data can be sent to url by this transport.
+
+    data must be a reader which knows how to send itself to a socket
+    (see send_file). Only plain HTTP is accepted: TLS encrypts data in
+    user space, so nothing would be saved by leaving the pooled session
+    (and its warm TLS connections). Requests through proxies, or on
+    Pythons without socket.sendfile, are left to requests.
+    """
+    try:
+        scheme = urlparse(url).scheme
+    except ValueError:
+        return False
+    return (SENDFILE_SUPPORTED and
+            hasattr(data, 'send_to') and
+            len(data) >= SENDFILE_MIN_SIZE and
+            scheme == 'http' and
+            not requests.utils.get_environ_proxies(url))
+
+
+def send_file(sock, descriptor, offset, size, progress=None):
+    """Sends size bytes from file descriptor, starting at offset.
+
+    File is sent by the kernel with sendfile and never copied into
+    Python. progress, if given, is called with the number of bytes
+    already sent after every sendfile call.
+    """
+    # socket.sendfile deals with socket timeouts, but it moves file
+    # offset; descriptor offset is never used by readers, so it is safe
+    with open(descriptor, 'rb', closefd=False) as fp:
+        sent = 0
+        while sent < size:
+            count = min(SEND_BUFFER_SIZE, size - sent)
+            written = sock.sendfile(fp, offset + sent, count)
+            if written == 0:
+                raise requests.ConnectionError('File was truncated.')
+            sent += written
+            if progress is not None:
+                progress(sent)
+
+
+def send(method, url, data, headers=None):
+    """Sends a request whose body is sent by data reader.
+
+    Errors are raised as the equivalent requests exceptions and a
+    requests.Response is returned, so callers can't tell this
+    transport from a requests session.
+    """
+    parsed = urlparse(url)
+    target = parsed.path or '/'
+    if parsed.query:
+        target = '{}?{}'.format(target, parsed.query)
+    connection = http.client.HTTPConnection(parsed.netloc, timeout=TIMEOUT)
+    try:
+        connection.putrequest(method, target, skip_accept_encoding=True)
+        connection.putheader('Content-Length', str(len(data)))
+        for header, value in (headers or {}).items():
+            connection.putheader(header, value)
+        connection.endheaders()
+        data.send_to(connection.sock)
+        raw = connection.getresponse()
+        content = raw.read()
+    except socket.timeout as error:
+        raise requests.Timeout(error)
+    except (OSError, http.client.HTTPException) as error:
+        raise requests.ConnectionError(error)
+    finally:
+        connection.close()
+    return build_response(
+        url, raw.status, raw.reason, raw.getheaders(), content)
+
+
+def build_response(url, status, reason, headers, content):
+    """Builds a requests.Response from an already read response."""
+    response = requests.Response()
+    response.status_code = status
+    response.reason = reason
+    response.headers = CaseInsensitiveDict(headers)
+    response.encoding = requests.utils.get_encoding_from_headers(
+        response.headers)
+    response.raw = io.BytesIO(content)
+    response.url = url
+    return response
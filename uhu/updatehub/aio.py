@@ -0,0 +1,232 @@
+# Copyright (C) 2017 O.S. Systems Software LTDA.
+# SPDX-License-Identifier: GPL-2.0
+
+"""asyncio push engine.
+
+Pushes packages like uhu.updatehub.api does, but every request is a
+task of a single event loop instead of a blocking call in a thread:
+one thread drives all in flight requests. It depends on the optional
+aiohttp package.
+"""
+
+import asyncio
+import io
+import itertools
+import ssl
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None  # pylint: disable=invalid-name
+
+from ..utils import (
+    call, get_custom_ca_certs_file, get_http_pool_size, get_retries,
+    get_server_url, get_upload_jobs)
+from . import http
+from ._request import Request
+from ._transport import build_response, TIMEOUT
+from .api import (
+    ObjectReader, ObjectUploadResult, UpdateHubError, check_object,
+    check_upload_results, finishing_package, metadata_errors,
+    parse_object_check, prepare_metadata, push_objects, set_stored,
+    upload_to_storage)
+
+
+# Utilities
+
+def create_session():
+    """Creates a session which pools connections (see _session)."""
+    cafile = get_custom_ca_certs_file()
+    connector = aiohttp.TCPConnector(
+        limit_per_host=get_http_pool_size(),
+        ssl=ssl.create_default_context(cafile=cafile))
+    # Uploads may take much longer than any timeout, only stalled
+    # connections time out
+    timeout = aiohttp.ClientTimeout(
+        total=None, sock_connect=TIMEOUT, sock_read=TIMEOUT)
+    return aiohttp.ClientSession(connector=connector, timeout=timeout)
+
+
+async def request(session, method, url, payload=b'', sign=True,
+                  json=False, headers=None):
+    """Sends a request, raising errors as uhu.updatehub.http does.
+
+    Signed requests are prepared by the same Request used by the
+    default engine. Response is returned as a requests.Response.
+    """
+    # pylint: disable=too-many-arguments,redefined-outer-name
+    if sign:
+        req = Request(url, method, payload, json=json, headers=headers)
+        headers = req.prepare()
+        payload = req.payload
+    if isinstance(payload, str):
+        payload = payload.encode()
+    try:
+        async with session.request(
+                method, url, data=payload, headers=headers) as response:
+            content = await response.read()
+    except aiohttp.InvalidURL:
+        raise http.HTTPError('You have provided an invalid server URL.')
+    except aiohttp.ClientSSLError:
+        raise http.HTTPError(http.UNAVAILABLE_ERROR)
+    except (aiohttp.ClientConnectionError, aiohttp.ClientPayloadError,
+            asyncio.TimeoutError):
+        raise http.TransientHTTPError(http.UNAVAILABLE_ERROR)
+    except aiohttp.ClientError:
+        raise http.HTTPError(http.UNKNOWN_ERROR)
+    return http.check_response(build_response(
+        url, response.status, response.reason, response.headers.items(),
+        content))
+
+
+async def retry(func, *args, **kwargs):
+    """Awaits func while it fails with a TransientHTTPError.
+
+    Same as uhu.updatehub.http.retry, without blocking the loop.
+    """
+    retries = get_retries()
+    for attempt in itertools.count():
+        try:
+            return await func(*args, **kwargs)
+        except http.TransientHTTPError:
+            if attempt >= retries:
+                raise
+        await asyncio.sleep(http.retry_delay(attempt))
+
+
+class ReaderStream(io.RawIOBase):
+    """File-like view of an ObjectReader.
+
+    aiohttp reads file-like payloads in its executor, so the loop is
+    never blocked by disk reads.
+    """
+
+    def __init__(self, reader):
+        super().__init__()
+        self._chunks = iter(reader)
+        self._pending = b''
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        if not self._pending:
+            self._pending = next(self._chunks, b'')
+        size = min(len(buffer), len(self._pending))
+        buffer[:size] = self._pending[:size]
+        self._pending = self._pending[size:]
+        return size
+
+    def close(self):
+        self._chunks.close()  # closes object file
+        super().close()
+
+
+async def put_object(session, filename, url, callback=None, start=0,
+                     size=None):
+    """Uploads an object with a single PUT, retrying it on failures.
+
+    start and size select a part of file as object (see ObjectReader).
+    """
+    # pylint: disable=too-many-arguments
+    reader = ObjectReader(filename, callback, start=start, size=size)
+    headers = {'Content-Length': str(len(reader))}
+
+    def upload():
+        return request(session, 'PUT', url, ReaderStream(reader),
+                       sign=False, headers=headers)
+    try:
+        await retry(upload)
+    except http.HTTPError:
+        return ObjectUploadResult.FAIL
+    reader.finish()
+    return ObjectUploadResult.SUCCESS
+
+
+# Push Package
+
+def push_package(metadata, objects, callback=None, jobs=None):
+    """Uploads a package to UpdateHub server using an event loop.
+
+    Behaves like uhu.updatehub.api.push_package, whose push_objects
+    decides what is sent: each of its steps is run by the loop. At
+    most jobs objects (UHU_UPLOAD_JOBS by default) are checked and
+    uploaded at the same time.
+    """
+    if aiohttp is None:
+        raise UpdateHubError(
+            'asyncio engine depends on aiohttp. Please install it.')
+    loop = asyncio.new_event_loop()
+    try:
+        session = loop.run_until_complete(_create_session())
+        try:
+            package_uid = loop.run_until_complete(
+                upload_metadata(session, metadata))
+            return push_objects(
+                package_uid, objects, callback,
+                lambda objs, cb: loop.run_until_complete(upload_objects(
+                    session, package_uid, objs, cb, jobs)),
+                lambda cb: loop.run_until_complete(finish_package(
+                    session, package_uid, cb)))
+        finally:
+            loop.run_until_complete(session.close())
+    finally:
+        loop.close()
+
+
+async def _create_session():
+    # Sessions must be created by a coroutine of their loop
+    return create_session()
+
+
+async def upload_metadata(session, metadata):
+    payload, headers = prepare_metadata(metadata)
+    url = get_server_url('/packages')
+    with metadata_errors():
+        response = await request(
+            session, 'POST', url, payload, json=True, headers=headers)
+        return response.json()['uid']
+
+
+async def upload_object(session, obj, package_uid, callback=None):
+    """Uploads a package object to UpdateHub server.
+
+    Multipart and resumable (dummy storage) uploads are rare and the
+    default engine sends them better: they are run in loop executor.
+    """
+    check = check_object(obj, package_uid, callback)
+    if check is None:
+        return ObjectUploadResult.STORED
+    try:
+        upload = parse_object_check(obj, await retry(
+            request, session, 'POST', *check, json=True), callback)
+    except http.HTTPError:
+        return ObjectUploadResult.FAIL
+    if isinstance(upload, ObjectUploadResult):
+        return upload
+    if 'parts' in upload.kwargs or upload.storage == 'dummy':
+        return await asyncio.get_event_loop().run_in_executor(
+            None, upload_to_storage, obj, upload, callback)
+    result = await put_object(
+        session, obj['filename'], upload.url, callback, **upload.kwargs)
+    if result == ObjectUploadResult.SUCCESS:
+        set_stored(obj)
+    return result
+
+
+async def upload_objects(session, package_uid, objects, callback=None,
+                         jobs=None):
+    """Uploads package objects, at most jobs of them at the same time."""
+    call(callback, 'start_package_upload', objects)
+    semaphore = asyncio.Semaphore(get_upload_jobs() if jobs is None else jobs)
+
+    async def upload(obj):
+        async with semaphore:
+            return await upload_object(session, obj, package_uid, callback)
+    results = await asyncio.gather(*[upload(obj) for obj in objects])
+    check_upload_results(results, callback)
+
+
+async def finish_package(session, package_uid, callback=None):
+    with finishing_package(package_uid, callback) as url:
+        await request(session, 'PUT', url)
@@ -1,53 +1,301 @@
 # Copyright (C) 2017 O.S. Systems Software LTDA.
 # SPDX-License-Identifier: GPL-2.0
 
+import gzip
 import json
+import math
 import os
+import re
+import threading
+from collections import namedtuple
+from contextlib import contextmanager
 from enum import Enum
+from urllib.parse import urlparse
 
 from pkgschema import validate_metadata, ValidationError
 
+from uhu.cache import cache
 from uhu.config import config
-from uhu.utils import call, get_server_url, get_chunk_size, sign_dict
+from uhu.utils import (
+    call, canonical_json, get_compress_metadata, get_server_url,
+    get_chunk_size, get_upload_jobs, parallel_map, sign_bytes)
 from . import http
+from ._transport import send_file
 
 
 # Utilities
 
 class ObjectReader:  # pylint: disable=too-few-public-methods
-    """Read-only object class. Used when uploading with requests."""
+    """Read-only object class. Used when uploading with requests.
 
-    def __init__(self, filename, callback=None):
+    Object is read from offset on, so an interrupted upload can be
+    resumed by the same reader. Chunks are reported to callback only
+    once, even if they are read again (or skipped) by a retry.
+
+    Object may be just the size bytes of file found at start (e.g. an
+    archive entry); offset is relative to start.
+    """
+
+    def __init__(self, filename, callback=None, offset=0, start=0,
+                 size=None):
+        # pylint: disable=too-many-arguments
         self.filename = os.path.realpath(filename)
         self.callback = callback
+        self.offset = offset
+        self.start = start
+        if size is None:
+            size = os.path.getsize(self.filename) - start
+        self.size = size
+        self.reported = 0  # chunks already reported to callback
 
     def __len__(self):
-        return os.path.getsize(self.filename)
+        return self.size - self.offset
 
     def __iter__(self):
         """Yields every single chunk."""
         chunk_size = get_chunk_size()
         with open(self.filename, 'br') as fp:
-            for chunk in iter(lambda: fp.read(chunk_size), b''):
+            fp.seek(self.start + self.offset)
+            position = self.offset
+            while position < self.size:
+                chunk = fp.read(min(chunk_size, self.size - position))
+                if not chunk:
+                    break  # file was truncated
                 yield chunk
-                call(self.callback, 'object_read')
+                position += len(chunk)
+                self._report(math.ceil(position / chunk_size))
+
+    def send_to(self, sock):
+        """Sends object to sock without reading it into Python."""
+        chunk_size = get_chunk_size()
+        with open(self.filename, 'br') as fp:
+            send_file(sock, fp.fileno(), self.start + self.offset, len(self),
+                      lambda sent: self._report(
+                          math.ceil((self.offset + sent) / chunk_size)))
+
+    def finish(self):
+        """Reports the chunks which were never read (if any)."""
+        self._report(math.ceil(self.size / get_chunk_size()))
+
+    def _report(self, chunks):
+        while self.reported < chunks:
+            self.reported += 1
+            call(self.callback, 'object_read')
+
 
+def get_upload_offset(url, size):
+    """Returns how many bytes of an interrupted upload storage has.
 
-def dummy_object_upload(filename, url, callback=None):
-    data = ObjectReader(filename, callback)
+    An empty PUT with "Content-Range: bytes */<size>" header is sent.
+    Storages which support resumable uploads answer it with 308 and the
+    received bytes in a "Range: bytes=0-<last>" header. For anything
+    else, upload must start over (offset 0).
+    """
+    headers = {'Content-Range': 'bytes */{}'.format(size)}
     try:
-        http.put(url, data=data, sign=False)
-        return ObjectUploadResult.SUCCESS
+        response = http.put(url, data=b'', headers=headers, sign=False)
+    except http.TransientHTTPError:
+        raise
+    except http.HTTPError:
+        return 0
+    match = re.match(r'bytes=0-(\d+)$', response.headers.get('Range', ''))
+    if response.status_code != 308 or match is None or size == 0:
+        return 0
+    # Last byte is always sent, so storage can complete the upload
+    return min(int(match.group(1)) + 1, size - 1)
+
+
+def put_object(filename, url, callback=None, resumable=False, start=0,
+               size=None):
+    """Uploads an object with a single PUT, retrying it on failures.
+
+    If resumable, a retry continues from the offset confirmed by the
+    storage (see get_upload_offset) instead of starting over. The
+    upload URL is kept in cache until the upload is done, so uploads
+    interrupted by a previous uhu process are resumed too.
+
+    start and size select a part of file as object (see ObjectReader).
+    Each part (e.g. archive entry) keeps its own upload URL.
+    """
+    # pylint: disable=too-many-arguments
+    key = 'upload' if size is None else 'upload-{}'.format(start)
+    reader = ObjectReader(filename, callback, start=start, size=size)
+    size = len(reader)
+    resuming = resumable and cache.get(filename).get(key) == url
+
+    def upload():
+        nonlocal resuming
+        reader.offset = get_upload_offset(url, size) if resuming else 0
+        headers = {}
+        if reader.offset:
+            headers['Content-Range'] = 'bytes {}-{}/{}'.format(
+                reader.offset, size - 1, size)
+        if resumable and not resuming:
+            cache.update(filename, **{key: url})
+            cache.flush()
+        resuming = resumable
+        http.put(url, data=reader, headers=headers, sign=False)
+
+    try:
+        http.retry(upload)
     except http.HTTPError:
         return ObjectUploadResult.FAIL
+    if resumable:
+        cache.update(filename, **{key: None})
+    reader.finish()
+    return ObjectUploadResult.SUCCESS
+
+
+class PartReader:  # pylint: disable=too-few-public-methods
+    """Read-only part of an object. Used by multipart uploads.
+
+    Part is read with os.pread, which does not move the file offset,
+    so all parts of an object are read in parallel from the same file
+    descriptor.
+    """
+
+    def __init__(self, descriptor, offset, size):
+        self.descriptor = descriptor
+        self.offset = offset
+        self.size = size
+
+    def __len__(self):
+        return self.size
 
+    def __iter__(self):
+        """Yields every single chunk."""
+        chunk_size = get_chunk_size()
+        end = self.offset + self.size
+        for position in range(self.offset, end, chunk_size):
+            chunk = os.pread(
+                self.descriptor, min(chunk_size, end - position), position)
+            if not chunk:
+                break  # file was truncated
+            yield chunk
+
+    def send_to(self, sock):
+        """Sends part to sock without reading it into Python."""
+        send_file(sock, self.descriptor, self.offset, self.size)
+
+
+class PartsProgress:  # pylint: disable=too-few-public-methods
+    """Reports chunks of parts uploaded by many threads to callback."""
+
+    def __init__(self, callback=None):
+        self.callback = callback
+        self.uploaded = 0  # bytes
+        self.reported = 0  # chunks
+        self._lock = threading.Lock()
+
+    def add(self, size, finish=False):
+        """Reports size uploaded bytes.
+
+        Only whole chunks are reported, unless finish is set.
+        """
+        with self._lock:
+            self.uploaded += size
+            chunks = self.uploaded / get_chunk_size()
+            chunks = math.ceil(chunks) if finish else math.floor(chunks)
+            while self.reported < chunks:
+                self.reported += 1
+                call(self.callback, 'object_read')
 
-def swift_object_upload(*args, **kw):
-    return dummy_object_upload(*args, **kw)
 
+def multipart_upload(filename, parts, part_size, complete, callback=None,
+                     start=0, size=None):
+    """Uploads an object split in parts, sending them in parallel.
 
-def s3_object_upload(*args, **kw):
-    return dummy_object_upload(*args, **kw)
+    parts are the upload URLs of each part_size bytes part, in order.
+    Parts are uploaded by UHU_UPLOAD_JOBS threads (each part is retried
+    on its own) and, once all of them are uploaded, complete is called
+    with a list of (url, size, etag) tuples to commit the upload.
+
+    start and size select a part of file as object (see ObjectReader).
+    """
+    # pylint: disable=too-many-arguments
+    if size is None:
+        size = os.path.getsize(filename) - start
+    offsets = range(0, size, part_size) if part_size > 0 else []
+    if len(offsets) != len(parts):
+        return ObjectUploadResult.FAIL
+    progress = PartsProgress(callback)
+    descriptor = os.open(filename, os.O_RDONLY)
+
+    def upload(part):
+        url, offset = part
+        reader = PartReader(
+            descriptor, start + offset, min(part_size, size - offset))
+        response = http.retry(http.put, url, data=reader, sign=False)
+        progress.add(len(reader))
+        etag = response.headers.get('ETag', '').strip('"')
+        return url, len(reader), etag
+
+    try:
+        uploaded = parallel_map(
+            upload, zip(parts, offsets), get_upload_jobs())
+        complete(uploaded)
+    except http.HTTPError:
+        return ObjectUploadResult.FAIL
+    finally:
+        os.close(descriptor)
+    progress.add(0, finish=True)
+    return ObjectUploadResult.SUCCESS
+
+
+def s3_complete_upload(url, parts):
+    """Commits a S3 multipart upload."""
+    body = ''.join(
+        '<Part><PartNumber>{}</PartNumber><ETag>"{}"</ETag></Part>'.format(
+            number, etag) for number, (_, _, etag) in enumerate(parts, 1))
+    body = '<CompleteMultipartUpload>{}</CompleteMultipartUpload>'.format(
+        body)
+    response = http.retry(http.post, url, data=body.encode(), sign=False)
+    # S3 may answer 200 and report the error in response body
+    if '<Error>' in response.text:
+        raise http.HTTPError('Could not complete multipart upload.')
+
+
+def swift_complete_upload(url, parts):
+    """Commits a Swift segmented upload with a static large object.
+
+    Segment paths are taken from segment URLs, which look like
+    https://<host>/v1/<account>/<container>/<object>.
+    """
+    manifest = [{
+        'path': '/' + urlparse(part_url).path.split('/', 3)[3],
+        'etag': etag,
+        'size_bytes': size,
+    } for part_url, size, etag in parts]
+    separator = '&' if urlparse(url).query else '?'
+    url = '{}{}multipart-manifest=put'.format(url, separator)
+    http.retry(http.put, url, data=json.dumps(manifest).encode(), sign=False)
+
+
+def dummy_object_upload(filename, url, callback=None, start=0, size=None):
+    return put_object(
+        filename, url, callback, resumable=True, start=start, size=size)
+
+
+def swift_object_upload(filename, url, callback=None, parts=None,
+                        part_size=None, start=0, size=None):
+    # pylint: disable=too-many-arguments
+    if not parts:
+        return put_object(filename, url, callback, start=start, size=size)
+    return multipart_upload(
+        filename, parts, part_size,
+        lambda uploaded: swift_complete_upload(url, uploaded), callback,
+        start=start, size=size)
+
+
+def s3_object_upload(filename, url, callback=None, parts=None,
+                     part_size=None, start=0, size=None):
+    # pylint: disable=too-many-arguments
+    if not parts:
+        return put_object(filename, url, callback, start=start, size=size)
+    return multipart_upload(
+        filename, parts, part_size,
+        lambda uploaded: s3_complete_upload(url, uploaded), callback,
+        start=start, size=size)
 
 
 STORAGES = {
@@ -61,34 +309,132 @@ class ObjectUploadResult(Enum):
     SUCCESS = 1
     EXISTS = 2
     FAIL = 3
+    STORED = 4  # server was not asked, ledger says it has the object
+
+
+# Upload told by server: storage name, upload URL and uploader kwargs
+ObjectUpload = namedtuple('ObjectUpload', 'storage url kwargs')
 
 
 class UpdateHubError(Exception):
     """Exception to be used when API is broken."""
 
 
+# Ledger
+
+def is_stored(obj):
+    """Checks if object was already confirmed as stored by server.
+
+    Confirmations are kept in cache, with the object file, for each
+    server URL. Like digests, they are lost when the file changes.
+    """
+    servers = cache.get(obj['filename']).get(_ledger_key(obj), [])
+    return get_server_url() in servers
+
+
+def set_stored(obj, stored=True):
+    """Records (or forgets) that server has stored object."""
+    server = get_server_url()
+    key = _ledger_key(obj)
+    servers = set(cache.get(obj['filename']).get(key, []))
+    if stored:
+        servers.add(server)
+    else:
+        servers.discard(server)
+    cache.update(obj['filename'], **{key: sorted(servers)})
+
+
+def _ledger_key(obj):
+    # Objects which are part of a file (archive entries) share it
+    if 'start' in obj:
+        return 'stored-{}'.format(obj['sha256sum'])
+    return 'stored'
+
+
 # Push Package
 
-def push_package(metadata, objects, callback=None):
-    package_uid = upload_metadata(metadata)
-    upload_objects(package_uid, objects, callback)
-    finish_package(package_uid, callback)
+def push_package(metadata, objects, callback=None, jobs=None,
+                 signature=None):
+    """Uploads a package to UpdateHub server.
+
+    Objects may be part of a file: their start and size keys select
+    it. See prepare_metadata for signature.
+    """
+    package_uid = upload_metadata(metadata, signature)
+    return push_objects(
+        package_uid, objects, callback,
+        lambda objs, cb: upload_objects(package_uid, objs, cb, jobs),
+        lambda cb: finish_package(package_uid, cb))
+
+
+def push_objects(package_uid, objects, callback, upload, finish):
+    """Uploads objects of a package and finishes it.
+
+    This is the push policy of every engine, which only do the I/O:
+    upload(objects, callback) must work like upload_objects and
+    finish(callback) like finish_package.
+
+    Objects which ledger says server already has are not checked. If
+    server refuses to finish the package, ledger may be wrong: these
+    objects are forgotten and uploaded as usual before trying again.
+    """
+    stored = [obj for obj in objects if is_stored(obj)]
+    upload(objects, callback)
+    if stored:
+        try:
+            finish(None)
+        except UpdateHubError:
+            for obj in stored:
+                set_stored(obj, False)
+            upload(stored, None)
+        else:
+            call(callback, 'push_finish', package_uid)
+            return package_uid
+    finish(callback)
     return package_uid
 
 
-def upload_metadata(metadata):
+def prepare_metadata(metadata, signature=None):
+    """Returns the payload and headers to upload metadata with.
+
+    metadata is serialized and signed with the private key, unless its
+    signature is given: then, metadata must be the signed bytes (e.g.
+    from an archive), which are sent as they are.
+    """
+    if signature is not None:
+        payload = metadata
+        try:
+            metadata = json.loads(payload.decode())
+        except ValueError:
+            raise UpdateHubError('You have an invalid package metadata.')
     try:
         validate_metadata(metadata)
     except ValidationError:
         raise UpdateHubError('You have an invalid package metadata.')
-    url = get_server_url('/packages')
-    signature = sign_dict(metadata, config.get_private_key_path())
-    payload = json.dumps(metadata, sort_keys=True)
+    if signature is None:
+        # The same bytes are signed, hashed by request and sent
+        payload = canonical_json(metadata)
+        signature = sign_bytes(payload, config.get_private_key_path())
     headers = {'UH-SIGNATURE': signature}
+    if get_compress_metadata():
+        payload = gzip.compress(payload)
+        headers['Content-Encoding'] = 'gzip'
+    return payload, headers
+
+
+def upload_metadata(metadata, signature=None):
+    payload, headers = prepare_metadata(metadata, signature)
+    url = get_server_url('/packages')
+    with metadata_errors():
+        response = http.post(url, payload=payload, json=True, headers=headers)
+        return response.json()['uid']
+
+
+@contextmanager
+def metadata_errors():
+    """Raises UpdateHubError for errors of a metadata upload."""
     try:
-        response = http.post(
-            url, payload=payload, json=True, headers=headers).json()
-        return response['uid']
+        yield
     except http.HTTPError as error:
         raise UpdateHubError('Could not upload metadata: {}'.format(error))
     except (ValueError, KeyError):
@@ -97,33 +443,88 @@ def upload_metadata(metadata):
 
 def upload_object(obj, package_uid, callback=None):
     """Uploads a package object to UpdateHub server."""
-    # First, check if we should upload the object
-    url = get_server_url('/packages/{}/objects/{}'.format(
-        package_uid, obj['sha256sum']))
-    body = json.dumps({'etag': obj['md5']})
+    check = check_object(obj, package_uid, callback)
+    if check is None:
+        return ObjectUploadResult.STORED
     try:
-        response = http.post(url, body, json=True)
+        response = http.retry(http.post, *check, json=True)
     except http.HTTPError:
         return ObjectUploadResult.FAIL
+    upload = parse_object_check(obj, response, callback)
+    if isinstance(upload, ObjectUploadResult):
+        return upload
+    return upload_to_storage(obj, upload, callback)
+
 
-    # Object already uploaded, return EXISTS.
+def check_object(obj, package_uid, callback=None):
+    """Returns URL and body of the request which checks obj on server.
+
+    If ledger says server already has it, obj is reported as read and
+    None is returned: there is nothing to check.
+    """
+    if is_stored(obj):
+        call(callback, 'object_read', obj['chunks'])
+        return None
+    url = get_server_url('/packages/{}/objects/{}'.format(
+        package_uid, obj['sha256sum']))
+    return url, json.dumps({'etag': obj['md5']})
+
+
+def parse_object_check(obj, response, callback=None):
+    """Tells how obj must be uploaded, given server check response.
+
+    Returns EXISTS if server already has obj, FAIL if response can not
+    be understood and, otherwise, an ObjectUpload. Large objects may
+    be split by server in parts, to be uploaded in parallel.
+    """
     if response.status_code == 200:
         call(callback, 'object_read', obj['chunks'])
+        set_stored(obj)
         return ObjectUploadResult.EXISTS
-
-    # Object not uploaded, try to uploaded it.
     try:
         body = response.json()
-        uploader = STORAGES[body['storage']]
+        storage = body['storage']
+        if storage not in STORAGES:
+            return ObjectUploadResult.FAIL
         url = body['url']
-    except (ValueError, KeyError):
+        kwargs = {}
+        if body.get('parts'):
+            kwargs['parts'] = body['parts']
+            kwargs['part_size'] = int(body['part_size'])
+    except (ValueError, KeyError, TypeError):
         return ObjectUploadResult.FAIL
-    return uploader(obj['filename'], url, callback)
+    if 'start' in obj:  # object is part of a file, e.g. an archive entry
+        kwargs['start'] = obj['start']
+        kwargs['size'] = obj['size']
+    return ObjectUpload(storage, url, kwargs)
 
 
-def upload_objects(package_uid, objects, callback=None):
+def upload_to_storage(obj, upload, callback=None):
+    """Uploads obj as told by parse_object_check."""
+    uploader = STORAGES[upload.storage]
+    result = uploader(obj['filename'], upload.url, callback, **upload.kwargs)
+    if result == ObjectUploadResult.SUCCESS:
+        set_stored(obj)
+    return result
+
+
+def upload_objects(package_uid, objects, callback=None, jobs=None):
+    """Uploads package objects to UpdateHub server.
+
+    Objects are checked and uploaded by a pool of jobs threads, so
+    requests to the server and to the storage overlap. If jobs is None,
+    it is taken from UHU_UPLOAD_JOBS environment variable. Callback
+    must be thread safe, since it is called from all of them.
+    """
     call(callback, 'start_package_upload', objects)
-    results = [upload_object(obj, package_uid, callback) for obj in objects]
+    jobs = get_upload_jobs() if jobs is None else jobs
+    results = parallel_map(
+        lambda obj: upload_object(obj, package_uid, callback), objects, jobs)
+    check_upload_results(results, callback)
+
+
+def check_upload_results(results, callback=None):
+    """Reports the end of an objects upload, raising if any failed."""
     call(callback, 'finish_package_upload')
     if ObjectUploadResult.FAIL in results:
         raise UpdateHubError(
@@ -131,9 +532,16 @@ def upload_objects(package_uid, objects, callback=None):
 
 
 def finish_package(package_uid, callback=None):
+    with finishing_package(package_uid, callback) as url:
+        http.put(url)
+
+
+@contextmanager
+def finishing_package(package_uid, callback=None):
+    """Yields URL which finishes package, raising UpdateHubError."""
     url = get_server_url('/packages/{}/finish'.format(package_uid))
     try:
-        http.put(url)
+        yield url
     except http.HTTPError as error:
         raise UpdateHubError(
             'Could not finish package on server: {}'.format(error))
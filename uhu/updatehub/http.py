@@ -1,13 +1,27 @@
 # Copyright (C) 2017 O.S. Systems Software LTDA.
 # SPDX-License-Identifier: GPL-2.0
 
+import itertools
+import random
+import time
+
 import requests
 
-from ..utils import get_custom_ca_certs_file
-from ._request import Request, HTTPError
+from ..utils import get_custom_ca_certs_file, get_retries
+from ._request import Request, HTTPError, TransientHTTPError
+from ._session import get_session
+from . import _transport
 
 
 UNKNOWN_ERROR = 'A unexpected request error ocurred. Try again later.'
+UNAVAILABLE_ERROR = 'Server is not available. Try again later.'
+
+# Responses which may succeed if request is retried
+TRANSIENT_STATUS_CODES = (408, 429, 500, 502, 503, 504)
+
+# Delay before the first retry, doubled on every retry up to the max
+RETRY_DELAY = 1  # seconds
+RETRY_MAX_DELAY = 30  # seconds
 
 
 def request(method, url, *args, sign=True, **kwargs):
@@ -19,8 +33,12 @@ def request(method, url, *args, sign=True, **kwargs):
     try:
         if sign:
             response = Request(url, method, *args, **kwargs).send()
+        elif not args and _transport.accepts(url, kwargs.get('data')):
+            # Large object files are sent without copying them
+            response = _transport.send(
+                method, url, kwargs['data'], kwargs.get('headers'))
         else:
-            response = requests.request(
+            response = get_session().request(
                 method, url, *args, timeout=30, **kwargs)
     except HTTPError as error:
         raise error
@@ -30,18 +48,54 @@ def request(method, url, *args, sign=True, **kwargs):
             requests.exceptions.InvalidURL):
         raise HTTPError('You have provided an invalid server URL.')
     except requests.ConnectTimeout:
-        raise HTTPError('Connection timed out. Try again later.')
+        raise TransientHTTPError('Connection timed out. Try again later.')
+    except requests.exceptions.SSLError:
+        raise HTTPError(UNAVAILABLE_ERROR)
     except requests.ConnectionError:
-        raise HTTPError('Server is not available. Try again later.')
+        raise TransientHTTPError(UNAVAILABLE_ERROR)
+    except (requests.Timeout, requests.exceptions.ChunkedEncodingError):
+        raise TransientHTTPError(UNKNOWN_ERROR)
     except requests.RequestException:
         raise HTTPError(UNKNOWN_ERROR)
+    return check_response(response)
+
+
+def check_response(response):
+    """Raises the proper HTTPError if response is not successful."""
     if response.status_code == 401:
         raise HTTPError('Unautorized. Did you set your credentials?')
+    elif response.status_code in TRANSIENT_STATUS_CODES:
+        raise TransientHTTPError(
+            format_server_error(response), response=response)
     elif not response.ok:
-        raise HTTPError(format_server_error(response))
+        raise HTTPError(format_server_error(response), response=response)
     return response
 
 
+def retry(func, *args, **kwargs):
+    """Calls func while it fails with a TransientHTTPError.
+
+    Retries are delayed by an exponential backoff with full jitter, so
+    many clients (or upload threads) don't retry all at once. After
+    UHU_RETRIES retries, the last error is raised. Any other error is
+    raised at once.
+    """
+    retries = get_retries()
+    for attempt in itertools.count():
+        try:
+            return func(*args, **kwargs)
+        except TransientHTTPError:
+            if attempt >= retries:
+                raise
+        time.sleep(retry_delay(attempt))
+
+
+def retry_delay(attempt):
+    """Returns how long to wait before retrying a failed attempt."""
+    return random.uniform(
+        0, min(RETRY_MAX_DELAY, RETRY_DELAY * 2 ** attempt))
+
+
 def get(url, *args, **kwargs):
     return request('GET', url, *args, **kwargs)
 
@@ -2,8 +2,10 @@
 # SPDX-License-Identifier: GPL-2.0
 
 import base64
+import binascii
 import json
 import os
+from concurrent.futures import ThreadPoolExecutor
 
 from Crypto.Hash import SHA256
 from Crypto.PublicKey import RSA
@@ -19,6 +21,13 @@ ACCESS_ID_VAR = 'UHU_ACCESS_ID'
 ACCESS_SECRET_VAR = 'UHU_ACCESS_SECRET'
 PRIVATE_KEY_FN = 'UHU_PRIVATE_KEY'
 CUSTOM_CA_CERTS_VAR = 'UHU_CUSTOM_CA_CERTS'
+CACHE_FILE_VAR = 'UHU_CACHE_FILE'
+CACHE_SIZE_VAR = 'UHU_CACHE_SIZE'
+JOBS_VAR = 'UHU_JOBS'
+HTTP_POOL_SIZE_VAR = 'UHU_HTTP_POOL_SIZE'
+UPLOAD_JOBS_VAR = 'UHU_UPLOAD_JOBS'
+RETRIES_VAR = 'UHU_RETRIES'
+COMPRESS_METADATA_VAR = 'UHU_COMPRESS_METADATA'
 
 
 # Default values
@@ -26,6 +35,13 @@ DEFAULT_CHUNK_SIZE = 1024 * 128  # 128 KiB
 DEFAULT_GLOBAL_CONFIG_FILE = os.path.expanduser('~/.uhu')
 DEFAULT_LOCAL_CONFIG_FILE = '.uhu'
 DEFAULT_SERVER_URL = 'http://0.0.0.0'  # TODO: replace by the right URL
+DEFAULT_CACHE_FILENAME = '.uhu-cache'  # next to global config file
+DEFAULT_CACHE_SIZE = 1024  # entries
+DEFAULT_JOBS = os.cpu_count() or 1
+DEFAULT_HTTP_POOL_SIZE = 10  # connections per host
+DEFAULT_UPLOAD_JOBS = 4
+DEFAULT_RETRIES = 5
+DEFAULT_COMPRESS_METADATA = 0  # disabled
 
 
 def get_chunk_size():
@@ -58,6 +74,47 @@ def get_custom_ca_certs_file():
     return os.environ.get(CUSTOM_CA_CERTS_VAR, None)
 
 
+def get_cache_file():
+    fn = os.environ.get(CACHE_FILE_VAR)
+    if fn is not None:
+        return fn
+    config_dir = os.path.dirname(os.path.abspath(get_global_config_file()))
+    return os.path.join(config_dir, DEFAULT_CACHE_FILENAME)
+
+
+def _get_int_var(var, default):
+    """Returns an integer environment variable, or default if invalid."""
+    try:
+        return int(os.environ.get(var, default))
+    except ValueError:
+        return default  # a typo must not break every command
+
+
+def get_cache_size():
+    return _get_int_var(CACHE_SIZE_VAR, DEFAULT_CACHE_SIZE)
+
+
+def get_jobs():
+    return max(1, _get_int_var(JOBS_VAR, DEFAULT_JOBS))
+
+
+def get_http_pool_size():
+    return max(1, _get_int_var(HTTP_POOL_SIZE_VAR, DEFAULT_HTTP_POOL_SIZE))
+
+
+def get_upload_jobs():
+    return max(1, _get_int_var(UPLOAD_JOBS_VAR, DEFAULT_UPLOAD_JOBS))
+
+
+def get_retries():
+    return max(0, _get_int_var(RETRIES_VAR, DEFAULT_RETRIES))
+
+
+def get_compress_metadata():
+    return bool(_get_int_var(
+        COMPRESS_METADATA_VAR, DEFAULT_COMPRESS_METADATA))
+
+
 def remove_local_config():
     os.remove(get_local_config_file())
 
@@ -67,6 +124,33 @@ def call(obj, name, *args, **kw):
     func(*args, **kw)
 
 
+def memoize(memo, key, func, *args, **kw):
+    """Calls func only if there is no result for key in memo yet.
+
+    If memo is None, func is always called.
+    """
+    if memo is None:
+        return func(*args, **kw)
+    if key not in memo:
+        memo[key] = func(*args, **kw)
+    return memo[key]
+
+
+def parallel_map(func, iterable, jobs=None):
+    """Applies func to every item using a pool of jobs threads.
+
+    Results are returned in the same order of iterable, no matter the
+    order in which they were computed. If jobs is None, it is taken
+    from UHU_JOBS environment variable.
+    """
+    items = list(iterable)
+    jobs = min(get_jobs() if jobs is None else jobs, len(items))
+    if jobs <= 1:
+        return [func(item) for item in items]
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        return list(executor.map(func, items))
+
+
 def indent(value, n_indents, all_lines=False):
     """Indent a multline string to right by n_indents.
 
@@ -100,8 +184,18 @@ def list_to_str(title, lst):
     return '\n'.join(lines)
 
 
+def canonical_json(dict_):
+    """Serializes a dict to the JSON bytes which are signed and sent."""
+    return json.dumps(dict_, sort_keys=True).encode()
+
+
 def sign_dict(dict_, private_key):
     """Serializes a dict to JSON and sign it using RSA."""
+    return sign_bytes(canonical_json(dict_), private_key)
+
+
+def sign_bytes(data, private_key):
+    """Signs data using RSA."""
     try:
         with open(private_key) as fp:
             key = RSA.importKey(fp.read())
@@ -111,8 +205,26 @@ def sign_dict(dict_, private_key):
     signer = PKCS1_v1_5.new(key)
 
     # encodes message
-    message = SHA256.new(json.dumps(dict_, sort_keys=True).encode())
+    message = SHA256.new(data)
 
     # sign
     signature = signer.sign(message)
     return base64.b64encode(signature).decode()
+
+
+def verify_bytes(data, signature, key):
+    """Checks a signature made by sign_bytes.
+
+    key is a RSA key file. It may hold a public key or the private key
+    which signed data.
+    """
+    try:
+        with open(key) as fp:
+            key = RSA.importKey(fp.read()).publickey()
+    except (FileNotFoundError, ValueError, IndexError, TypeError):
+        raise ValueError('Invalid public key file.')
+    try:
+        signature = base64.b64decode(signature, validate=True)
+    except (binascii.Error, ValueError):
+        return False
+    return bool(PKCS1_v1_5.new(key).verify(SHA256.new(data), signature))